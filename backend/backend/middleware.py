@@ -0,0 +1,80 @@
+from asgiref.sync import iscoroutinefunction,markcoroutinefunction,sync_to_async
+from django.conf import settings
+from whitenoise.middleware import WhiteNoiseMiddleware
+from backend.routers import replica_reads
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    #whitenoise is sync only, and one sync middleware makes django run every
+    #request, async views included, through the sync thread. static files are
+    #still served the whitenoise way, everything else stays on the event loop
+    sync_capable=True
+    async_capable=True
+
+    def __init__(self,get_response=None,*args,**kwargs):
+        super().__init__(get_response,*args,**kwargs)
+        self.async_mode=iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self,request):
+        if self.async_mode:
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self,request):
+        if self.autorefresh:
+            static_file=await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file=self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file,request)
+        return await self.get_response(request)
+
+
+class ReplicaReadMiddleware:
+    #safe requests read from replicas. after a write the client gets a short lived
+    #cookie that keeps its reads on the primary until the replicas caught up
+    sync_capable=True
+    async_capable=True
+    cookie='db_primary'
+
+    def __init__(self,get_response):
+        self.get_response=get_response
+        self.async_mode=iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self,request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token=replica_reads.set(self.safe(request))
+        try:
+            response=self.get_response(request)
+        finally:
+            replica_reads.reset(token)
+        return self.pin(request,response)
+
+    async def __acall__(self,request):
+        token=replica_reads.set(self.safe(request))
+        try:
+            response=await self.get_response(request)
+        finally:
+            replica_reads.reset(token)
+        return self.pin(request,response)
+
+    def safe(self,request):
+        return request.method in ('GET','HEAD','OPTIONS') and self.cookie not in request.COOKIES
+
+    def pin(self,request,response):
+        if request.method not in ('GET','HEAD','OPTIONS') and response.status_code<400:
+            response.set_cookie(
+                key=self.cookie,
+                value='1',
+                max_age=getattr(settings,'REPLICA_PIN_SECONDS',5),
+                httponly=True,
+                secure=True,
+                samesite='None',
+                path='/'
+            )
+        return response
@@ -0,0 +1,106 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack,contextmanager
+from asgiref.sync import iscoroutinefunction,markcoroutinefunction,sync_to_async
+from django.db import connections
+
+#opt-in request profiler (QUERY_PROFILER=true). counts the queries of every api
+#request through a database execute wrapper, so it works without DEBUG, and
+#reports them with the view time as a log line and response headers.
+#query_budget is the same counting for tests
+
+logger=logging.getLogger('backend.profiling')
+
+_literals=re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.queries=[]
+        self.db_time=0
+
+    def __call__(self,execute,sql,params,many,context):
+        start=time.perf_counter()
+        try:
+            return execute(sql,params,many,context)
+        finally:
+            self.db_time+=time.perf_counter()-start
+            self.queries.append(sql)
+
+    @contextmanager
+    def record(self):
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(self))
+            yield self
+
+    def duplicates(self):
+        #same statement shape run more than once, the usual sign of an n+1
+        shapes=Counter(_literals.sub('?',sql) for sql in self.queries)
+        return {sql:count for sql,count in shapes.items() if count>1}
+
+
+class QueryProfilerMiddleware:
+    #first in MIDDLEWARE, a sync only middleware there would put every request,
+    #the async note views included, through the sync thread
+    sync_capable=True
+    async_capable=True
+
+    def __init__(self,get_response):
+        self.get_response=get_response
+        self.async_mode=iscoroutinefunction(self.get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self,request):
+        if self.async_mode:
+            return self.__acall__(request)
+        recorder=QueryRecorder()
+        start=time.perf_counter()
+        with recorder.record():
+            response=self.get_response(request)
+        return self.report(request,response,recorder,time.perf_counter()-start)
+
+    async def __acall__(self,request):
+        recorder=QueryRecorder()
+        start=time.perf_counter()
+        #connections belong to a thread, async views query from the request's sync
+        #thread so the wrappers are put on that thread's connections
+        stack=ExitStack()
+        await sync_to_async(stack.enter_context)(recorder.record())
+        try:
+            response=await self.get_response(request)
+        finally:
+            await sync_to_async(stack.close)()
+        return self.report(request,response,recorder,time.perf_counter()-start)
+
+    def report(self,request,response,recorder,total):
+        duplicates=recorder.duplicates()
+        match=getattr(request,'resolver_match',None)
+        logger.info(json.dumps({
+            'method':request.method,
+            'path':request.path,
+            'view':match.view_name if match else None,
+            'status':response.status_code,
+            'queries':len(recorder.queries),
+            'duplicate_queries':sum(duplicates.values())-len(duplicates),
+            'db_ms':round(recorder.db_time*1000,2),
+            'view_ms':round(total*1000,2),
+        }))
+        response['X-Query-Count']=str(len(recorder.queries))
+        response['Server-Timing']=f'db;dur={recorder.db_time*1000:.2f}, view;dur={total*1000:.2f}'
+        return response
+
+
+@contextmanager
+def query_budget(limit):
+    #with query_budget(3): client.get(...) fails the test past 3 queries
+    recorder=QueryRecorder()
+    with recorder.record():
+        yield recorder
+    if len(recorder.queries)>limit:
+        listing='\n'.join(recorder.queries)
+        raise AssertionError(f"{len(recorder.queries)} queries, budget is {limit}:\n{listing}")
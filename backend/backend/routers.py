@@ -0,0 +1,27 @@
+import random
+from contextvars import ContextVar
+from django.conf import settings
+
+#reads go to a replica only inside requests ReplicaReadMiddleware marked as safe
+#(GET/HEAD from a client that did not write in the last REPLICA_PIN_SECONDS).
+#writes, websocket consumers, the write-behind and commands all use the primary
+
+replica_reads=ContextVar('replica_reads',default=False)
+
+
+class ReplicaRouter:
+    def db_for_read(self,model,**hints):
+        replicas=getattr(settings,'DATABASE_REPLICAS',[])
+        if replicas and replica_reads.get():
+            return random.choice(replicas)
+        return 'default'
+
+    def db_for_write(self,model,**hints):
+        return 'default'
+
+    def allow_relation(self,obj1,obj2,**hints):
+        #replicas hold the same rows as the primary
+        return True
+
+    def allow_migrate(self,db,app_label,model_name=None,**hints):
+        return db=='default'
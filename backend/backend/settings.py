@@ -15,6 +15,7 @@ from datetime import timedelta
 import os
 from dotenv import load_dotenv
 import dj_database_url
+from corsheaders.defaults import default_headers
 
 load_dotenv()
 
@@ -49,6 +50,8 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    #SearchVectorField on Note
+    'django.contrib.postgres',
     'rest_framework',
     'corsheaders',
     'channels',
@@ -66,6 +69,12 @@ REST_FRAMEWORK = {
 
 
 
+#build request.user from the token's user id and a cached copy of the user's fields
+#instead of loading it on every request. a change to the user, is_active included,
+#shows after at most JWT_ACTIVE_CACHE_TIMEOUT seconds
+JWT_AUTH_FAST_PATH = os.environ.get("JWT_AUTH_FAST_PATH", "true").lower() == "true"
+JWT_ACTIVE_CACHE_TIMEOUT = int(os.environ.get("JWT_ACTIVE_CACHE_TIMEOUT", 60))
+
 SIMPLE_JWT = {
     # "TOKEN_OBTAIN_SERIALIZER": "base.serializers.MyTokenObtainPairSerializer",
     "ACCESS_TOKEN_LIFETIME": timedelta(days=30),
@@ -107,7 +116,7 @@ SIMPLE_JWT = {
 }
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'backend.middleware.AsyncWhiteNoiseMiddleware',
 
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -120,6 +129,17 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+#per request query count, duplicate queries and db/view time as a log line and headers
+QUERY_PROFILER = os.environ.get("QUERY_PROFILER", "false").lower() == "true"
+if QUERY_PROFILER:
+    MIDDLEWARE.insert(0, 'backend.profiling.QueryProfilerMiddleware')
+    LOGGING = {
+        "version": 1,
+        "disable_existing_loggers": False,
+        "handlers": {"console": {"class": "logging.StreamHandler"}},
+        "loggers": {"backend.profiling": {"handlers": ["console"], "level": "INFO"}},
+    }
+
 
 # CORS_ALLOW_ALL_ORIGINS = True
 if ENVIRONMENT == "local":
@@ -135,6 +155,9 @@ else:
 
 
 CORS_ALLOW_CREDENTIALS = True
+#conditional requests on notes (ETag / If-None-Match / If-Match)
+CORS_ALLOW_HEADERS = (*default_headers, "if-match", "if-none-match")
+CORS_EXPOSE_HEADERS = ["ETag"]
 
 ROOT_URLCONF = 'backend.urls'
 
@@ -168,11 +191,18 @@ ASGI_APPLICATION = 'backend.asgi.application'
 #     }
 # }
 
+#DB_POOL_MODE picks how connections are shared:
+#  pool       - psycopg3 pool per process (min/max size, acquire timeout, health check on checkout)
+#  pgbouncer  - no connection kept by django, for pgbouncer in transaction pooling mode
+#  persistent - one connection per thread kept CONN_MAX_AGE seconds, the old behaviour
+DB_POOL_MODE = os.environ.get("DB_POOL_MODE", "pool")
+
 DATABASES = {
     "default": dj_database_url.config(
         default=os.environ.get("DATABASE_URL"),
-        conn_max_age=300,
-        conn_health_checks=True,
+        conn_max_age=300 if DB_POOL_MODE == "persistent" else 0,
+        #with the pool this is the check run on every checkout
+        conn_health_checks=DB_POOL_MODE != "pgbouncer",
         ssl_require=True,
     )
 }
@@ -182,6 +212,42 @@ DATABASES['default']['OPTIONS'] = {
     'connect_timeout': 10,
 }
 
+if DB_POOL_MODE == "pool" and "postgresql" in DATABASES['default'].get('ENGINE', ''):
+    DATABASES['default']['OPTIONS']['pool'] = {
+        "min_size": int(os.environ.get("DB_POOL_MIN_SIZE", 2)),
+        "max_size": int(os.environ.get("DB_POOL_MAX_SIZE", 10)),
+        #seconds a request waits for a free connection before failing
+        "timeout": float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+        "max_idle": 300,
+        "max_lifetime": 1800,
+    }
+elif DB_POOL_MODE == "pgbouncer":
+    #transaction pooling hands every transaction a different server connection, so
+    #no server side cursors (django already turns psycopg prepared statements off)
+    DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+#read replicas, comma separated database urls. safe api reads are spread over them,
+#a client that just wrote reads from the primary for REPLICA_PIN_SECONDS
+DATABASE_REPLICAS = []
+for index, url in enumerate(u for u in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if u):
+    alias = f"replica_{index}"
+    DATABASES[alias] = dj_database_url.parse(
+        url,
+        conn_max_age=DATABASES['default']['CONN_MAX_AGE'],
+        conn_health_checks=DATABASES['default']['CONN_HEALTH_CHECKS'],
+        ssl_require=True,
+    )
+    if DB_POOL_MODE == "pgbouncer":
+        DATABASES[alias]['DISABLE_SERVER_SIDE_CURSORS'] = True
+    DATABASES[alias]['OPTIONS'] = dict(DATABASES['default']['OPTIONS'])
+    #tests run against the primary only
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    DATABASE_REPLICAS.append(alias)
+REPLICA_PIN_SECONDS = 5
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS = ['backend.routers.ReplicaRouter']
+    MIDDLEWARE.insert(0, 'backend.middleware.ReplicaReadMiddleware')
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -232,17 +298,23 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 #     }
 # }
 
+REDIS_URL = os.environ.get("REDIS_URL")
+#comma separated redis urls the note rooms are spread over, defaults to REDIS_URL
+REDIS_SHARD_URLS = [url for url in os.environ.get("REDIS_SHARD_URLS", "").split(",") if url] or (
+    [REDIS_URL] if REDIS_URL else []
+)
+#the shard list before a change, set during the rolling restart that changes it and
+#removed in a second one (see notes/sharding.py)
+REDIS_SHARD_URLS_PREVIOUS = [url for url in os.environ.get("REDIS_SHARD_URLS_PREVIOUS", "").split(",") if url]
+
+#pub/sub layer that delivers to room members in this process without redis and
+#publishes once per group message for the other processes
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "notes.layers.LocalFanoutChannelLayer",
         "CONFIG": {
-            "hosts": [os.environ.get("REDIS_URL")],
-            "capacity": 1500,
-            "expiry": 10,
-            "channel_capacity": {
-                "http.request": 200,
-                "http.response!*": 10,
-            },
+            "hosts": REDIS_SHARD_URLS,
+            "previous_hosts": REDIS_SHARD_URLS_PREVIOUS,
         },
         "OPTIONS": {
             "connection_pool_kwargs": {
@@ -256,6 +328,49 @@ CHANNEL_LAYERS = {
     },
 }
 
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+#seconds a cached note detail payload lives, writes invalidate it earlier
+NOTES_CACHE_TIMEOUT = int(os.environ.get("NOTES_CACHE_TIMEOUT", 300))
+
+#seconds between write-behind flushes of notes open in a websocket room
+NOTES_FLUSH_INTERVAL = float(os.environ.get("NOTES_FLUSH_INTERVAL", 2))
+#max websocket frames per second to each client, updates in between are coalesced
+NOTES_WS_SEND_RATE = float(os.environ.get("NOTES_WS_SEND_RATE", 25))
+#queued frames per client before updates are dropped for a snapshot (high) and
+#the level the queue must drain to before another overflow closes the socket (low)
+NOTES_WS_HIGH_WATER = int(os.environ.get("NOTES_WS_HIGH_WATER", 256))
+NOTES_WS_LOW_WATER = int(os.environ.get("NOTES_WS_LOW_WATER", 32))
+#frames sent ahead of the "seen" count a client reports, the rest is held and coalesced
+NOTES_WS_WINDOW = int(os.environ.get("NOTES_WS_WINDOW", 64))
+#bearer token required on /metrics, left open when unset
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+#seconds a room member stays listed without a heartbeat
+PRESENCE_TTL = int(os.environ.get("PRESENCE_TTL", 60))
+#seconds before the room lease of a worker that stopped renewing it runs out,
+#its clients reconnect to another worker after that
+NOTES_OWNER_TTL = float(os.environ.get("NOTES_OWNER_TTL", 15))
+#live notes write a new content snapshot every this many operations
+NOTES_SNAPSHOT_EVERY = int(os.environ.get("NOTES_SNAPSHOT_EVERY", 200))
+#operations kept per note as history once folded into a snapshot
+NOTES_HISTORY_KEEP = int(os.environ.get("NOTES_HISTORY_KEEP", 1000))
+#operations accepted by one /notes/bulk/ request
+NOTES_BULK_MAX = int(os.environ.get("NOTES_BULK_MAX", 500))
+#notes per query or insert in exports and imports, and notes accepted per import
+NOTES_TRANSFER_BATCH = int(os.environ.get("NOTES_TRANSFER_BATCH", 1000))
+NOTES_IMPORT_MAX = int(os.environ.get("NOTES_IMPORT_MAX", 100000))
+
 if ENVIRONMENT == "local":
     CSRF_TRUSTED_ORIGINS = [
         "http://localhost:5173",
@@ -280,3 +395,18 @@ SENDGRID_API_KEY=os.environ.get("SENDGRID_API_KEY")
 # CSRF_COOKIE_SAMESITE = 'None'
 # CSRF_COOKIE_SECURE = False
 EMAIL_TIMEOUT = 10
+
+#emails are queued in users.OutgoingEmail and sent by `manage.py send_emails`.
+#without a sendgrid key they go through EMAIL_BACKEND (smtp, or the file backend locally)
+EMAIL_OUTBOX_TRANSPORT = os.environ.get(
+    "EMAIL_OUTBOX_TRANSPORT",
+    "users.mail.SendGridTransport" if SENDGRID_API_KEY else "users.mail.DjangoMailTransport",
+)
+EMAIL_OUTBOX_BATCH = 20
+EMAIL_OUTBOX_POLL = 2
+EMAIL_OUTBOX_MAX_ATTEMPTS = 8
+#seconds, doubled after every failed attempt
+EMAIL_OUTBOX_RETRY_BASE = 30
+if os.environ.get("EMAIL_FILE_PATH"):
+    EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
+    EMAIL_FILE_PATH = os.environ.get("EMAIL_FILE_PATH")
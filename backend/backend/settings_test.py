@@ -0,0 +1,28 @@
+from backend.settings import *
+
+#settings for the test suite, without postgres or redis:
+#    python manage.py test --settings=backend.settings_test
+#two local sqlite databases, the second one is a read replica so the replica
+#routing and the read-your-writes pin run for real (see backend/tests.py)
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "test-default.sqlite3",
+    },
+    "replica_0": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": BASE_DIR / "test-replica.sqlite3",
+    },
+}
+DATABASE_REPLICAS = ["replica_0"]
+DATABASE_ROUTERS = ["backend.routers.ReplicaRouter"]
+if "backend.middleware.ReplicaReadMiddleware" not in MIDDLEWARE:
+    MIDDLEWARE.insert(0, "backend.middleware.ReplicaReadMiddleware")
+
+REDIS_SHARD_URLS = []
+CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+EMAIL_BACKEND = "django.core.mail.backends.locmem.EmailBackend"
+EMAIL_OUTBOX_TRANSPORT = "users.mail.DjangoMailTransport"
+PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
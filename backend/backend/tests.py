@@ -0,0 +1,82 @@
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import TestCase,override_settings
+from backend.routers import ReplicaRouter,replica_reads
+from notes.models import Note
+from users.tests import login
+
+#needs the replica_0 database of backend.settings_test
+
+
+class ReplicaRoutingTest(TestCase):
+    databases={'default','replica_0'}
+
+    @classmethod
+    def setUpClass(cls):
+        #replicas are never migrated, the test replica gets the tables by hand
+        #(before the class transaction, sqlite can not change schema inside one)
+        with connections['replica_0'].schema_editor() as editor:
+            editor.create_model(User)
+            editor.create_model(Note)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        with connections['replica_0'].schema_editor() as editor:
+            editor.delete_model(Note)
+            editor.delete_model(User)
+
+    def setUp(self):
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        self.note=Note.objects.create(owner=self.user,title='primary',content='a')
+        #the replica lags: it has the user but an older copy of the note
+        User.objects.using('replica_0').create(id=self.user.id,username='owner')
+        Note.objects.using('replica_0').create(id=self.note.id,owner_id=self.user.id,title='replica',content='a')
+        login(self.client,self.user)
+
+    def titles(self):
+        response=self.client.get('/notes/')
+        self.assertEqual(response.status_code,200)
+        return [note['title'] for note in response.json()]
+
+    def test_router_uses_primary_outside_safe_requests(self):
+        router=ReplicaRouter()
+        self.assertEqual(router.db_for_read(Note),'default')
+        token=replica_reads.set(True)
+        try:
+            self.assertEqual(router.db_for_read(Note),'replica_0')
+            self.assertEqual(router.db_for_write(Note),'default')
+        finally:
+            replica_reads.reset(token)
+        self.assertFalse(router.allow_migrate('replica_0','notes'))
+
+    def test_safe_reads_go_to_replica(self):
+        self.assertEqual(self.titles(),['replica'])
+        self.assertNotIn('db_primary',self.client.cookies)
+
+    def test_write_pins_reads_to_primary(self):
+        response=self.client.post('/notes/',{'title':'new','content':'b'},content_type='application/json')
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.cookies['db_primary']['max-age'],5)
+        self.assertCountEqual(self.titles(),['primary','new'])
+
+    @override_settings(REPLICA_PIN_SECONDS=0)
+    def test_pin_expires(self):
+        self.client.post('/notes/',{'title':'new','content':'b'},content_type='application/json')
+        #the browser drops the cookie after max-age, the test client has to be told
+        del self.client.cookies['db_primary']
+        self.assertEqual(self.titles(),['replica'])
+
+    def test_writes_read_the_primary(self):
+        response=self.client.put(
+            f'/notes/{self.note.id}/',
+            {'title':'renamed','content':'a','category':'work'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(Note.objects.get(id=self.note.id).title,'renamed')
+
+    def test_detail_cache_fills_from_primary(self):
+        response=self.client.get(f'/notes/{self.note.id}/')
+        self.assertEqual(response.json()['title'],'primary')
@@ -16,9 +16,11 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path,include
+from notes.views import metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('users/',include('users.urls')),
     path('notes/',include('notes.urls.note_url')),
+    path('metrics',metrics_view.metrics,name='metrics'),
 ]
@@ -0,0 +1,61 @@
+import json
+from functools import wraps
+from django.http import HttpResponse,JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException
+from rest_framework.status import *
+from rest_framework.utils.encoders import JSONEncoder
+from users.authentication import CookieJWTAuthentication
+
+#what @api_view and IsAuthenticated do for the sync views, for async django views.
+#DRF runs its views synchronously, under daphne every request would hop to the
+#sync thread. responses and errors keep DRF's json shapes
+
+
+def Response(data=None,status=HTTP_200_OK,headers=None):
+    if data is None:
+        response=HttpResponse(status=status)
+    else:
+        response=JsonResponse(data,status=status,encoder=JSONEncoder,safe=False)
+    for name,value in (headers or {}).items():
+        response[name]=value
+    return response
+
+
+def _error(exc):
+    detail=exc.detail
+    data=detail if isinstance(detail,(dict,list)) else {'detail':detail}
+    return Response(data,status=exc.status_code)
+
+
+def async_api_view(methods,parse_body=True):
+    #parse_body=False leaves the body unread for views that stream it
+    authentication=CookieJWTAuthentication()
+
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        async def wrapper(request,*args,**kwargs):
+            if request.method not in methods:
+                return Response({'detail':f'Method "{request.method}" not allowed.'},status=HTTP_405_METHOD_NOT_ALLOWED)
+            try:
+                result=await authentication.aauthenticate(request)
+            except APIException as e:
+                return _error(e)
+            if result is None:
+                return Response(
+                    {'detail':'Authentication credentials were not provided.'},
+                    status=HTTP_401_UNAUTHORIZED,
+                    headers={'WWW-Authenticate':authentication.authenticate_header(request)},
+                )
+            request.user,request.auth=result
+            request.query_params=request.GET
+            request.data={}
+            if parse_body and request.body:
+                try:
+                    request.data=json.loads(request.body)
+                except ValueError as e:
+                    return Response({'detail':f'JSON parse error - {e}'},status=HTTP_400_BAD_REQUEST)
+            return await view(request,*args,**kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,134 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from notes.models import Note,NoteOperation
+from notes.serializers import NoteBulkSerializer
+from notes.conditional import current_version
+from notes.documents import is_live
+from notes.oplog import content_operation,replay_notes
+from notes.persistence import write_behind
+from notes.cache import invalidate_notes
+
+#batch create/update/move/delete for one owner. ownership is checked with one
+#query, the writes are one bulk_create, one bulk_update per set of changed fields
+#and one filtered delete in a transaction. invalid items are reported and skipped,
+#the rest is applied
+
+OPS=('create','update','move','delete')
+
+
+def max_operations():
+    return getattr(settings,'NOTES_BULK_MAX',500)
+
+
+def _error(index,op,message,errors=None):
+    result={'index':index,'op':op,'status':'error','message':message}
+    if errors:
+        result['errors']=errors
+    return result
+
+
+def _validate(index,item,seen):
+    #returns (op,id,fields) or an error result
+    if not isinstance(item,dict) or item.get('op') not in OPS:
+        return _error(index,None,f"op must be one of {', '.join(OPS)}")
+    op=item['op']
+    if op=='create':
+        serializer=NoteBulkSerializer(data=item)
+        if not serializer.is_valid():
+            return _error(index,op,"Invalid note",serializer.errors)
+        return op,None,serializer.validated_data
+    id=item.get('id')
+    if not isinstance(id,int) or isinstance(id,bool):
+        return _error(index,op,"id required")
+    if id in seen:
+        return _error(index,op,"Note already changed in this request")
+    seen.add(id)
+    if op=='delete':
+        return op,id,{}
+    if op=='move':
+        if 'category' not in item:
+            return _error(index,op,"category required")
+        item={'category':item['category']}
+    serializer=NoteBulkSerializer(data=item,partial=True)
+    if not serializer.is_valid():
+        return _error(index,op,"Invalid note",serializer.errors)
+    return op,id,serializer.validated_data
+
+
+def apply_operations(user,items,live_ids=frozenset()):
+    #live_ids are notes with a room open in another worker, see documents.alive_notes
+    results=[None]*len(items)
+    valid=[]
+    seen=set()
+    for index,item in enumerate(items):
+        checked=_validate(index,item,seen)
+        if isinstance(checked,dict):
+            results[index]=checked
+        else:
+            valid.append((index,)+checked)
+
+    ids=[id for _,_,id,_ in valid if id is not None]
+    owned={}
+    if ids:
+        notes=replay_notes(list(Note.objects.filter(owner=user,id__in=ids).defer('search_vector')))
+        owned={note.id:note for note in notes}
+
+    created=[]
+    groups={}
+    operations=[]
+    live={}
+    deleted=[]
+    today=timezone.localdate()
+    for index,op,id,fields in valid:
+        if op=='create':
+            created.append((index,Note(owner=user,**fields)))
+            continue
+        note=owned.get(id)
+        if note is None:
+            results[index]=_error(index,op,"Not found")
+            continue
+        if op=='delete':
+            deleted.append(note)
+            results[index]={'index':index,'op':op,'status':'deleted','id':id}
+            continue
+        changed={'version','updated_at'}
+        for name in ('title','category'):
+            if name in fields:
+                setattr(note,name,fields[name])
+                changed.add(name)
+        note.version=current_version(note.id,note.version)+1
+        note.updated_at=today
+        if is_live(note.id):
+            #an open room owns the content, like a single PUT only the rest is written
+            live[note.id]={name:getattr(note,name) for name in changed if name!='updated_at'}
+        elif 'content' in fields and note.id not in live_ids:
+            #a room open in another worker keeps the content too, the bulk_update
+            #below writes the rest straight away
+            operation=content_operation(note,fields['content'])
+            if operation is not None:
+                operations.append(operation)
+                changed|={'content','rev','snapshot_rev'}
+        groups.setdefault(tuple(sorted(changed)),[]).append(note)
+        results[index]={'index':index,'op':op,'status':'updated','id':id,'version':note.version}
+
+    with transaction.atomic():
+        if created:
+            Note.objects.bulk_create([note for _,note in created])
+        if operations:
+            NoteOperation.objects.bulk_create(operations)
+        for fields,notes in groups.items():
+            Note.objects.bulk_update(notes,list(fields))
+        if deleted:
+            Note.objects.filter(owner=user,id__in=[note.id for note in deleted]).delete()
+
+    for note_id,fields in live.items():
+        #keep this process's queued flush from writing the older values back
+        write_behind.mark(note_id,**fields)
+    for index,note in created:
+        results[index]={'index':index,'op':'create','status':'created','id':note.id}
+    invalidate_notes(
+        [note.id for notes in groups.values() for note in notes]+[note.id for note in deleted],
+        [note.share_token for note in deleted if note.share_token is not None],
+    )
+    return results
@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.core.cache import cache
+from notes.models import Note
+from notes.serializers import NoteDetailSerializer
+
+#detail payloads of notes, serialized once and shared by every reader.
+#writers call ainvalidate_note after changing a note
+
+
+def _timeout():
+    return getattr(settings,'NOTES_CACHE_TIMEOUT',300)
+
+
+def detail_key(note_id):
+    return f'notes:detail:{note_id}'
+
+
+def share_key(token):
+    return f'notes:share:{token}'
+
+
+#cache fills read the primary, a lagging replica would cache a stale note
+#for the whole timeout right after ainvalidate_note
+
+
+async def aget_note_detail(note_id):
+    #returns None when the note does not exist
+    data=await cache.aget(detail_key(note_id))
+    if data is None:
+        note=await Note.objects.using('default').select_related('owner').filter(id=note_id).afirst()
+        if note is None:
+            return None
+        #Note.content is the snapshot, the operations after it are replayed
+        from notes.oplog import areplay_note
+        await areplay_note(note)
+        data=dict(NoteDetailSerializer(note,many=False).data)
+        await cache.aset(detail_key(note_id),data,_timeout())
+    return data
+
+
+async def aget_shared_note_id(token):
+    #returns None when no note is shared with that token
+    note_id=await cache.aget(share_key(token))
+    if note_id is None:
+        note_id=await Note.objects.using('default').filter(share_token=token,is_shared=True).values_list('id',flat=True).afirst()
+        if note_id is None:
+            return None
+        await cache.aset(share_key(token),note_id,_timeout())
+    return note_id
+
+
+async def ainvalidate_note(note_id,share_token=None):
+    keys=[detail_key(note_id)]
+    if share_token is not None:
+        keys.append(share_key(share_token))
+    await cache.adelete_many(keys)
+
+
+def invalidate_notes(note_ids,share_tokens=()):
+    keys=[detail_key(note_id) for note_id in note_ids]
+    keys+=[share_key(token) for token in share_tokens]
+    cache.delete_many(keys)
@@ -0,0 +1,37 @@
+from django.utils.http import parse_etags
+from notes.documents import live_rev
+from notes.persistence import write_behind
+
+#strong etags for note payloads, built from Note.version (title, category, sharing)
+#and the content revision, which comes from the live document while a room is open
+
+
+def current_version(note_id,version):
+    #changes queued in the write-behind are already the current state
+    return write_behind.pending(note_id).get('version',version)
+
+
+def note_etag(note_id,version,rev):
+    return f'"{note_id}.{current_version(note_id,version)}.{live_rev(note_id,rev)}"'
+
+
+def _strip_weak(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def not_modified(request,etag):
+    #If-None-Match uses the weak comparison
+    header=request.headers.get('If-None-Match')
+    if not header:
+        return False
+    etags=parse_etags(header)
+    return '*' in etags or _strip_weak(etag) in [_strip_weak(tag) for tag in etags]
+
+
+def precondition_failed(request,etag):
+    #If-Match uses the strong comparison, weak tags never match
+    header=request.headers.get('If-Match')
+    if not header:
+        return False
+    etags=parse_etags(header)
+    return '*' not in etags and etag not in etags
@@ -1,101 +1,345 @@
+from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncWebsocketConsumer
-import json
+from django.conf import settings
+import asyncio
+import time
+from rest_framework.exceptions import AuthenticationFailed
+from notes.delta import DeltaError,validate_ops
+from notes.models import Note
+from notes.documents import RoomMoved,StaleRevision,acquire_document,release_document
+from notes.presence import get_presence
+from notes.outbox import Outbox,stats
+from notes.wire import BINARY_PROTOCOL,FrameEncoder,FrameTooLarge,decode
+from notes import metrics
+from users.authentication import CookieJWTAuthentication
+
+#close code for connections without a valid access_token cookie or no access to the note
+FORBIDDEN=4403
+#close code when the room is served by another worker now, the client reconnects
+MOVED=4012
 
 class NoteConsumer(AsyncWebsocketConsumer):
-    current_user={}
+    async def dispatch(self, message):
+        #channels closes old db connections before every message, a hop to the sync
+        #thread that http views also wait on. nothing here uses the database outside
+        #database_sync_to_async, which does that cleanup itself
+        handler=getattr(self,get_handler_name(message),None)
+        if handler is None:
+            raise ValueError("No handler for message type %s" % message["type"])
+        await handler(message)
+
     async def connect(self):
         self.note_id = self.scope['url_route']['kwargs']['note_id']
         self.room_group_name = f'note_{self.note_id}'
+        #clients switch to the delta protocol by sending an "op" or "sync" message,
+        #until then they get full content like before
+        self.delta=False
+        self.member=None
+        self.heartbeat=None
+        #everything sent to the client goes through the outbox so bursts get coalesced
+        #clients opt into binary msgpack frames through the websocket subprotocol
+        self.binary=BINARY_PROTOCOL in self.scope.get('subprotocols',[])
+        self.outbox=Outbox(
+            self.send,
+            getattr(settings,'NOTES_WS_SEND_RATE',25),
+            resync=self.snapshot_frame,
+            on_overflow=self.close_slow,
+            high_water=getattr(settings,'NOTES_WS_HIGH_WATER',256),
+            low_water=getattr(settings,'NOTES_WS_LOW_WATER',32),
+            window=getattr(settings,'NOTES_WS_WINDOW',64),
+        )
+        self.document=None
+        if not await self.authorized():
+            #accepted first so the client gets the close code instead of a failed handshake
+            await self.accept(BINARY_PROTOCOL if self.binary else None)
+            await self.close(code=FORBIDDEN)
+            return
+        try:
+            self.document=await acquire_document(self.note_id,self.channel_name,self.scope['room_host'])
+        except RoomMoved:
+            await self.accept(BINARY_PROTOCOL if self.binary else None)
+            await self.close(code=MOVED)
+            return
+        if self.document is None:
+            await self.close()
+            return
+        self.outbox.encode=FrameEncoder(self.binary,self.document.frames)
+        #last revision this connection was sent, to notice events the channel layer dropped
+        self.last_rev=self.document.rev
 
         await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
- 
-        await self.accept()
 
-    async def receive(self, text_data):
-        
-        data = json.loads(text_data)
+        await self.accept(BINARY_PROTOCOL if self.binary else None)
+        metrics.connections.inc()
+
+    async def authorized(self):
+        #same cookie and rules as the api: the owner, or anyone signed in for shared notes
+        try:
+            result=await CookieJWTAuthentication().aauthenticate_token(self.scope.get('cookies',{}).get('access_token'))
+        except AuthenticationFailed:
+            return False
+        if result is None:
+            return False
+        self.user=result[0]
+        note=await Note.objects.filter(id=self.note_id).values('owner_id','is_shared').afirst()
+        return note is not None and (note['owner_id']==self.user.id or note['is_shared'])
+
+    @metrics.timed('receive')
+    async def receive(self, text_data=None, bytes_data=None):
+        if self.document is None:
+            #refused connection, frames sent before the close arrived
+            return
+
+        try:
+            data = decode(text_data,bytes_data)
+        except FrameTooLarge:
+            #1009, message too big
+            await self.close(code=1009)
+            return
+        metrics.bytes_in.observe(len(text_data if text_data is not None else bytes_data))
+        metrics.messages_in.inc(data.get('type') or 'content')
         content = data.get('content')
-        
-        sender_id=data.get('senderId')
-        # print(sender_id)
+
+        #who sent it comes from the authenticated connection, never from the frame
+        sender_id=self.user.id
         if data.get("type")=='join':
-            username=data.get('username')
-            if sender_id not in self.current_user:
-                self.current_user[str(sender_id)]=username
-            # self.current_user.append(username)
-            # print("joined")
-            # current_username=list(self.current_user.values())
-
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_joined',
-                    'username': username,
-                    'senderId':sender_id,
-                    'current_user':self.current_user
-                }
-            )
+            username=self.user.first_name
+            if self.member is not None:
+                return
+            self.member=(sender_id,username)
+            presence=get_presence()
+            first=await presence.join(self.room_group_name,self.channel_name,sender_id,username)
+            users,gone=await presence.roster(self.room_group_name)
+            #the joiner gets the roster once, everyone else only the change
+            self.outbox.push({
+                'type':'presence',
+                'users':users,
+            })
+            for gone_id,gone_name in gone:
+                await self.broadcast(
+                    {
+                        'type': 'user_left',
+                        'username': gone_name,
+                        'senderId':gone_id,
+                    }
+                )
+            if first:
+                await self.broadcast(
+                    {
+                        'type': 'user_joined',
+                        'username': username,
+                        'senderId':sender_id,
+                    }
+                )
+            self.heartbeat=asyncio.ensure_future(self.send_heartbeats())
+            return
+
+        if data.get("type")=="seen":
+            self.outbox.ack(data.get('frames'))
             return
 
         if data.get("type")=="left":
-            # print("left")
-            sender_id=data.get("senderId")
-            username=data.get("username")
-            if str(sender_id) in self.current_user:
-                # print("removed")
-                self.current_user.pop(str(sender_id))
-                # print(self.current_user)
-            # self.current_user.remove(username)
-            # current_username=list(self.current_user.values())
-            
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            await self.leave_room()
+            return
+
+        if data.get("type")=="sync":
+            self.delta=True
+            #a reconnecting client sends the last revision it saw and only gets what it missed
+            if 'rev' in data:
+                await self.resume(data.get('rev'))
+            else:
+                await self.send_snapshot()
+            return
+
+        if data.get("type")=="op":
+            self.delta=True
+            base_rev=data.get('rev')
+            try:
+                ops=validate_ops(data.get('ops'))
+                async with self.document.lock:
+                    rev,ops=self.document.apply(base_rev,ops)
+            except StaleRevision:
+                await self.send_snapshot()
+                return
+            except DeltaError as e:
+                self.outbox.push({
+                    'type':'error',
+                    'message':str(e),
+                })
+                await self.send_snapshot()
+                return
+
+            await self.broadcast(
                 {
-                    'type': 'user_left',
-                    'username': username,
+                    'type': 'note_delta',
+                    'rev':rev,
+                    'ops':ops,
                     'senderId':sender_id,
-                    'current_user':self.current_user
+                    'origin':self.channel_name
                 }
             )
             return
-        
-        await self.channel_layer.group_send(
-            self.room_group_name,
+
+        #legacy full content message, diffed against the live document
+        if not isinstance(content,str):
+            return
+        async with self.document.lock:
+            if content==self.document.content:
+                return
+            rev,ops=self.document.replace(content)
+        await self.broadcast(
             {
-                'type': 'note_update',
-                'content': content,
-                'senderId':sender_id
+                'type': 'note_delta',
+                'rev':rev,
+                'ops':ops,
+                'senderId':sender_id,
+                'origin':self.channel_name
             }
         )
 
-    async def note_update(self, event):
-        await self.send(text_data=json.dumps({
-            'content': event['content'],
-            'senderId':event['senderId'],
-        }))
+    async def broadcast(self,event):
+        start=time.perf_counter()
+        await self.channel_layer.group_send(self.room_group_name,event)
+        metrics.group_send_seconds.observe(time.perf_counter()-start)
+
+    def snapshot_frame(self):
+        snapshot=self.document.snapshot()
+        self.last_rev=max(self.last_rev,snapshot['rev'])
+        return {
+            'type':'snapshot',
+            'rev':snapshot['rev'],
+            'content':snapshot['content'],
+        }
 
+    async def send_snapshot(self):
+        self.outbox.push(self.snapshot_frame(),'snapshot')
+
+    async def resume(self,rev):
+        ops=self.document.since(rev)
+        if ops is None:
+            await self.send_snapshot()
+            return
+        self.last_rev=self.document.rev
+        self.outbox.push({
+            'type':'op',
+            'rev':self.document.rev,
+            'baseRev':rev,
+            'ops':ops,
+            'senderId':None,
+        },'op')
+
+    async def close_slow(self):
+        #client could not keep up even after a forced resync
+        await self.close(code=4008)
+
+    @metrics.timed('note_delta')
+    async def note_delta(self, event):
+        if event['rev']<=self.last_rev and event['origin']!=self.channel_name:
+            #already covered by a snapshot this connection was sent
+            return
+        #the channel layer drops events for a connection whose channel is full,
+        #delta clients then get a snapshot instead of a broken op stream
+        gap=event['rev']>self.last_rev+1
+        if gap:
+            stats['gaps']+=1
+        self.last_rev=max(self.last_rev,event['rev'])
+        if event['origin']==self.channel_name:
+            if self.delta:
+                self.outbox.push({
+                    'type':'ack',
+                    'rev':event['rev'],
+                })
+                if gap:
+                    await self.send_snapshot()
+            return
+        if gap and self.delta:
+            await self.send_snapshot()
+            return
+        if self.delta:
+            self.outbox.push({
+                'type':'op',
+                'rev':event['rev'],
+                'baseRev':event['rev']-1,
+                'ops':event['ops'],
+                'senderId':event['senderId'],
+            },'op')
+            return
+        #clients still on the full content protocol get the document as it is when the frame goes out
+        sender_id=event['senderId']
+        self.outbox.push(lambda:{
+            'content': self.document.content,
+            'rev':self.document.rev,
+            'senderId':sender_id,
+        },'content')
+
+    async def note_reload(self, event):
+        #the document went back to the stored state, revisions may be lower than before
+        self.last_rev=0
+        if self.delta:
+            await self.send_snapshot()
+            return
+        self.outbox.push(lambda:{
+            'content': self.document.content,
+            'rev':self.document.rev,
+            'senderId':None,
+        },'content')
+
+    async def note_moved(self, event):
+        await self.close(code=MOVED)
+
+    @metrics.timed('user_joined')
     async def user_joined(self, event):
-        await self.send(text_data=json.dumps({
+        self.outbox.push({
             'type':"join",
             'username': event['username'],
             'senderId':event['senderId'],
-            'current_user':event['current_user']
-        }))
+        })
+
+    @metrics.timed('user_left')
+    async def user_left(self, event):
+        self.outbox.push({
+            'type':"left",
+            'username': event['username'],
+            'senderId':event['senderId'],
+        })
+
+    async def send_heartbeats(self):
+        interval=getattr(settings,'PRESENCE_TTL',60)/3
+        while True:
+            await asyncio.sleep(interval)
+            sender_id,username=self.member
+            try:
+                await get_presence().touch(self.room_group_name,self.channel_name,sender_id,username)
+            except Exception as e:
+                print("presence heartbeat error:",e)
+
+    async def leave_room(self):
+        if self.member is None:
+            return
+        sender_id,username=self.member
+        self.member=None
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        if await get_presence().leave(self.room_group_name,self.channel_name,sender_id):
+            await self.broadcast(
+                {
+                    'type': 'user_left',
+                    'username': username,
+                    'senderId':sender_id,
+                }
+            )
 
     async def disconnect(self, close_code):
+        if getattr(self,'document',None) is None:
+            return
+        metrics.connections.dec()
+        self.outbox.close()
+        await self.leave_room()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
-        
-    
-    async def user_left(self, event):
-        await self.send(text_data=json.dumps({
-            'type':"left",
-            'username': event['username'],
-            'senderId':event['senderId'],
-            'current_user':event['current_user']
-        }))
+        await release_document(self.note_id,self.channel_name)
@@ -0,0 +1,123 @@
+#delta operations exchanged over the note websocket
+#an op is either {"pos":int,"insert":str} or {"pos":int,"delete":int}
+#a message carries a list of ops applied one after the other against a base revision
+
+MAX_OPS_PER_MESSAGE=200
+MAX_INSERT_LENGTH=64*1024
+
+
+class DeltaError(ValueError):
+    pass
+
+
+def validate_ops(ops):
+    if not isinstance(ops,list) or not ops:
+        raise DeltaError("ops must be a non empty list")
+    if len(ops)>MAX_OPS_PER_MESSAGE:
+        raise DeltaError("too many ops in one message")
+    cleaned=[]
+    for op in ops:
+        if not isinstance(op,dict):
+            raise DeltaError("op must be an object")
+        pos=op.get('pos')
+        if not isinstance(pos,int) or isinstance(pos,bool) or pos<0:
+            raise DeltaError("op pos must be a non negative integer")
+        if 'insert' in op:
+            text=op['insert']
+            if not isinstance(text,str) or len(text)>MAX_INSERT_LENGTH:
+                raise DeltaError("invalid insert text")
+            if text:
+                cleaned.append({'pos':pos,'insert':text})
+        elif 'delete' in op:
+            length=op['delete']
+            if not isinstance(length,int) or isinstance(length,bool) or length<0:
+                raise DeltaError("invalid delete length")
+            if length:
+                cleaned.append({'pos':pos,'delete':length})
+        else:
+            raise DeltaError("op must be insert or delete")
+    return cleaned
+
+
+def apply_ops(content,ops):
+    for op in ops:
+        pos=op['pos']
+        if 'insert' in op:
+            if pos>len(content):
+                raise DeltaError("insert out of range")
+            content=content[:pos]+op['insert']+content[pos:]
+        else:
+            if pos+op['delete']>len(content):
+                raise DeltaError("delete out of range")
+            content=content[:pos]+content[pos+op['delete']:]
+    return content
+
+
+def diff_ops(old,new):
+    #single delete+insert covering the changed middle part, used to turn
+    #full content messages into ops
+    start=0
+    limit=min(len(old),len(new))
+    while start<limit and old[start]==new[start]:
+        start+=1
+    end=0
+    while end<limit-start and old[len(old)-1-end]==new[len(new)-1-end]:
+        end+=1
+    ops=[]
+    if len(old)-end>start:
+        ops.append({'pos':start,'delete':len(old)-end-start})
+    if len(new)-end>start:
+        ops.append({'pos':start,'insert':new[start:len(new)-end]})
+    return ops
+
+
+#operational transform, a_first breaks ties between two inserts at the same position
+def _transform_op(a,b,a_first):
+    pos=a['pos']
+    if 'insert' in a:
+        if 'insert' in b:
+            if pos<b['pos'] or (pos==b['pos'] and a_first):
+                return [a]
+            return [{'pos':pos+len(b['insert']),'insert':a['insert']}]
+        if pos<=b['pos']:
+            return [a]
+        if pos>=b['pos']+b['delete']:
+            return [{'pos':pos-b['delete'],'insert':a['insert']}]
+        return [{'pos':b['pos'],'insert':a['insert']}]
+    end=pos+a['delete']
+    if 'insert' in b:
+        if b['pos']>=end:
+            return [a]
+        if b['pos']<=pos:
+            return [{'pos':pos+len(b['insert']),'delete':a['delete']}]
+        #text inserted inside the deleted range survives, delete around it
+        before=b['pos']-pos
+        return [
+            {'pos':pos,'delete':before},
+            {'pos':pos+len(b['insert']),'delete':a['delete']-before},
+        ]
+    b_end=b['pos']+b['delete']
+    shift=max(0,min(pos,b_end)-b['pos'])
+    overlap=max(0,min(end,b_end)-max(pos,b['pos']))
+    length=a['delete']-overlap
+    if not length:
+        return []
+    return [{'pos':pos-shift,'delete':length}]
+
+
+def transform(ops_a,ops_b,a_first):
+    #returns (a',b') so that applying b then a' gives the same text as a then b'
+    if not ops_a or not ops_b:
+        return ops_a,ops_b
+    if len(ops_a)==1 and len(ops_b)==1:
+        return (
+            _transform_op(ops_a[0],ops_b[0],a_first),
+            _transform_op(ops_b[0],ops_a[0],not a_first),
+        )
+    if len(ops_a)>1:
+        head,ops_b=transform(ops_a[:1],ops_b,a_first)
+        tail,ops_b=transform(ops_a[1:],ops_b,a_first)
+        return head+tail,ops_b
+    ops_a,head=transform(ops_a,ops_b[:1],a_first)
+    ops_a,tail=transform(ops_a,ops_b[1:],a_first)
+    return ops_a,head+tail
@@ -0,0 +1,217 @@
+import asyncio
+from collections import deque
+from django.conf import settings
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from notes.delta import apply_ops,diff_ops,transform
+from notes.oplog import load_note,recent_operations
+from notes.ownership import get_ownership,lease_ttl
+from notes.persistence import write_behind
+from notes.wire import FrameCache
+
+#authoritative live state of the notes that have an open websocket room in this process.
+#while a note is live its document is the only writer of Note.content,
+#through the write-behind in notes.persistence.
+#a room is served by one worker at a time, the one holding its lease (notes.ownership),
+#sockets of the room reaching other workers are tunnelled to it (notes.rooms)
+
+HISTORY_SIZE=500
+
+
+class StaleRevision(Exception):
+    pass
+
+
+class RoomMoved(Exception):
+    #another worker opened the room first
+    pass
+
+
+class LiveDocument:
+    def __init__(self,note_id,content,rev=0,snapshot_rev=0):
+        self.note_id=note_id
+        self.content=content
+        self.rev=rev
+        self.snapshot_rev=snapshot_rev
+        #worker holding the lease and the connections of the room
+        self.node=None
+        self.channels=set()
+        self.history=deque(maxlen=HISTORY_SIZE)
+        #encoded frames shared by every connection of the room
+        self.frames=FrameCache()
+        self.lock=asyncio.Lock()
+
+    def apply(self,base_rev,ops):
+        #ops were made against base_rev, rebase them over everything sequenced since.
+        #ops already in the history win ties so every client resolves them the same way
+        if not isinstance(base_rev,int) or base_rev>self.rev:
+            raise StaleRevision()
+        missed=self.rev-base_rev
+        if missed>len(self.history):
+            raise StaleRevision()
+        for entry in list(self.history)[len(self.history)-missed:]:
+            ops,_=transform(ops,entry,False)
+        self.content=apply_ops(self.content,ops)
+        self.rev+=1
+        self.history.append(ops)
+        write_behind.append(self.note_id,self.rev,ops)
+        if self.rev-self.snapshot_rev>=getattr(settings,'NOTES_SNAPSHOT_EVERY',200):
+            self.take_snapshot()
+        return self.rev,ops
+
+    def replace(self,content):
+        #full content messages become a diff so they stay transformable
+        return self.apply(self.rev,diff_ops(self.content,content))
+
+    def take_snapshot(self):
+        if self.snapshot_rev==self.rev:
+            return
+        write_behind.mark(self.note_id,content=self.content,snapshot_rev=self.rev)
+        self.snapshot_rev=self.rev
+
+    def since(self,rev):
+        #ops sequenced after rev in order, None once they left the history
+        if not isinstance(rev,int) or rev<0 or rev>self.rev:
+            return None
+        missed=self.rev-rev
+        if missed>len(self.history):
+            return None
+        return [op for entry in list(self.history)[len(self.history)-missed:] for op in entry]
+
+    def snapshot(self):
+        return {'rev':self.rev,'content':self.content}
+
+
+documents={}
+_loading_lock=asyncio.Lock()
+
+
+def is_live(note_id):
+    return note_id in documents
+
+
+def live_content(note_id,default):
+    document=documents.get(note_id)
+    return default if document is None else document.content
+
+
+def live_rev(note_id,default):
+    document=documents.get(note_id)
+    return default if document is None else document.rev
+
+
+def room_name(note_id):
+    return f'note_{note_id}'
+
+
+async def alive_notes(note_ids):
+    #notes with an open room in this or another worker, their content belongs to the room
+    rest=[note_id for note_id in note_ids if note_id not in documents]
+    owned=await get_ownership().owned([room_name(note_id) for note_id in rest]) if rest else set()
+    return {note_id for note_id in note_ids if note_id in documents or room_name(note_id) in owned}
+
+
+async def acquire_document(note_id,channel,node):
+    async with _loading_lock:
+        document=documents.get(note_id)
+        if document is None:
+            #the connection was routed here before another worker took the room
+            if await get_ownership().claim(room_name(note_id),node)!=node:
+                raise RoomMoved()
+            state=await database_sync_to_async(load_note)(note_id)
+            if state is None:
+                await get_ownership().release(room_name(note_id),node)
+                return None
+            document=LiveDocument(note_id,*state)
+            document.node=node
+            #reopened rooms keep their history so reconnecting clients can still resume
+            document.history.extend(await database_sync_to_async(recent_operations)(
+                note_id,document.rev,HISTORY_SIZE
+            ))
+            documents[note_id]=document
+            write_behind.start()
+            _keep_leases(node)
+        document.channels.add(channel)
+        return document
+
+
+async def release_document(note_id,channel):
+    async with _loading_lock:
+        document=documents.get(note_id)
+        if document is None or channel not in document.channels:
+            return
+        document.channels.discard(channel)
+        if not document.channels:
+            documents.pop(note_id,None)
+            document.take_snapshot()
+            await write_behind.flush([note_id])
+            #after the flush so the next owner loads everything
+            await get_ownership().release(room_name(note_id),document.node)
+
+
+_renewals={}
+
+
+def _keep_leases(node):
+    task=_renewals.get(node)
+    if task is None or task.done():
+        _renewals[node]=asyncio.ensure_future(_renew_leases(node))
+
+
+async def _renew_leases(node):
+    ownership=get_ownership()
+    while True:
+        await asyncio.sleep(lease_ttl()/3)
+        owned=[document for document in list(documents.values()) if document.node==node]
+        if not owned:
+            return
+        for document in owned:
+            try:
+                kept=await ownership.renew(room_name(document.note_id),node)
+            except Exception as e:
+                print("room lease error:",e)
+                continue
+            if not kept:
+                await _drop_document(document)
+
+
+async def _drop_document(document):
+    #the lease ran out (a long stall) and another worker has the room now. queued
+    #writes still go out, the write-behind conflict check sorts out the overlap.
+    #the clients reconnect and land on the new owner
+    async with _loading_lock:
+        if documents.get(document.note_id) is not document:
+            return
+        documents.pop(document.note_id)
+    document.take_snapshot()
+    await write_behind.flush([document.note_id])
+    layer=get_channel_layer()
+    for channel in list(document.channels):
+        await layer.send(channel,{'type':'note_moved'})
+
+
+async def reload_documents(note_ids):
+    #the database has revisions this process did not sequence, its queued writes for
+    #the note were dropped. the room restarts from the stored state and every
+    #connection gets it as a snapshot
+    for note_id in note_ids:
+        document=documents.get(note_id)
+        if document is None:
+            continue
+        async with document.lock:
+            write_behind.take([note_id])
+            state=await database_sync_to_async(load_note)(note_id)
+            if state is None:
+                continue
+            document.content,document.rev,document.snapshot_rev=state
+            #revisions start over, frames cached under them belong to the old document.
+            #cleared in place, every connection's encoder holds this cache
+            document.frames.clear()
+            document.history.clear()
+            document.history.extend(await database_sync_to_async(recent_operations)(
+                note_id,document.rev,HISTORY_SIZE
+            ))
+        await get_channel_layer().group_send(f'note_{note_id}',{'type':'note_reload'})
+
+
+write_behind.on_conflict=reload_documents
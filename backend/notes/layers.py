@@ -0,0 +1,153 @@
+import asyncio
+import uuid
+from channels_redis.pubsub import RedisPubSubChannelLayer,RedisPubSubLoopLayer,RedisSingleShardConnection
+from channels_redis.utils import _wrap_close,decode_hosts
+from notes.sharding import HashRing,room_key
+
+#redis pub/sub channel layer with an in-process fast path for groups.
+#group_send hands the message object straight to the group members connected to
+#this process and publishes it once on the group's redis channel for other
+#processes. every publish carries the id of the process that sent it so the
+#copy coming back from redis is not delivered twice.
+#with several hosts a room's group and presence keys go to the same shard of a
+#consistent hash ring (notes.sharding).
+#while the shard list changes, previous_hosts is the old list: a channel or group that
+#moved to another shard is subscribed on both and published to both, the copy on the
+#old shard is marked so processes subscribed on both skip it.
+#the classes below override private parts of channels_redis.pubsub (_layers,
+#_shards, _receive_message, the channels/groups dicts), which is why requirements.txt
+#pins it exactly. check them against the new version before upgrading it
+
+#key set on the copy published to the old shard
+COPY='__shard_copy__'
+
+
+def _address(host):
+    return host.get('address',str(host))
+
+
+class LocalFanoutChannelLayer(RedisPubSubChannelLayer):
+    def deserialize(self,message):
+        #messages delivered in process are never serialized
+        if isinstance(message,dict):
+            return message
+        return super().deserialize(message)
+
+    def _get_layer(self):
+        loop=asyncio.get_running_loop()
+        try:
+            layer=self._layers[loop]
+        except KeyError:
+            layer=LocalFanoutLoopLayer(*self._args,**self._kwargs,channel_layer=self)
+            self._layers[loop]=layer
+            _wrap_close(self,loop)
+        return layer
+
+
+class LocalFanoutLoopLayer(RedisPubSubLoopLayer):
+    def __init__(self,*args,previous_hosts=None,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.node=uuid.uuid4().bytes
+        self._shards=[LocalFanoutShardConnection(shard.host,self) for shard in self._shards]
+        self.ring=HashRing([_address(shard.host) for shard in self._shards])
+        self.previous_ring=None
+        if previous_hosts:
+            #hosts in both lists share the connection
+            shards={_address(shard.host):shard for shard in self._shards}
+            self.previous_shards=[
+                shards.get(_address(host)) or LocalFanoutShardConnection(host,self)
+                for host in decode_hosts(previous_hosts)
+            ]
+            self.previous_ring=HashRing([_address(shard.host) for shard in self.previous_shards])
+
+    def _get_shard(self,channel_or_group_name):
+        return self._shards[self.ring.index(room_key(channel_or_group_name))]
+
+    def _get_previous_shard(self,channel_or_group_name):
+        #shard of the old list when the name moved away from it, otherwise None
+        if self.previous_ring is None:
+            return None
+        shard=self.previous_shards[self.previous_ring.index(room_key(channel_or_group_name))]
+        return None if shard is self._get_shard(channel_or_group_name) else shard
+
+    async def _subscribe_to_channel(self,channel):
+        await super()._subscribe_to_channel(channel)
+        previous=self._get_previous_shard(channel)
+        if previous is not None:
+            await previous.subscribe(channel)
+
+    async def receive(self,channel):
+        try:
+            return await super().receive(channel)
+        except (asyncio.CancelledError,asyncio.TimeoutError,GeneratorExit):
+            #the base class unsubscribed the current shard
+            previous=self._get_previous_shard(channel)
+            if previous is not None and channel not in self.channels:
+                try:
+                    await previous.unsubscribe(channel)
+                except Exception as e:
+                    print("channel layer unsubscribe error:",e)
+            raise
+
+    async def send(self,channel,message):
+        await super().send(channel,message)
+        previous=self._get_previous_shard(channel)
+        if previous is not None:
+            await previous.publish(channel,self.channel_layer.serialize({**message,COPY:True}))
+
+    async def group_add(self,group,channel):
+        await super().group_add(group,channel)
+        group_channel=self._get_group_channel_name(group)
+        previous=self._get_previous_shard(group_channel)
+        if previous is not None:
+            await previous.subscribe(group_channel)
+
+    async def group_discard(self,group,channel):
+        await super().group_discard(group,channel)
+        group_channel=self._get_group_channel_name(group)
+        previous=self._get_previous_shard(group_channel)
+        if previous is not None and group_channel not in self.groups:
+            await previous.unsubscribe(group_channel)
+
+    async def flush(self):
+        await super().flush()
+        if self.previous_ring is not None:
+            for shard in self.previous_shards:
+                if shard not in self._shards:
+                    await shard.flush()
+
+    async def group_send(self,group,message):
+        group_channel=self._get_group_channel_name(group)
+        for channel in self.groups.get(group_channel,()):
+            queue=self.channels.get(channel)
+            if queue is not None:
+                queue.put_nowait(dict(message))
+        shard=self._get_shard(group_channel)
+        await shard.publish(group_channel,self.node+self.channel_layer.serialize(message))
+        previous=self._get_previous_shard(group_channel)
+        if previous is not None:
+            await previous.publish(group_channel,self.node+self.channel_layer.serialize({**message,COPY:True}))
+
+
+class LocalFanoutShardConnection(RedisSingleShardConnection):
+    def _receive_message(self,message):
+        if message is None:
+            return
+        name=message['channel']
+        if isinstance(name,bytes):
+            name=name.decode()
+        if name in self.channel_layer.groups:
+            data=message['data']
+            node=self.channel_layer.node
+            if data[:len(node)]==node:
+                #already delivered in process by group_send
+                return
+            message={**message,'data':data[len(node):]}
+        if self.channel_layer._get_previous_shard(name) is self:
+            #also subscribed on the current shard, which has the original of any copy.
+            #processes still on the old list get copies like any other message
+            data=self.channel_layer.channel_layer.deserialize(message['data'])
+            if data.get(COPY):
+                return
+            message={**message,'data':data}
+        super()._receive_message(message)
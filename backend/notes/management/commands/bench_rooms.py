@@ -0,0 +1,199 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+import tracemalloc
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.sessions import CookieMiddleware
+from channels.testing import HttpCommunicator,WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from notes.models import Note
+from notes.routing import websocket_urlpatterns
+from users.views import MyTokenObtainPairSerializer
+
+#drives NoteConsumer in process with simulated editors on the delta protocol and
+#reports fan-out latency (op sent -> op received by the other room members),
+#throughput, memory per connection and, on redis, the commands redis processed.
+#with --http-clients readers also fetch notes over the api during the run to see
+#how http and websocket traffic share one worker.
+#creates its own user and notes and deletes them afterwards
+
+
+class Client:
+    def __init__(self,application,note_id,headers):
+        self.communicator=WebsocketCommunicator(application,f'/notes/{note_id}/',headers=headers)
+        self.rev=0
+        self.pending=[]
+        self.sent={}
+        self.received=[]
+
+    async def connect(self):
+        await self.communicator.connect()
+        #every client moves to the delta protocol, readers would get legacy
+        #content frames otherwise and their deliveries would not be timed
+        await self.communicator.send_to(text_data=json.dumps({'type':'sync'}))
+
+    async def read(self):
+        while True:
+            frame=json.loads((await self.communicator.receive_output(timeout=None))['text'])
+            now=time.perf_counter()
+            if frame.get('type')=='ack':
+                self.sent[frame['rev']]=self.pending.pop(0)
+                self.rev=max(self.rev,frame['rev'])
+            elif frame.get('type')=='op':
+                self.received.append((frame['baseRev'],frame['rev'],now))
+                self.rev=max(self.rev,frame['rev'])
+            elif frame.get('type')=='snapshot':
+                self.rev=frame['rev']
+
+    async def type(self,rate,until):
+        await asyncio.sleep(random.random()/rate)
+        while time.perf_counter()<until:
+            self.pending.append(time.perf_counter())
+            await self.communicator.send_to(text_data=json.dumps({
+                'type':'op',
+                'rev':self.rev,
+                'ops':[{'pos':0,'insert':'a'}],
+            }))
+            await asyncio.sleep(1/rate)
+
+
+class Command(BaseCommand):
+    help="Load test NoteConsumer with simulated editors and report latency and throughput"
+
+    def add_arguments(self,parser):
+        parser.add_argument('--rooms',type=int,default=10)
+        parser.add_argument('--clients',type=int,default=5,help="Clients per room, or the mean with --skew")
+        parser.add_argument('--skew',action='store_true',help="Random room sizes between 1 and 2x --clients")
+        parser.add_argument('--typists',type=float,default=0.2,help="Share of clients that type")
+        parser.add_argument('--rate',type=float,default=5,help="Ops per second per typing client")
+        parser.add_argument('--duration',type=float,default=10)
+        parser.add_argument('--note-size',type=int,default=2000)
+        parser.add_argument('--layer',choices=['memory','redis'],default='memory')
+        parser.add_argument('--http-clients',type=int,default=0,help="Concurrent api readers")
+        parser.add_argument('--http-rate',type=float,default=10,help="Requests per second per api reader")
+
+    def handle(self,*args,**options):
+        if options['layer']=='memory':
+            layers={'default':{'BACKEND':'channels.layers.InMemoryChannelLayer'}}
+        else:
+            layers=settings.CHANNEL_LAYERS
+        with override_settings(CHANNEL_LAYERS=layers):
+            asyncio.run(self.run(options))
+
+    async def run(self,options):
+        user,note_ids=await sync_to_async(self.setup)(options)
+        application=CookieMiddleware(URLRouter(websocket_urlpatterns))
+        headers=[(b'host',b'localhost'),(b'cookie',f'access_token={self.token}'.encode())]
+        try:
+            sizes=[
+                random.randint(1,options['clients']*2) if options['skew'] else options['clients']
+                for _ in note_ids
+            ]
+            tracemalloc.start()
+            before=tracemalloc.get_traced_memory()[0]
+            rooms=[]
+            for note_id,size in zip(note_ids,sizes):
+                room=[Client(application,note_id,headers) for _ in range(size)]
+                for client in room:
+                    await client.connect()
+                rooms.append(room)
+            clients=[client for room in rooms for client in room]
+            per_connection=(tracemalloc.get_traced_memory()[0]-before)/len(clients)
+            tracemalloc.stop()
+            redis_before=await self.redis_commands(options)
+            readers=[asyncio.ensure_future(client.read()) for client in clients]
+            until=time.perf_counter()+options['duration']
+            typists=[client for client in clients if random.random()<options['typists']] or clients[:1]
+            http_latencies=[]
+            await asyncio.gather(
+                *(client.type(options['rate'],until) for client in typists),
+                *(self.browse(note_ids,headers,options['http_rate'],until,http_latencies)
+                  for _ in range(options['http_clients'])),
+            )
+            await asyncio.sleep(1)
+            redis_after=await self.redis_commands(options)
+            for reader in readers:
+                reader.cancel()
+            for client in clients:
+                await client.communicator.disconnect()
+            self.report(rooms,options,per_connection,redis_before,redis_after)
+            if http_latencies:
+                self.report_http(http_latencies,options)
+        finally:
+            await sync_to_async(self.teardown)(user)
+
+    async def browse(self,note_ids,headers,rate,until,latencies):
+        application=get_asgi_application()
+        await asyncio.sleep(random.random()/rate)
+        while time.perf_counter()<until:
+            start=time.perf_counter()
+            communicator=HttpCommunicator(application,'GET',f'/notes/{random.choice(note_ids)}/',headers=headers)
+            await communicator.get_response(timeout=30)
+            latencies.append(time.perf_counter()-start)
+            await communicator.send_input({'type':'http.disconnect'})
+            await communicator.wait()
+            await asyncio.sleep(max(0,1/rate-(time.perf_counter()-start)))
+
+    def setup(self,options):
+        user=User.objects.create(username=f'bench-{time.time_ns()}')
+        self.token=str(MyTokenObtainPairSerializer.get_token(user).access_token)
+        content='x'*options['note_size']
+        notes=Note.objects.bulk_create(
+            [Note(owner=user,title='bench',content=content) for _ in range(options['rooms'])]
+        )
+        return user,[note.id for note in notes]
+
+    def teardown(self,user):
+        user.delete()
+
+    async def redis_commands(self,options):
+        if options['layer']!='redis' or not getattr(settings,'REDIS_URL',None):
+            return None
+        from redis.asyncio import Redis
+        client=Redis.from_url(settings.REDIS_URL)
+        try:
+            return (await client.info('stats'))['total_commands_processed']
+        finally:
+            await client.aclose()
+
+    def report(self,rooms,options,per_connection,redis_before,redis_after):
+        latencies=[]
+        ops=0
+        for room in rooms:
+            sent={}
+            for client in room:
+                sent.update(client.sent)
+            ops+=len(sent)
+            for client in room:
+                for base_rev,rev,received in client.received:
+                    for covered in range(base_rev+1,rev+1):
+                        if covered in sent and covered not in client.sent:
+                            latencies.append(received-sent[covered])
+        clients=sum(len(room) for room in rooms)
+        self.stdout.write(f"rooms {len(rooms)}, clients {clients}, layer {options['layer']}")
+        self.stdout.write(f"ops sequenced {ops} ({ops/options['duration']:.0f}/s), deliveries {len(latencies)}")
+        if latencies:
+            latencies.sort()
+            p99=latencies[min(len(latencies)-1,int(len(latencies)*0.99))]
+            self.stdout.write(
+                f"fan-out latency ms p50 {statistics.median(latencies)*1000:.2f} p99 {p99*1000:.2f}"
+            )
+        self.stdout.write(f"memory per connection {per_connection/1024:.1f} KiB")
+        if redis_before is not None:
+            commands=redis_after-redis_before
+            self.stdout.write(f"redis commands {commands} ({commands/max(ops,1):.1f} per op)")
+
+    def report_http(self,latencies,options):
+        latencies.sort()
+        p99=latencies[min(len(latencies)-1,int(len(latencies)*0.99))]
+        self.stdout.write(
+            f"api requests {len(latencies)} ({len(latencies)/options['duration']:.0f}/s), "
+            f"latency ms p50 {statistics.median(latencies)*1000:.2f} p99 {p99*1000:.2f}"
+        )
@@ -0,0 +1,77 @@
+import asyncio
+import tempfile
+import time
+import tracemalloc
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from notes.models import Note
+from notes.transfer import batch_size,export_ndjson,export_zip,import_lines
+
+#times the note export formats and the import on one large account, the ndjson
+#export is imported back from a temporary file. --memory also reports the peak
+#memory of each, which should stay flat as --notes grows (tracing slows everything
+#down several times, take timings without it). creates its own users and deletes
+#them afterwards
+
+
+class Command(BaseCommand):
+    help="Benchmark note export and import on one large account"
+
+    def add_arguments(self,parser):
+        parser.add_argument('--notes',type=int,default=100000)
+        parser.add_argument('--note-size',type=int,default=2000)
+        parser.add_argument('--formats',default='ndjson,html,markdown')
+        parser.add_argument('--memory',action='store_true',help="Trace peak memory")
+
+    def handle(self,*args,**options):
+        stamp=time.time_ns()
+        user=User.objects.create(username=f'bench-export-{stamp}')
+        target=User.objects.create(username=f'bench-import-{stamp}')
+        try:
+            self.setup(user,options)
+            with tempfile.TemporaryFile() as dump:
+                for kind in options['formats'].split(','):
+                    self.measure(
+                        f'export {kind}',options,
+                        lambda:asyncio.run(self.export(user,kind,dump))
+                    )
+                dump.seek(0)
+                result=self.measure('import ndjson',options,lambda:import_lines(target,dump))
+                self.stdout.write(f"imported {result['imported']}, failed {result['failed']}")
+        finally:
+            user.delete()
+            target.delete()
+
+    def setup(self,user,options):
+        content='<div>'+'x'*options['note_size']+'</div>'
+        for start in range(0,options['notes'],batch_size()):
+            count=min(batch_size(),options['notes']-start)
+            Note.objects.bulk_create([Note(owner=user,title=f'bench {start+i}',content=content) for i in range(count)])
+
+    async def export(self,user,kind,dump):
+        size=0
+        stream=export_ndjson(user) if kind=='ndjson' else export_zip(user,kind)
+        async for chunk in stream:
+            size+=len(chunk)
+            if kind=='ndjson':
+                dump.write(chunk)
+        return size
+
+    def measure(self,label,options,run):
+        if options['memory']:
+            tracemalloc.start()
+        start=time.perf_counter()
+        try:
+            result=run()
+            elapsed=time.perf_counter()-start
+            peak=tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        line=f"{label}: {elapsed:.2f}s ({options['notes']/elapsed:.0f} notes/s"
+        if isinstance(result,int):
+            line+=f", {result/1048576:.1f} MiB"
+        line+=")"
+        if options['memory']:
+            line+=f", peak memory {peak/1048576:.1f} MiB"
+        self.stdout.write(line)
+        return result
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from notes.oplog import compact_note,notes_with_tail,prune_history
+
+
+class Command(BaseCommand):
+    help="Fold pending note operations into new snapshots and prune old history"
+
+    def handle(self,*args,**options):
+        compacted=0
+        for note_id in notes_with_tail().iterator():
+            if compact_note(note_id):
+                compacted+=1
+        pruned=prune_history()
+        self.stdout.write(f"compacted {compacted} notes, pruned {pruned} operations")
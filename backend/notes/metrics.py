@@ -0,0 +1,159 @@
+import bisect
+import time
+from functools import wraps
+
+#in process metrics for the websocket layer in the prometheus text format.
+#every daphne worker keeps its own numbers, prometheus scrapes each one.
+#updates are plain dict and list increments on the event loop, no locks
+
+BYTE_BUCKETS=(64,256,1024,4096,16384,65536,262144,1048576)
+SECOND_BUCKETS=(0.0005,0.001,0.0025,0.005,0.01,0.025,0.05,0.1,0.25,0.5,1)
+SIZE_BUCKETS=(1,2,3,5,10,20,50,100)
+
+registry=[]
+
+
+def _labels(names,values):
+    if not names:
+        return ''
+    return '{'+','.join(f'{name}="{value}"' for name,value in zip(names,values))+'}'
+
+
+class Counter:
+    kind='counter'
+
+    def __init__(self,name,help,labels=()):
+        self.name=name
+        self.help=help
+        self.labels=labels
+        self.values={}
+        registry.append(self)
+
+    def inc(self,*labels,amount=1):
+        self.values[labels]=self.values.get(labels,0)+amount
+
+    def samples(self):
+        for labels,value in list(self.values.items()):
+            yield self.name+_labels(self.labels,labels),value
+
+
+class Gauge(Counter):
+    kind='gauge'
+
+    def dec(self,*labels,amount=1):
+        self.inc(*labels,amount=-amount)
+
+
+class Histogram:
+    kind='histogram'
+
+    def __init__(self,name,help,buckets,labels=()):
+        self.name=name
+        self.help=help
+        self.buckets=buckets
+        self.labels=labels
+        self.values={}
+        registry.append(self)
+
+    def observe(self,value,*labels):
+        entry=self.values.get(labels)
+        if entry is None:
+            entry=self.values[labels]=[[0]*(len(self.buckets)+1),0]
+        entry[0][bisect.bisect_left(self.buckets,value)]+=1
+        entry[1]+=value
+
+    def samples(self):
+        for labels,(counts,total) in list(self.values.items()):
+            seen=0
+            for bound,count in zip(self.buckets+('+Inf',),counts):
+                seen+=count
+                yield self.name+'_bucket'+_labels(self.labels+('le',),labels+(bound,)),seen
+            yield self.name+'_sum'+_labels(self.labels,labels),total
+            yield self.name+'_count'+_labels(self.labels,labels),seen
+
+
+class Collector:
+    #values computed when scraped, for state that is already kept elsewhere
+    def __init__(self,name,help,kind,collect):
+        self.name=name
+        self.help=help
+        self.kind=kind
+        self.collect=collect
+        registry.append(self)
+
+    def samples(self):
+        return self.collect()
+
+
+connections=Gauge('notes_ws_connections','Open websocket connections')
+messages_in=Counter('notes_ws_messages_received_total','Messages received from clients',('type',))
+frames_out=Counter('notes_ws_frames_sent_total','Frames sent to clients')
+bytes_in=Histogram('notes_ws_received_bytes','Size of received messages',BYTE_BUCKETS)
+bytes_out=Histogram('notes_ws_sent_bytes','Size of sent frames',BYTE_BUCKETS)
+group_send_seconds=Histogram('notes_ws_group_send_seconds','Time spent in channel layer group_send',SECOND_BUCKETS)
+handler_seconds=Histogram('notes_ws_handler_seconds','Time spent in consumer handlers',SECOND_BUCKETS,('handler',))
+
+
+def timed(handler):
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(*args,**kwargs):
+            start=time.perf_counter()
+            try:
+                return await method(*args,**kwargs)
+            finally:
+                handler_seconds.observe(time.perf_counter()-start,handler)
+        return wrapper
+    return decorator
+
+
+def _rooms():
+    from notes.documents import documents
+    yield 'notes_ws_rooms',len(documents)
+
+
+def _room_sizes():
+    from notes.documents import documents
+    counts=[0]*(len(SIZE_BUCKETS)+1)
+    total=0
+    for document in list(documents.values()):
+        counts[bisect.bisect_left(SIZE_BUCKETS,len(document.channels))]+=1
+        total+=len(document.channels)
+    seen=0
+    for bound,count in zip(SIZE_BUCKETS+('+Inf',),counts):
+        seen+=count
+        yield f'notes_ws_room_clients_bucket{{le="{bound}"}}',seen
+    yield 'notes_ws_room_clients_sum',total
+    yield 'notes_ws_room_clients_count',seen
+
+
+def _outbox():
+    from notes.outbox import stats
+    for reason in ('dropped','resyncs','disconnects','gaps','stalls'):
+        yield f'notes_ws_outbox_total{{event="{reason}"}}',stats[reason]
+
+
+def _db_pools():
+    from django.db import connections
+    for alias in connections:
+        pool=getattr(type(connections[alias]),'_connection_pools',{}).get(alias)
+        if pool is None:
+            continue
+        for stat,value in pool.get_stats().items():
+            yield f'notes_db_pool{{alias="{alias}",stat="{stat}"}}',value
+
+
+Collector('notes_ws_rooms','Rooms with a live document in this process','gauge',_rooms)
+Collector('notes_ws_room_clients','Connections per live room','histogram',_room_sizes)
+Collector('notes_ws_outbox_total','Slow client handling: dropped frames, resyncs, disconnects and revision gaps','counter',_outbox)
+Collector('notes_db_pool','psycopg pool stats: size, available and waiting connections, wait time','gauge',_db_pools)
+
+
+def render():
+    lines=[]
+    for metric in registry:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name,value in metric.samples():
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines)+'\n'
@@ -0,0 +1,77 @@
+import uuid
+from django.db import migrations, models
+
+# category, is_shared and share_token were in the model before any migration added
+# them. databases set up then got them from migrations that were never committed
+# (db.sqlite3 has a notes.0002_note_category), so each column is only added where
+# it is missing and the state is recorded either way
+
+
+def column_names(schema_editor, table):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        return {column.name for column in connection.introspection.get_table_description(cursor, table)}
+
+
+def add_missing(name, field):
+    def forwards(apps, schema_editor):
+        Note = apps.get_model('notes', 'Note')
+        if name in column_names(schema_editor, Note._meta.db_table):
+            return
+        column = field.clone()
+        column.set_attributes_from_name(name)
+        column.model = Note
+        schema_editor.add_field(Note, column)
+
+    return migrations.SeparateDatabaseAndState(
+        database_operations=[migrations.RunPython(forwards, migrations.RunPython.noop)],
+        state_operations=[migrations.AddField(model_name='note', name=name, field=field)],
+    )
+
+
+def has_unique_share_token(schema_editor, Note):
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, Note._meta.db_table)
+    return any(
+        constraint['unique'] and constraint['columns'] == ['share_token']
+        for constraint in constraints.values()
+    )
+
+
+def unique_share_tokens(apps, schema_editor):
+    Note = apps.get_model('notes', 'Note')
+    unique = has_unique_share_token(schema_editor, Note)
+    # an AddField gives every existing row the same uuid, give each note its own
+    notes = Note.objects.all() if not unique else Note.objects.filter(share_token__isnull=True)
+    for note in notes.only('id').iterator():
+        Note.objects.filter(id=note.id).update(share_token=uuid.uuid4())
+    if not unique:
+        old = Note._meta.get_field('share_token')
+        new = models.UUIDField(blank=True, default=uuid.uuid4, editable=False, null=True, unique=True)
+        new.set_attributes_from_name('share_token')
+        new.model = Note
+        schema_editor.alter_field(Note, old, new)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0001_initial'),
+    ]
+
+    operations = [
+        add_missing('category', models.CharField(default='work', max_length=20)),
+        add_missing('is_shared', models.BooleanField(default=False)),
+        add_missing('share_token', models.UUIDField(blank=True, editable=False, null=True)),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunPython(unique_share_tokens, migrations.RunPython.noop)],
+            state_operations=[
+                migrations.AlterField(
+                    model_name='note',
+                    name='share_token',
+                    field=models.UUIDField(blank=True, default=uuid.uuid4, editable=False, null=True, unique=True),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-18 17:06
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0002_note_revisions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='note',
+            index=models.Index(fields=['owner', '-updated_at', '-id'], name='note_owner_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 6.0 on 2026-10-18 17:06
+
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+SEARCH_VECTOR = """
+    setweight(to_tsvector('english', coalesce({row}title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce({row}category, '')), 'B') ||
+    setweight(to_tsvector('english', coalesce({row}content, '')), 'C')
+"""
+
+CREATE_TRIGGER = """
+CREATE OR REPLACE FUNCTION notes_note_search_vector_update() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := {vector};
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER notes_note_search_vector_trigger
+BEFORE INSERT OR UPDATE OF title, category, content ON notes_note
+FOR EACH ROW EXECUTE FUNCTION notes_note_search_vector_update();
+
+UPDATE notes_note SET search_vector = {backfill};
+
+CREATE INDEX notes_note_search_vector_gin ON notes_note USING gin (search_vector);
+""".format(vector=SEARCH_VECTOR.format(row='NEW.'), backfill=SEARCH_VECTOR.format(row=''))
+
+DROP_TRIGGER = """
+DROP INDEX IF EXISTS notes_note_search_vector_gin;
+DROP TRIGGER IF EXISTS notes_note_search_vector_trigger ON notes_note;
+DROP FUNCTION IF EXISTS notes_note_search_vector_update();
+"""
+
+
+def create_trigger(apps, schema_editor):
+    # only postgres keeps a search vector, other databases search with icontains
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_TRIGGER)
+
+
+def drop_trigger(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notes', '0003_note_owner_updated_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='note',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_trigger, drop_trigger),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchVectorField
 import uuid
 
 # Create your models here.
@@ -15,4 +16,36 @@ class Note(models.Model):
     created_at=models.DateField(auto_now_add=True)
     updated_at=models.DateField(auto_now=True)
     share_token=models.UUIDField(default=uuid.uuid4,unique=True,null=True,blank=True,editable=False)
-    is_shared=models.BooleanField(default=False)
\ No newline at end of file
+    is_shared=models.BooleanField(default=False)
+
+    #content is a snapshot at snapshot_rev, later edits are NoteOperation rows up to rev
+    rev=models.PositiveIntegerField(default=0)
+    snapshot_rev=models.PositiveIntegerField(default=0)
+    #bumped on every change outside the content ops, part of the note etag
+    version=models.PositiveIntegerField(default=1)
+
+    #weighted title/category/content vector, filled by a postgres trigger (migration 0004)
+    #and gin indexed there. stays empty on other databases, search falls back to icontains
+    search_vector=SearchVectorField(null=True,editable=False)
+
+    class Meta:
+        indexes=[
+            #dashboard listing, keyset paginated on (updated_at, id)
+            models.Index(fields=['owner','-updated_at','-id'],name='note_owner_updated_idx'),
+        ]
+
+
+class NoteOperation(models.Model):
+    note=models.ForeignKey(
+        Note,
+        on_delete=models.CASCADE,
+        related_name='operations'
+    )
+    rev=models.PositiveIntegerField()
+    ops=models.JSONField()
+    created_at=models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints=[
+            models.UniqueConstraint(fields=['note','rev'],name='unique_note_operation_rev'),
+        ]
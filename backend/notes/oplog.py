@@ -0,0 +1,131 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F,Q
+from django.utils import timezone
+from asgiref.sync import sync_to_async
+from notes.models import Note,NoteOperation
+from notes.delta import apply_ops,diff_ops
+from notes.cache import invalidate_notes
+
+#Note.content is a snapshot at Note.snapshot_rev, the operations after it are the
+#tail. loading replays the tail, compaction folds it into a new snapshot
+
+
+def load_note(note_id):
+    note=Note.objects.filter(id=note_id).values('content','rev','snapshot_rev').first()
+    if note is None:
+        return None
+    content=note['content']
+    head=note['snapshot_rev']
+    tail=NoteOperation.objects.filter(
+        note_id=note_id,
+        rev__gt=note['snapshot_rev']
+    ).order_by('rev').values_list('rev','ops')
+    for head,ops in tail:
+        content=apply_ops(content,ops)
+    return content,max(head,note['rev']),note['snapshot_rev']
+
+
+def replay_notes(notes):
+    #brings notes read from the table up to their latest revision with one query for
+    #all their tails. a replayed note holds the content at rev, so it is marked as
+    #a snapshot at rev and can be saved as is
+    tails={}
+    pending=[note for note in notes if note.rev>note.snapshot_rev]
+    if pending:
+        condition=Q()
+        for note in pending:
+            condition|=Q(note_id=note.id,rev__gt=note.snapshot_rev)
+        rows=NoteOperation.objects.using(pending[0]._state.db).filter(condition).order_by('note_id','rev')
+        for note_id,rev,ops in rows.values_list('note_id','rev','ops'):
+            tails.setdefault(note_id,[]).append((rev,ops))
+    for note in pending:
+        for rev,ops in tails.get(note.id,()):
+            note.content=apply_ops(note.content,ops)
+            note.rev=max(note.rev,rev)
+        note.snapshot_rev=note.rev
+    return notes
+
+
+async def areplay_note(note):
+    if note.rev>note.snapshot_rev:
+        await sync_to_async(replay_notes)([note])
+    return note
+
+
+def recent_operations(note_id,head,limit):
+    #the newest ops up to head that follow each other without a hole, oldest first
+    rows=NoteOperation.objects.filter(
+        note_id=note_id,
+        rev__gt=head-limit,
+        rev__lte=head
+    ).order_by('-rev').values_list('rev','ops')
+    recent=[]
+    for rev,ops in rows:
+        if rev!=head-len(recent):
+            break
+        recent.append(ops)
+    recent.reverse()
+    return recent
+
+
+def compact_note(note_id):
+    with transaction.atomic():
+        state=load_note(note_id)
+        if state is None:
+            return False
+        content,rev,_=state
+        #a write-behind flush that moved the note past rev meanwhile wins,
+        #the next run folds the rest
+        updated=Note.objects.filter(id=note_id,rev__lte=rev,snapshot_rev__lte=rev).update(
+            content=content,rev=rev,snapshot_rev=rev
+        )
+    invalidate_notes([note_id])
+    return bool(updated)
+
+
+def notes_with_tail():
+    return Note.objects.filter(rev__gt=F('snapshot_rev')).values_list('id',flat=True)
+
+
+def prune_history():
+    #operations already folded into a snapshot are only kept as recent history
+    keep=getattr(settings,'NOTES_HISTORY_KEEP',1000)
+    deleted,_=NoteOperation.objects.filter(
+        rev__lte=F('note__snapshot_rev')-keep
+    ).delete()
+    return deleted
+
+
+def content_operation(note,content):
+    #full content writes from the api start a new snapshot, the diff stays in the history.
+    #updates note in place and returns the operation row to save, None if unchanged
+    ops=diff_ops(note.content,content)
+    if not ops:
+        return None
+    note.rev+=1
+    note.content=content
+    note.snapshot_rev=note.rev
+    return NoteOperation(note=note,rev=note.rev,ops=ops)
+
+
+def save_note(note,version,rev,content=None):
+    #writes an api update only if the note is still at version (and rev when the content
+    #changes), the operation and the row commit together. False when it moved meanwhile
+    with transaction.atomic():
+        fields={'title':note.title,'category':note.category,'version':note.version,'updated_at':timezone.localdate()}
+        condition={'id':note.id,'version':version}
+        operation=None if content is None else content_operation(note,content)
+        if content is not None:
+            condition['rev']=rev
+        if operation is not None:
+            fields.update(content=note.content,rev=note.rev,snapshot_rev=note.snapshot_rev)
+        if not Note.objects.filter(**condition).update(**fields):
+            return False
+        if operation is not None:
+            operation.save()
+    return True
+
+
+async def asave_note(note,version,rev,content=None):
+    return await sync_to_async(save_note)(note,version,rev,content)
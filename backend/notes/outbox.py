@@ -0,0 +1,139 @@
+import asyncio
+import time
+from collections import Counter
+from notes.wire import FrameEncoder
+from notes import metrics
+
+#per connection outbound queue flushed at most NOTES_WS_SEND_RATE times a second.
+#the first frame after an idle period goes out right away, frames that arrive
+#while waiting for the next tick are coalesced:
+#  content  - full content for legacy clients, only the newest one is kept
+#  op       - consecutive op frames are merged into one covering all their revisions
+#  snapshot - replaces queued content and op frames it already contains
+#everything else (acks, presence, errors) is sent as is and in order.
+#
+#websocket sends return once the server buffered the frame, so a slow client is
+#only noticed through the "seen" counts it reports. once a client reported one, at
+#most window frames are sent ahead of what it has seen and the rest waits in the
+#queue, where it keeps being coalesced. clients that never report are not held back.
+#a client that does not keep up lets the queue grow past high_water (or the merged
+#op frame past high_water ops). the queued updates are then dropped for one
+#snapshot rendered at send time (forced resync). if it grows past high_water again
+#before draining below low_water the connection is closed through on_overflow and
+#the client has to reconnect
+
+#process wide counters: dropped frames, forced resyncs, slow disconnects, gaps,
+#flushes held back for a client behind its window
+stats=Counter()
+
+
+class Outbox:
+    def __init__(self,send,rate,resync=None,on_overflow=None,high_water=256,low_water=32,encode=None,window=64):
+        self.send=send
+        self.encode=encode or FrameEncoder()
+        self.interval=1/rate if rate else 0
+        self.resync=resync
+        self.on_overflow=on_overflow
+        self.high_water=high_water
+        self.low_water=low_water
+        self.resyncing=False
+        self.window=window
+        self.sent=0
+        self.seen=None
+        self.acked=asyncio.Event()
+        self.frames=[]
+        self.last_flush=0
+        self.task=None
+
+    def push(self,frame,kind=None):
+        #frame is a dict, or for kind content a callable returning the dict at send time
+        if kind in ('op','content') and any(entry[0]=='snapshot' and callable(entry[1]) for entry in self.frames):
+            #a forced resync is queued and is rendered after this update was applied
+            stats['dropped']+=1
+            return
+        if kind=='content':
+            self.frames=[entry for entry in self.frames if entry[0]!='content']
+        elif kind=='op' and self.frames and self.frames[-1][0]=='op':
+            self.frames[-1]=('op',_merge_ops(self.frames[-1][1],frame))
+            if len(self.frames[-1][1]['ops'])>self.high_water:
+                self.relieve()
+            return
+        elif kind=='snapshot':
+            #a snapshot rendered at send time covers every queued op
+            rev=None if callable(frame) else frame['rev']
+            self.frames=[
+                entry for entry in self.frames
+                if entry[0] not in ('content','snapshot')
+                and not (entry[0]=='op' and (rev is None or entry[1]['rev']<=rev))
+            ]
+        self.frames.append((kind,frame))
+        if len(self.frames)>self.high_water:
+            self.relieve()
+        if self.task is None and self.frames:
+            self.task=asyncio.ensure_future(self.run())
+
+    def ack(self,frames):
+        #number of frames the client has processed on this connection
+        if isinstance(frames,int) and not isinstance(frames,bool) and 0<=frames<=self.sent:
+            self.seen=max(self.seen or 0,frames)
+            self.acked.set()
+
+    def behind(self):
+        return bool(self.window) and self.seen is not None and self.sent-self.seen>=self.window
+
+    def relieve(self):
+        if self.resyncing or self.resync is None:
+            stats['disconnects']+=1
+            self.close()
+            if self.on_overflow is not None:
+                asyncio.ensure_future(self.on_overflow())
+            return
+        kept=[entry for entry in self.frames if entry[0] not in ('op','content','snapshot')]
+        stats['dropped']+=len(self.frames)-len(kept)
+        stats['resyncs']+=1
+        self.frames=kept+[('snapshot',self.resync)]
+        self.resyncing=True
+
+    async def run(self):
+        try:
+            while self.frames:
+                delay=self.last_flush+self.interval-time.monotonic()
+                if delay>0:
+                    await asyncio.sleep(delay)
+                if self.behind():
+                    stats['stalls']+=1
+                    while self.behind():
+                        self.acked.clear()
+                        await self.acked.wait()
+                    continue
+                frames=self.frames
+                self.frames=[]
+                self.last_flush=time.monotonic()
+                for kind,frame in frames:
+                    if callable(frame):
+                        frame=frame()
+                    data=self.encode(frame)
+                    metrics.frames_out.inc()
+                    metrics.bytes_out.observe(len(data.get('text_data') or data.get('bytes_data')))
+                    await self.send(**data)
+                    self.sent+=1
+                if self.resyncing and len(self.frames)<=self.low_water:
+                    self.resyncing=False
+        finally:
+            self.task=None
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task=None
+        self.frames=[]
+
+
+def _merge_ops(first,second):
+    return {
+        'type':'op',
+        'rev':second['rev'],
+        'baseRev':first['baseRev'],
+        'ops':first['ops']+second['ops'],
+        'senderId':first['senderId'] if first['senderId']==second['senderId'] else None,
+    }
@@ -0,0 +1,155 @@
+from django.conf import settings
+from notes.sharding import HashRing
+
+#which worker serves each note room. the worker that opens a room takes a lease on
+#it in redis and is the only one running its LiveDocument, connections reaching
+#other workers are tunnelled to it (notes.rooms). the owner renews the lease while
+#the room is open and drops it when the last client leaves, a lease left by a
+#worker that died expires after NOTES_OWNER_TTL seconds. leases live on the shard
+#of the room like its presence keys
+
+
+def lease_ttl():
+    return getattr(settings,'NOTES_OWNER_TTL',15)
+
+
+class RedisOwnership:
+    def __init__(self,urls):
+        self.ring=HashRing(urls)
+        self.clients={}
+
+    def get_client(self,room):
+        url=self.ring.get(room)
+        client=self.clients.get(url)
+        if client is None:
+            from redis.asyncio import Redis
+            client=self.clients[url]=Redis.from_url(url,decode_responses=True)
+        return client
+
+    def key(self,room):
+        return f'owner:{room}'
+
+    async def claim(self,room,node):
+        #returns the owner after the attempt, node when the room was free
+        client=self.get_client(room)
+        key=self.key(room)
+        while True:
+            if await client.set(key,node,nx=True,px=int(lease_ttl()*1000)):
+                return node
+            owner=await client.get(key)
+            if owner is not None:
+                return owner
+
+    async def owner(self,room):
+        return await self.get_client(room).get(self.key(room))
+
+    async def owned(self,rooms):
+        #the rooms that have an owner, one round trip per shard
+        shards={}
+        for room in rooms:
+            shards.setdefault(self.ring.get(room),[]).append(room)
+        result=set()
+        for names in shards.values():
+            values=await self.get_client(names[0]).mget([self.key(room) for room in names])
+            result.update(room for room,value in zip(names,values) if value is not None)
+        return result
+
+    async def renew(self,room,node):
+        #False once the lease expired and another worker took the room
+        from redis.exceptions import WatchError
+        key=self.key(room)
+        async with self.get_client(room).pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                owner=await pipe.get(key)
+                if owner not in (None,node):
+                    return False
+                pipe.multi()
+                pipe.set(key,node,px=int(lease_ttl()*1000))
+                await pipe.execute()
+                return True
+            except WatchError:
+                return False
+
+    async def release(self,room,node):
+        #only the owner's own lease, a room taken over meanwhile keeps its new owner
+        from redis.exceptions import WatchError
+        key=self.key(room)
+        async with self.get_client(room).pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(key)
+                if await pipe.get(key)!=node:
+                    return
+                pipe.multi()
+                pipe.delete(key)
+                await pipe.execute()
+            except WatchError:
+                pass
+
+
+class MigratingOwnership:
+    #while the shard list changes a lease is taken on the room's shard of both lists.
+    #processes still on the old list compete on the old shard, the ones already
+    #without the previous list on the new one
+    def __init__(self,previous,current):
+        self.previous=previous
+        self.current=current
+
+    async def claim(self,room,node):
+        owner=await self.previous.claim(room,node)
+        if owner!=node:
+            return owner
+        owner=await self.current.claim(room,node)
+        if owner!=node:
+            await self.previous.release(room,node)
+        return owner
+
+    async def owner(self,room):
+        return await self.previous.owner(room) or await self.current.owner(room)
+
+    async def owned(self,rooms):
+        return await self.previous.owned(rooms)|await self.current.owned(rooms)
+
+    async def renew(self,room,node):
+        kept=await self.previous.renew(room,node)
+        return await self.current.renew(room,node) and kept
+
+    async def release(self,room,node):
+        await self.current.release(room,node)
+        await self.previous.release(room,node)
+
+
+class LocalOwnership:
+    #single process fallback when no redis is configured (local dev, tests)
+    def __init__(self):
+        self.owners={}
+
+    async def claim(self,room,node):
+        return self.owners.setdefault(room,node)
+
+    async def owner(self,room):
+        return self.owners.get(room)
+
+    async def owned(self,rooms):
+        return {room for room in rooms if room in self.owners}
+
+    async def renew(self,room,node):
+        return self.owners.setdefault(room,node)==node
+
+    async def release(self,room,node):
+        if self.owners.get(room)==node:
+            del self.owners[room]
+
+
+_ownership=None
+
+
+def get_ownership():
+    global _ownership
+    if _ownership is None:
+        urls=getattr(settings,'REDIS_SHARD_URLS',None)
+        previous=getattr(settings,'REDIS_SHARD_URLS_PREVIOUS',None)
+        _ownership=RedisOwnership(urls) if urls else LocalOwnership()
+        if urls and previous and previous!=urls:
+            _ownership=MigratingOwnership(RedisOwnership(previous),_ownership)
+    return _ownership
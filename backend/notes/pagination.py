@@ -0,0 +1,37 @@
+import base64
+from datetime import date
+from django.db.models import Q
+
+#keyset pagination over (updated_at, id), newest first.
+#the cursor is the position of the last note of the previous page
+
+DEFAULT_LIMIT=50
+MAX_LIMIT=200
+
+
+def encode_cursor(note):
+    raw=f"{note.updated_at.isoformat()},{note.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    raw=base64.urlsafe_b64decode(cursor.encode()).decode()
+    updated_at,id=raw.split(',')
+    return date.fromisoformat(updated_at),int(id)
+
+
+async def paginate(queryset,params):
+    #raises ValueError for a bad limit or cursor
+    limit=min(int(params.get('limit',DEFAULT_LIMIT)),MAX_LIMIT)
+    if limit<1:
+        raise ValueError("limit must be positive")
+    queryset=queryset.order_by('-updated_at','-id')
+    cursor=params.get('cursor')
+    if cursor:
+        updated_at,id=decode_cursor(cursor)
+        queryset=queryset.filter(
+            Q(updated_at__lt=updated_at)|Q(updated_at=updated_at,id__lt=id)
+        )
+    page=[note async for note in queryset[:limit+1]]
+    next_cursor=encode_cursor(page[limit-1]) if len(page)>limit else None
+    return page[:limit],next_cursor
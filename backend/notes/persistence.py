@@ -0,0 +1,155 @@
+import asyncio
+import atexit
+import threading
+from django.conf import settings
+from django.db import IntegrityError,close_old_connections,transaction
+from django.utils import timezone
+from channels.db import database_sync_to_async
+from notes.models import Note,NoteOperation
+from notes.cache import invalidate_notes
+
+#write-behind for live notes: edits only mark the note dirty or queue their ops and
+#a background task writes everything with one bulk_create for the ops and one
+#bulk_update per set of changed note fields. a batch that fails on one note is
+#written again note by note, notes that still conflict are dropped and their rooms
+#reloaded from the database instead of retrying them forever
+
+
+class WriteBehind:
+    def __init__(self):
+        self.dirty={}
+        self.operations=[]
+        self.lock=threading.Lock()
+        self.task=None
+        #note ids whose queued writes were dropped, for on_conflict to resync
+        self.conflicts=set()
+        self.on_conflict=None
+
+    def mark(self,note_id,**fields):
+        with self.lock:
+            self.dirty.setdefault(note_id,{}).update(fields)
+
+    def append(self,note_id,rev,ops):
+        with self.lock:
+            self.operations.append(NoteOperation(note_id=note_id,rev=rev,ops=ops))
+            self.dirty.setdefault(note_id,{})['rev']=rev
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task=asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(getattr(settings,'NOTES_FLUSH_INTERVAL',2))
+            try:
+                await self.flush()
+            except Exception as e:
+                print("write behind flush error:",e)
+
+    def pending(self,note_id):
+        with self.lock:
+            return dict(self.dirty.get(note_id,{}))
+
+    def take(self,note_ids=None):
+        with self.lock:
+            if note_ids is None:
+                taken=self.dirty,self.operations
+                self.dirty={}
+                self.operations=[]
+            else:
+                operations=[op for op in self.operations if op.note_id in note_ids]
+                self.operations=[op for op in self.operations if op.note_id not in note_ids]
+                taken={id:self.dirty.pop(id) for id in note_ids if id in self.dirty},operations
+        return taken
+
+    def restore(self,taken):
+        #newer values marked while the write was failing win
+        dirty,operations=taken
+        with self.lock:
+            for note_id,fields in dirty.items():
+                self.dirty[note_id]={**fields,**self.dirty.get(note_id,{})}
+            self.operations=operations+self.operations
+
+    def write(self,taken):
+        dirty,operations=taken
+        if not dirty and not operations:
+            return 0
+        try:
+            with transaction.atomic():
+                self._write(dirty,operations)
+        except IntegrityError:
+            return self._write_each(taken)
+        except Exception:
+            self.restore(taken)
+            raise
+        invalidate_notes(dirty)
+        return len(dirty)
+
+    def _write(self,dirty,operations):
+        today=timezone.localdate()
+        groups={}
+        for note_id,fields in dirty.items():
+            groups.setdefault(tuple(sorted(fields)),[]).append(
+                Note(id=note_id,updated_at=today,**fields)
+            )
+        if operations:
+            #ops of notes deleted while their room was open are dropped
+            existing=set(Note.objects.filter(
+                id__in={op.note_id for op in operations}
+            ).values_list('id',flat=True))
+            NoteOperation.objects.bulk_create(
+                [op for op in operations if op.note_id in existing]
+            )
+        for fields,notes in groups.items():
+            Note.objects.bulk_update(notes,list(fields)+['updated_at'])
+
+    def _write_each(self,taken):
+        dirty,operations=taken
+        note_ids=list(dict.fromkeys([*dirty,*(op.note_id for op in operations)]))
+        written=[]
+        for index,note_id in enumerate(note_ids):
+            fields={note_id:dirty[note_id]} if note_id in dirty else {}
+            ops=[op for op in operations if op.note_id==note_id]
+            try:
+                with transaction.atomic():
+                    self._write(fields,ops)
+            except IntegrityError as e:
+                #another writer already stored one of these revisions
+                print("write behind conflict error:",note_id,e)
+                with self.lock:
+                    self.conflicts.add(note_id)
+                continue
+            except Exception:
+                rest=set(note_ids[index:])
+                self.restore((
+                    {id:fields for id,fields in dirty.items() if id in rest},
+                    [op for op in operations if op.note_id in rest],
+                ))
+                invalidate_notes(written)
+                raise
+            written.append(note_id)
+        invalidate_notes(written)
+        return len([id for id in written if id in dirty])
+
+    async def resolve_conflicts(self):
+        with self.lock:
+            conflicts=self.conflicts
+            self.conflicts=set()
+        if conflicts and self.on_conflict is not None:
+            await self.on_conflict(conflicts)
+
+    async def flush(self,note_ids=None):
+        try:
+            return await database_sync_to_async(self.write)(self.take(note_ids))
+        finally:
+            await self.resolve_conflicts()
+
+    def flush_sync(self):
+        try:
+            self.write(self.take())
+        finally:
+            close_old_connections()
+
+
+write_behind=WriteBehind()
+atexit.register(write_behind.flush_sync)
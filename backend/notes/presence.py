@@ -0,0 +1,152 @@
+import json
+import time
+from django.conf import settings
+from notes.sharding import HashRing
+
+#who is connected to each note room, shared by every worker through redis.
+#each connection is a field of the room hash, refreshed by heartbeats, and a
+#second hash counts connections per user so join/leave only fire for the
+#first and last tab of a user. rooms are spread over the redis shards by consistent hashing
+
+
+def _ttl():
+    return getattr(settings,'PRESENCE_TTL',60)
+
+
+class RedisPresence:
+    def __init__(self,urls):
+        self.ring=HashRing(urls)
+        self.clients={}
+
+    def get_client(self,room):
+        url=self.ring.get(room)
+        client=self.clients.get(url)
+        if client is None:
+            from redis.asyncio import Redis
+            client=self.clients[url]=Redis.from_url(url,decode_responses=True)
+        return client
+
+    def keys(self,room):
+        return f'presence:{room}',f'presence:{room}:users'
+
+    async def join(self,room,channel,sender_id,username):
+        key,users_key=self.keys(room)
+        ttl=_ttl()
+        entry=json.dumps({'id':sender_id,'name':username,'seen':time.time()})
+        async with self.get_client(room).pipeline(transaction=True) as pipe:
+            pipe.hset(key,channel,entry)
+            pipe.hincrby(users_key,str(sender_id),1)
+            pipe.expire(key,ttl)
+            pipe.expire(users_key,ttl)
+            result=await pipe.execute()
+        return result[1]==1
+
+    async def touch(self,room,channel,sender_id,username):
+        key,users_key=self.keys(room)
+        ttl=_ttl()
+        entry=json.dumps({'id':sender_id,'name':username,'seen':time.time()})
+        async with self.get_client(room).pipeline(transaction=True) as pipe:
+            pipe.hset(key,channel,entry)
+            pipe.expire(key,ttl)
+            pipe.expire(users_key,ttl)
+            await pipe.execute()
+
+    async def leave(self,room,channel,sender_id):
+        #returns True when it was the last connection of that user in the room
+        key,users_key=self.keys(room)
+        client=self.get_client(room)
+        if not await client.hdel(key,channel):
+            return False
+        return await self._decrement(client,users_key,sender_id)
+
+    async def _decrement(self,client,users_key,sender_id):
+        left=await client.hincrby(users_key,str(sender_id),-1)
+        if left<=0:
+            await client.hdel(users_key,str(sender_id))
+            return True
+        return False
+
+    async def roster(self,room):
+        #full user list, only sent to a joining client. drops connections
+        #whose worker died without cleaning up and returns the users that went away
+        key,users_key=self.keys(room)
+        client=self.get_client(room)
+        deadline=time.time()-_ttl()
+        users={}
+        gone=[]
+        for channel,value in (await client.hgetall(key)).items():
+            entry=json.loads(value)
+            if entry['seen']<deadline:
+                if await client.hdel(key,channel) and await self._decrement(client,users_key,entry['id']):
+                    gone.append((entry['id'],entry['name']))
+                continue
+            users[str(entry['id'])]=entry['name']
+        return users,gone
+
+
+class MigratingPresence:
+    #while the shard list changes every connection is written to the room's shard on
+    #both lists, processes on either list find it. the first/last tab of a user is
+    #the first/last on both
+    def __init__(self,previous,current):
+        self.previous=previous
+        self.current=current
+
+    async def join(self,room,channel,sender_id,username):
+        first=await self.previous.join(room,channel,sender_id,username)
+        return await self.current.join(room,channel,sender_id,username) and first
+
+    async def touch(self,room,channel,sender_id,username):
+        await self.previous.touch(room,channel,sender_id,username)
+        await self.current.touch(room,channel,sender_id,username)
+
+    async def leave(self,room,channel,sender_id):
+        last=await self.previous.leave(room,channel,sender_id)
+        return await self.current.leave(room,channel,sender_id) and last
+
+    async def roster(self,room):
+        users,gone=await self.previous.roster(room)
+        current,current_gone=await self.current.roster(room)
+        users.update(current)
+        return users,[user for user in dict.fromkeys(gone+current_gone) if str(user[0]) not in users]
+
+
+class LocalPresence:
+    #single process fallback when no redis is configured (local dev, tests)
+    def __init__(self):
+        self.rooms={}
+
+    async def join(self,room,channel,sender_id,username):
+        members=self.rooms.setdefault(room,{})
+        first=all(entry['id']!=sender_id for entry in members.values())
+        members[channel]={'id':sender_id,'name':username}
+        return first
+
+    async def touch(self,room,channel,sender_id,username):
+        pass
+
+    async def leave(self,room,channel,sender_id):
+        members=self.rooms.get(room,{})
+        if members.pop(channel,None) is None:
+            return False
+        if not members:
+            self.rooms.pop(room,None)
+        return all(entry['id']!=sender_id for entry in members.values())
+
+    async def roster(self,room):
+        members=self.rooms.get(room,{})
+        return {str(entry['id']):entry['name'] for entry in members.values()},[]
+
+
+_presence=None
+
+
+def get_presence():
+    global _presence
+    if _presence is None:
+        urls=getattr(settings,'REDIS_SHARD_URLS',None)
+        previous=getattr(settings,'REDIS_SHARD_URLS_PREVIOUS',None)
+        _presence=RedisPresence(urls) if urls else LocalPresence()
+        if urls and previous and previous!=urls:
+            _presence=MigratingPresence(RedisPresence(previous),_presence)
+    return _presence
@@ -0,0 +1,131 @@
+import asyncio
+import weakref
+from channels.layers import get_channel_layer
+from channels.routing import get_default_application
+from notes.consumers import MOVED
+from notes.documents import room_name
+from notes.ownership import get_ownership,lease_ttl
+
+#routes note sockets to the worker that owns the room (notes.ownership). every worker
+#listens on a channel of the channel layer, a socket for a room owned elsewhere is
+#piped there: its asgi events go to the owner, which runs the NoteConsumer for it, and
+#the events the consumer sends come back on a channel of the tunnel. a room that is
+#unowned or owned here is served in process
+
+#scope entries sent through a tunnel, the owner's middleware rebuilds the rest
+SCOPE_KEYS=('type','path','raw_path','root_path','scheme','query_string','headers','subprotocols','client','server','asgi')
+
+
+class RoomHost:
+    #a worker's end of the tunnels, its channel name is what the leases hold
+    def __init__(self):
+        self.channel=None
+        self.sessions={}
+        self.task=None
+        self.starting=None
+
+    async def start(self):
+        layer=get_channel_layer()
+        self.channel=await layer.new_channel('rooms.')
+        self.task=asyncio.ensure_future(self.run(layer))
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def run(self,layer):
+        while True:
+            message=await layer.receive(self.channel)
+            if message['type']=='tunnel.open':
+                queue=self.sessions[message['reply']]=asyncio.Queue()
+                asyncio.ensure_future(self.serve(layer,message['reply'],message['scope'],queue))
+            elif message['type']=='tunnel.event':
+                queue=self.sessions.get(message['reply'])
+                if queue is not None:
+                    queue.put_nowait(message['event'])
+
+    async def serve(self,layer,reply,scope,queue):
+        async def send(event):
+            await layer.send(reply,{'type':'tunnel.event','event':event})
+        try:
+            await get_default_application()({**scope,'room_host':self.channel},queue.get,send)
+        except Exception as e:
+            print("room tunnel error:",e)
+        finally:
+            self.sessions.pop(reply,None)
+
+
+_hosts=weakref.WeakKeyDictionary()
+
+
+async def get_host():
+    #one per event loop like the channel layer
+    loop=asyncio.get_running_loop()
+    host=_hosts.get(loop)
+    if host is None:
+        host=_hosts[loop]=RoomHost()
+        host.starting=asyncio.ensure_future(host.start())
+    await host.starting
+    return host
+
+
+async def tunnel(scope,receive,send,room,owner):
+    layer=get_channel_layer()
+    reply=await layer.new_channel('tunnel.')
+    await layer.send(owner,{
+        'type':'tunnel.open',
+        'reply':reply,
+        'scope':{key:scope[key] for key in SCOPE_KEYS if key in scope},
+    })
+
+    async def upstream():
+        while True:
+            event=await receive()
+            await layer.send(owner,{'type':'tunnel.event','reply':reply,'event':event})
+            if event['type']=='websocket.disconnect':
+                return
+
+    async def downstream():
+        while True:
+            event=(await layer.receive(reply))['event']
+            await send(event)
+            if event['type']=='websocket.close':
+                return
+
+    async def watch():
+        #the owner died or gave the room up, the client reconnects to the next one
+        ownership=get_ownership()
+        while True:
+            await asyncio.sleep(lease_ttl()/3)
+            try:
+                if await ownership.owner(room)!=owner:
+                    break
+            except Exception as e:
+                print("room lease error:",e)
+        await send({'type':'websocket.close','code':MOVED})
+
+    tasks=[asyncio.ensure_future(task()) for task in (upstream,downstream,watch)]
+    try:
+        done,_=await asyncio.wait(tasks,return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+    if tasks[0] not in done:
+        #the consumer on the owner only ends with a disconnect
+        await layer.send(owner,{'type':'tunnel.event','reply':reply,'event':{'type':'websocket.disconnect','code':1006}})
+
+
+class RoomRouter:
+    def __init__(self,app):
+        self.app=app
+
+    async def __call__(self,scope,receive,send):
+        if 'room_host' in scope:
+            #tunnelled here by another worker
+            return await self.app(scope,receive,send)
+        host=await get_host()
+        room=room_name(scope['url_route']['kwargs']['note_id'])
+        owner=await get_ownership().owner(room)
+        if owner is None or owner==host.channel:
+            return await self.app({**scope,'room_host':host.channel},receive,send)
+        await tunnel(scope,receive,send,room,owner)
@@ -1,6 +1,7 @@
 from django.urls import path
 from . import consumers
+from .rooms import RoomRouter
 
 websocket_urlpatterns = [
-    path('notes/<int:note_id>/', consumers.NoteConsumer.as_asgi()),
+    path('notes/<int:note_id>/', RoomRouter(consumers.NoteConsumer.as_asgi())),
 ]
@@ -0,0 +1,100 @@
+import html
+import re
+from django.db import connection
+from django.db.models import Case,F,Func,IntegerField,Q,Value,When
+from django.contrib.postgres.search import SearchHeadline,SearchQuery,SearchRank
+from django.utils.html import escape,strip_tags
+from notes.models import Note
+
+#full text search over a user's notes. postgres ranks on the trigger maintained
+#search_vector through its gin index, other databases (sqlite for local runs and
+#tests) fall back to icontains with a fixed title > category > content ranking
+
+DEFAULT_LIMIT=20
+MAX_LIMIT=100
+SNIPPET_LENGTH=160
+
+LIST_FIELDS=['id','title','category','updated_at']
+
+
+def search_notes(user,text,limit=DEFAULT_LIMIT):
+    limit=max(1,min(limit,MAX_LIMIT))
+    if connection.vendor=='postgresql':
+        return _search_postgres(user,text,limit)
+    return _search_fallback(user,text,limit)
+
+
+def _search_postgres(user,text,limit):
+    query=SearchQuery(text,search_type='websearch',config='english')
+    hits=list(
+        Note.objects.filter(owner=user,search_vector=query)
+        .annotate(rank=SearchRank('search_vector',query))
+        .order_by('-rank','-updated_at')
+        .values(*LIST_FIELDS,'rank')[:limit]
+    )
+    #headlines read content, so only build them for the page being returned.
+    #they are built on the text without its tags, a note cannot add markup to results
+    snippets=dict(
+        Note.objects.filter(id__in=[hit['id'] for hit in hits])
+        .annotate(text=Func(
+            F('content'),Value('<[^>]*>'),Value(' '),Value('g'),function='regexp_replace',
+        ))
+        .annotate(snippet=SearchHeadline(
+            'text',query,config='english',
+            start_sel='<mark>',stop_sel='</mark>',max_words=30,min_words=10,
+        ))
+        .values_list('id','snippet')
+    )
+    for hit in hits:
+        hit['snippet']=_marked(snippets.get(hit['id'],''))
+    return hits
+
+
+def _marked(headline):
+    #the content had its tags stripped, so the only tags left are the marks.
+    #the text around them is escaped like the fallback's
+    return ''.join(
+        part if part in ('<mark>','</mark>') else escape(html.unescape(part))
+        for part in re.split('(</?mark>)',headline)
+    )
+
+
+def _search_fallback(user,text,limit):
+    terms=text.split()
+    if not terms:
+        return []
+    matches=Q()
+    for term in terms:
+        matches&=Q(title__icontains=term)|Q(category__icontains=term)|Q(content__icontains=term)
+    first=terms[0]
+    notes=(
+        Note.objects.filter(matches,owner=user)
+        .annotate(rank=Case(
+            When(title__icontains=first,then=Value(3)),
+            When(category__icontains=first,then=Value(2)),
+            default=Value(1),
+            output_field=IntegerField(),
+        ))
+        .order_by('-rank','-updated_at')
+        .values(*LIST_FIELDS,'rank','content')[:limit]
+    )
+    hits=[]
+    for note in notes:
+        note['snippet']=_highlight(html.unescape(strip_tags(note.pop('content'))),terms)
+        hits.append(note)
+    return hits
+
+
+def _highlight(text,terms):
+    pattern=re.compile('|'.join(re.escape(term) for term in terms),re.IGNORECASE)
+    match=pattern.search(text)
+    start=max(0,match.start()-SNIPPET_LENGTH//2) if match else 0
+    window=text[start:start+SNIPPET_LENGTH]
+    parts=[]
+    last=0
+    for found in pattern.finditer(window):
+        parts.append(escape(window[last:found.start()]))
+        parts.append('<mark>'+escape(found.group())+'</mark>')
+        last=found.end()
+    parts.append(escape(window[last:]))
+    return ''.join(parts)
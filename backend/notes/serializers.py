@@ -13,11 +13,18 @@ class NoteDetailSerializer(serializers.ModelSerializer):
     ownerName=serializers.SerializerMethodField(read_only=True)
     class Meta:
         model=Note
-        fields='__all__'
+        exclude=['search_vector']
     def get_ownerName(self,obj):
         return obj.owner.first_name
     
 class NoteShareSerializer(serializers.ModelSerializer):
     class Meta:
         model=Note
-        fields=['is_shared']
\ No newline at end of file
+        fields=['is_shared']
+
+
+class NoteBulkSerializer(serializers.ModelSerializer):
+    #validates the fields of one bulk create or update item
+    class Meta:
+        model=Note
+        fields=['title','content','category']
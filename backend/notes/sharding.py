@@ -0,0 +1,44 @@
+import bisect
+import hashlib
+
+#consistent hash ring over redis shards. every shard owns many points on the ring
+#so adding a shard only moves the rooms that land on its points (about 1/n of them)
+#instead of remapping almost every room like hash % n does.
+#a new shard list goes out in two rolling restarts: first REDIS_SHARD_URLS is the new
+#list and REDIS_SHARD_URLS_PREVIOUS the old one, then the previous list is removed.
+#with both set a room that moved is served on both shards (channel layer, presence and
+#room leases), so processes on either side of each restart still reach each other
+
+POINTS_PER_SHARD=160
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8],'big')
+
+
+class HashRing:
+    def __init__(self,shards,points=POINTS_PER_SHARD):
+        if not shards:
+            raise ValueError("HashRing needs at least one shard")
+        self.shards=list(shards)
+        ring=sorted(
+            (_hash(f'{shard}#{point}'),index)
+            for index,shard in enumerate(self.shards)
+            for point in range(points)
+        )
+        self.points=[point for point,_ in ring]
+        self.owners=[index for _,index in ring]
+
+    def index(self,key):
+        position=bisect.bisect(self.points,_hash(key))%len(self.points)
+        return self.owners[position]
+
+    def get(self,key):
+        return self.shards[self.index(key)]
+
+
+def room_key(name):
+    #note_12, asgi__group__note_12 and presence:note_12 all hash as note_12
+    #so a room's messages and presence live on the same shard
+    start=name.find('note_')
+    return name[start:].split(':')[0] if start!=-1 else name
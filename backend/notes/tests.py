@@ -1,3 +1,1188 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import random
+import time
+import zipfile
+import zlib
+from datetime import date
+from unittest import mock
+import fakeredis
+import msgpack
+from asgiref.sync import async_to_sync,iscoroutinefunction,sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError,IntegrityError
+from django.test import SimpleTestCase,TestCase,TransactionTestCase,override_settings
+from backend.asgi import application
+from backend.profiling import QueryProfilerMiddleware,query_budget
+from notes.bulk import apply_operations
+from notes.delta import apply_ops,transform
+from notes.documents import LiveDocument,RoomMoved,StaleRevision,acquire_document,documents
+from notes.layers import LocalFanoutChannelLayer,LocalFanoutShardConnection
+from notes.models import Note,NoteOperation
+from notes.oplog import load_note,replay_notes,save_note
+from notes.outbox import Outbox
+from notes.ownership import LocalOwnership,MigratingOwnership,get_ownership
+from notes.presence import LocalPresence,MigratingPresence,RedisPresence,get_presence
+from notes.persistence import WriteBehind,write_behind
+from notes.rooms import RoomHost
+from notes.search import _marked
+from notes.sharding import HashRing,room_key
+from notes.transfer import export_ndjson
+from notes.wire import DEFLATE,MAX_FRAME,FrameTooLarge,decode,encode_binary
+from users.tests import login
+from users.views import MyTokenObtainPairSerializer
 
-# Create your tests here.
+
+def cookie_header(user):
+    token=MyTokenObtainPairSerializer.get_token(user).access_token
+    return [(b'cookie',f'access_token={token}'.encode())]
+
+
+class NoteSocketTestCase(TransactionTestCase):
+    def setUp(self):
+        self.owner=User.objects.create(username='owner',email='owner@example.com')
+        self.other=User.objects.create(username='other',email='other@example.com')
+        self.note=Note.objects.create(owner=self.owner,title='note',content='abc')
+
+    def tearDown(self):
+        documents.clear()
+        write_behind.take()
+        get_ownership().owners.clear()
+
+    async def connect(self,user=None,note=None):
+        note=note or self.note
+        communicator=WebsocketCommunicator(
+            application,
+            f'/ws/notes/{note.id}/',
+            headers=cookie_header(user) if user else [],
+        )
+        connected,_=await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self,communicator):
+        return json.loads(await communicator.receive_from(timeout=2))
+
+
+class NoteSocketAccessTest(NoteSocketTestCase):
+    async def assertRefused(self,communicator):
+        output=await communicator.receive_output(timeout=2)
+        self.assertEqual(output,{'type':'websocket.close','code':4403})
+        await communicator.disconnect()
+
+    async def test_anonymous_is_refused(self):
+        communicator=await self.connect()
+        await self.assertRefused(communicator)
+        self.assertNotIn(self.note.id,documents)
+
+    async def test_bad_token_is_refused(self):
+        communicator=WebsocketCommunicator(
+            application,f'/ws/notes/{self.note.id}/',headers=[(b'cookie',b'access_token=nope')]
+        )
+        await communicator.connect()
+        await self.assertRefused(communicator)
+
+    async def test_private_note_of_someone_else_is_refused(self):
+        communicator=await self.connect(self.other)
+        await communicator.send_to(text_data=json.dumps({'content':'defaced'}))
+        await self.assertRefused(communicator)
+        self.assertEqual((await Note.objects.aget(id=self.note.id)).content,'abc')
+
+    async def test_owner_can_sync(self):
+        communicator=await self.connect(self.owner)
+        await communicator.send_to(text_data=json.dumps({'type':'sync'}))
+        self.assertEqual(await self.receive(communicator),{'type':'snapshot','rev':0,'content':'abc'})
+        await communicator.disconnect()
+
+    async def test_shared_note_is_open_to_signed_in_users(self):
+        await Note.objects.filter(id=self.note.id).aupdate(is_shared=True)
+        communicator=await self.connect(self.other)
+        await communicator.send_to(text_data=json.dumps({'type':'op','rev':0,'ops':[{'pos':3,'insert':'d'}]}))
+        self.assertEqual(await self.receive(communicator),{'type':'ack','rev':1})
+        await communicator.disconnect()
+        self.assertEqual(await sync_to_async(load_note)(self.note.id),('abcd',1,1))
+
+    async def test_presence_is_the_signed_in_user(self):
+        await Note.objects.filter(id=self.note.id).aupdate(is_shared=True)
+        self.other.first_name='Other'
+        await self.other.asave()
+        communicator=await self.connect(self.other)
+        await communicator.send_to(text_data=json.dumps({'type':'join','senderId':self.owner.id,'username':'owner'}))
+        self.assertEqual(await self.receive(communicator),{'type':'presence','users':{str(self.other.id):'Other'}})
+        self.assertEqual(
+            await self.receive(communicator),{'type':'join','username':'Other','senderId':self.other.id},
+        )
+        await communicator.disconnect()
+        self.assertEqual(await get_presence().roster(f'note_{self.note.id}'),({},[]))
+
+    async def test_conflicting_revision_reloads_the_room(self):
+        communicator=await self.connect(self.owner)
+        await communicator.send_to(text_data=json.dumps({'type':'sync'}))
+        await self.receive(communicator)
+        await communicator.send_to(text_data=json.dumps({'type':'op','rev':0,'ops':[{'pos':3,'insert':'d'}]}))
+        self.assertEqual(await self.receive(communicator),{'type':'ack','rev':1})
+        #puts the rev 1 snapshot in the frame cache
+        await communicator.send_to(text_data=json.dumps({'type':'sync'}))
+        self.assertEqual(await self.receive(communicator),{'type':'snapshot','rev':1,'content':'abcd'})
+        #another writer stored rev 1 first
+        await NoteOperation.objects.acreate(note=self.note,rev=1,ops=[{'pos':0,'insert':'x'}])
+        await Note.objects.filter(id=self.note.id).aupdate(rev=1)
+        await write_behind.flush()
+        self.assertEqual(await self.receive(communicator),{'type':'snapshot','rev':1,'content':'xabc'})
+        self.assertEqual(write_behind.take(),({},[]))
+        await communicator.disconnect()
+
+
+class MetricsTest(NoteSocketTestCase):
+    async def scrape(self,**headers):
+        response=await self.async_client.get('/metrics',headers=headers)
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response['Content-Type'],'text/plain; version=0.0.4; charset=utf-8')
+        samples={}
+        kinds={}
+        for line in response.content.decode().splitlines():
+            if line.startswith('# TYPE '):
+                _,_,name,kind=line.split(' ')
+                kinds[name]=kind
+            elif not line.startswith('# HELP '):
+                name,value=line.rsplit(' ',1)
+                self.assertRegex(name,r'^[a-z_]+(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})?$')
+                #every sample belongs to a metric declared above it
+                self.assertTrue(any(name.startswith(metric) for metric in kinds),name)
+                samples[name]=float(value)
+        return samples,kinds
+
+    async def test_scrape_counts_connections_and_messages(self):
+        before,kinds=await self.scrape()
+        self.assertEqual(kinds['notes_ws_connections'],'gauge')
+        self.assertEqual(kinds['notes_ws_messages_received_total'],'counter')
+        self.assertEqual(kinds['notes_ws_handler_seconds'],'histogram')
+        communicator=await self.connect(self.owner)
+        await communicator.send_to(text_data=json.dumps({'type':'sync'}))
+        await self.receive(communicator)
+        await communicator.send_to(text_data=json.dumps({'type':'op','rev':0,'ops':[{'pos':3,'insert':'d'}]}))
+        await self.receive(communicator)
+        after,_=await self.scrape()
+        self.assertEqual(after['notes_ws_connections']-before.get('notes_ws_connections',0),1)
+        self.assertEqual(after['notes_ws_rooms'],1)
+        for kind in ('sync','op'):
+            name=f'notes_ws_messages_received_total{{type="{kind}"}}'
+            self.assertEqual(after[name]-before.get(name,0),1)
+        name='notes_ws_handler_seconds_count{handler="receive"}'
+        self.assertEqual(after[name]-before.get(name,0),2)
+        self.assertEqual(after['notes_ws_received_bytes_bucket{le="+Inf"}'],after['notes_ws_received_bytes_count'])
+        await communicator.disconnect()
+        done,_=await self.scrape()
+        self.assertEqual(done['notes_ws_connections'],before.get('notes_ws_connections',0))
+        self.assertEqual(done['notes_ws_rooms'],0)
+
+    @override_settings(METRICS_TOKEN='secret')
+    async def test_scrape_needs_the_token(self):
+        response=await self.async_client.get('/metrics',headers={'Authorization':'Bearer wrong'})
+        self.assertEqual(response.status_code,403)
+        await self.scrape(Authorization='Bearer secret')
+
+
+class NoteRoomTest(NoteSocketTestCase):
+    #one event loop stands in for two workers, the second one is a RoomHost
+    async def test_room_lease_is_held_while_open(self):
+        room=f'note_{self.note.id}'
+        communicator=await self.connect(self.owner)
+        owner=await get_ownership().owner(room)
+        self.assertIsNotNone(owner)
+        self.assertEqual(documents[self.note.id].node,owner)
+        await communicator.disconnect()
+        self.assertIsNone(await get_ownership().owner(room))
+
+    async def test_socket_on_another_worker_is_tunnelled_to_the_owner(self):
+        host=RoomHost()
+        await host.start()
+        await get_ownership().claim(f'note_{self.note.id}',host.channel)
+        try:
+            communicator=await self.connect(self.owner)
+            await communicator.send_to(text_data=json.dumps({'type':'sync'}))
+            self.assertEqual(await self.receive(communicator),{'type':'snapshot','rev':0,'content':'abc'})
+            await communicator.send_to(text_data=json.dumps({'type':'op','rev':0,'ops':[{'pos':3,'insert':'d'}]}))
+            self.assertEqual(await self.receive(communicator),{'type':'ack','rev':1})
+            #the consumer runs in the owner's host
+            self.assertEqual(documents[self.note.id].node,host.channel)
+            self.assertEqual(len(host.sessions),1)
+            await communicator.disconnect()
+            for _ in range(100):
+                if self.note.id not in documents:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertEqual(await sync_to_async(load_note)(self.note.id),('abcd',1,1))
+            self.assertIsNone(await get_ownership().owner(f'note_{self.note.id}'))
+        finally:
+            host.stop()
+
+    @override_settings(NOTES_OWNER_TTL=0.3)
+    async def test_tunnel_closes_when_the_owner_is_gone(self):
+        room=f'note_{self.note.id}'
+        #a worker that died with the lease
+        await get_ownership().claim(room,'rooms.inmemory!gone')
+        communicator=WebsocketCommunicator(
+            application,f'/ws/notes/{self.note.id}/',headers=cookie_header(self.owner)
+        )
+        await communicator.send_input({'type':'websocket.connect'})
+        #routed into a tunnel that never answers
+        self.assertTrue(await communicator.receive_nothing(timeout=0.05))
+        await get_ownership().release(room,'rooms.inmemory!gone')
+        self.assertEqual(await communicator.receive_output(timeout=2),{'type':'websocket.close','code':4012})
+        await communicator.wait()
+
+    async def test_room_taken_over_meanwhile_is_refused(self):
+        await get_ownership().claim(f'note_{self.note.id}','rooms.inmemory!other')
+        with self.assertRaises(RoomMoved):
+            await acquire_document(self.note.id,'specific.inmemory!a','rooms.inmemory!here')
+        self.assertNotIn(self.note.id,documents)
+
+    @override_settings(NOTES_OWNER_TTL=0.3)
+    async def test_lost_lease_sends_clients_to_the_new_owner(self):
+        communicator=await self.connect(self.owner)
+        await communicator.send_to(text_data=json.dumps({'type':'op','rev':0,'ops':[{'pos':3,'insert':'d'}]}))
+        self.assertEqual(await self.receive(communicator),{'type':'ack','rev':1})
+        #the lease expired during a stall and another worker took the room
+        get_ownership().owners[f'note_{self.note.id}']='rooms.inmemory!other'
+        self.assertEqual(await communicator.receive_output(timeout=2),{'type':'websocket.close','code':4012})
+        self.assertNotIn(self.note.id,documents)
+        self.assertEqual(await sync_to_async(load_note)(self.note.id),('abcd',1,1))
+        await communicator.disconnect()
+
+
+class ShardMigrationTest(SimpleTestCase):
+    #local stores stand in for the room's shard on the old and the new list
+    async def test_lease_is_taken_on_both_lists(self):
+        old,new=LocalOwnership(),LocalOwnership()
+        migrating=MigratingOwnership(old,new)
+        self.assertEqual(await migrating.claim('note_1','a'),'a')
+        self.assertEqual((await old.owner('note_1'),await new.owner('note_1')),('a','a'))
+        #workers on either list see it
+        self.assertEqual(await old.claim('note_1','b'),'a')
+        self.assertEqual(await new.claim('note_1','b'),'a')
+        await migrating.release('note_1','a')
+        self.assertEqual(await migrating.owned(['note_1']),set())
+
+    async def test_lease_held_on_one_list_wins(self):
+        old,new=LocalOwnership(),LocalOwnership()
+        migrating=MigratingOwnership(old,new)
+        await new.claim('note_1','b')
+        self.assertEqual(await migrating.claim('note_1','a'),'b')
+        self.assertIsNone(await old.owner('note_1'))
+        await old.claim('note_2','c')
+        self.assertEqual(await migrating.claim('note_2','a'),'c')
+        self.assertEqual(await migrating.owner('note_2'),'c')
+
+    async def test_presence_is_merged(self):
+        old,new=LocalPresence(),LocalPresence()
+        migrating=MigratingPresence(old,new)
+        await old.join('note_1','x',1,'one')
+        self.assertFalse(await migrating.join('note_1','y',1,'one'))
+        self.assertTrue(await migrating.join('note_1','z',2,'two'))
+        self.assertEqual(await new.roster('note_1'),({'1':'one','2':'two'},[]))
+        self.assertEqual(await migrating.roster('note_1'),({'1':'one','2':'two'},[]))
+        self.assertFalse(await migrating.leave('note_1','y',1))
+        self.assertTrue(await migrating.leave('note_1','z',2))
+
+
+class HashRingTest(SimpleTestCase):
+    shards=['redis://shard-a:6379/0','redis://shard-b:6379/0','redis://shard-c:6379/0']
+    keys=[f'note_{number}' for number in range(5000)]
+
+    def placement(self,ring):
+        return {key:ring.get(key) for key in self.keys}
+
+    def test_placement_is_stable(self):
+        placement=self.placement(HashRing(self.shards))
+        #same in every process and whatever the order of the list
+        self.assertEqual(self.placement(HashRing(self.shards)),placement)
+        self.assertEqual(self.placement(HashRing(self.shards[::-1])),placement)
+        for shard in self.shards:
+            self.assertGreater(list(placement.values()).count(shard),len(self.keys)/5)
+
+    def test_room_names_hash_like_the_room(self):
+        ring=HashRing(self.shards)
+        for key in self.keys[:200]:
+            self.assertEqual(ring.get(room_key(f'asgi__group__{key}')),ring.get(key))
+            self.assertEqual(ring.get(room_key(f'presence:{key}:users')),ring.get(key))
+
+    def test_adding_a_shard_only_moves_keys_to_it(self):
+        before=self.placement(HashRing(self.shards))
+        added='redis://shard-d:6379/0'
+        after=self.placement(HashRing(self.shards+[added]))
+        moved=[key for key in self.keys if before[key]!=after[key]]
+        self.assertEqual({after[key] for key in moved},{added})
+        self.assertLess(abs(len(moved)/len(self.keys)-1/4),0.08)
+
+    def test_removing_a_shard_only_moves_its_keys(self):
+        before=self.placement(HashRing(self.shards))
+        removed=self.shards[1]
+        after=self.placement(HashRing([shard for shard in self.shards if shard!=removed]))
+        moved=[key for key in self.keys if before[key]!=after[key]]
+        self.assertEqual(moved,[key for key in self.keys if before[key]==removed])
+
+    def test_empty_ring_is_refused(self):
+        with self.assertRaises(ValueError):
+            HashRing([])
+
+    async def test_previous_shard_is_only_set_for_names_that_moved(self):
+        layer=LocalFanoutChannelLayer(hosts=self.shards,previous_hosts=self.shards[:2])._get_layer()
+        old=HashRing(self.shards[:2])
+        moved=0
+        for key in self.keys[:500]:
+            name=layer._get_group_channel_name(key)
+            current=layer._get_shard(name)
+            previous=layer._get_previous_shard(name)
+            if old.get(key)==current.host['address']:
+                self.assertIsNone(previous)
+            else:
+                moved+=1
+                #the shard the old list puts it on, on the connection both lists share
+                self.assertEqual(previous.host['address'],old.get(key))
+                self.assertIn(previous,layer._shards)
+        self.assertTrue(0<moved<500)
+
+    async def test_previous_shard_without_a_migration(self):
+        layer=LocalFanoutChannelLayer(hosts=self.shards)._get_layer()
+        self.assertIsNone(layer._get_previous_shard('asgi__group__note_1'))
+        layer=LocalFanoutChannelLayer(hosts=self.shards[:2],previous_hosts=self.shards)._get_layer()
+        names=[layer._get_group_channel_name(key) for key in self.keys[:500]]
+        removed=[name for name in names if layer._get_previous_shard(name) is not None]
+        #a removed shard has its own connection, it is not in the new list
+        self.assertTrue(removed)
+        self.assertEqual({layer._get_previous_shard(name).host['address'] for name in removed},{self.shards[2]})
+        self.assertNotIn(layer._get_previous_shard(removed[0]),layer._shards)
+
+
+class LocalFanoutLayerTest(SimpleTestCase):
+    #two layers on one loop stand in for two processes on the same redis
+    def setUp(self):
+        servers={}
+
+        def ensure_redis(connection):
+            if connection._redis is None:
+                server=servers.setdefault(connection.host['address'],fakeredis.FakeServer())
+                connection._redis=fakeredis.FakeAsyncRedis(server=server)
+                connection._pubsub=connection._redis.pubsub()
+        patcher=mock.patch.object(LocalFanoutShardConnection,'_ensure_redis',ensure_redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.here=LocalFanoutChannelLayer(hosts=['redis://shard-a:6379/0'])
+        self.there=LocalFanoutChannelLayer(hosts=['redis://shard-a:6379/0'])
+
+    async def asyncTearDown(self):
+        await self.here.flush()
+        await self.there.flush()
+
+    async def join(self,layer,group):
+        channel=await layer.new_channel()
+        await layer.group_add(group,channel)
+        return channel
+
+    def pending(self,layer,channel):
+        queue=layer._get_layer().channels[channel]
+        return [queue.get_nowait() for _ in range(queue.qsize())]
+
+    async def test_group_send_is_delivered_once_in_process_and_once_elsewhere(self):
+        first=await self.join(self.here,'note_1')
+        second=await self.join(self.here,'note_1')
+        remote=await self.join(self.there,'note_1')
+        message={'type':'note_delta','rev':1,'ops':[{'pos':0,'insert':'a'}]}
+        await self.here.group_send('note_1',message)
+        #in process without a trip through redis
+        self.assertEqual(self.pending(self.here,first),[message])
+        self.assertEqual(self.pending(self.here,second),[message])
+        self.assertEqual(await asyncio.wait_for(self.there.receive(remote),2),message)
+        #the copy published for the other process does not come back here
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.pending(self.here,first)+self.pending(self.here,second),[])
+
+    async def test_in_process_copies_are_independent(self):
+        first=await self.join(self.here,'note_1')
+        second=await self.join(self.here,'note_1')
+        await self.here.group_send('note_1',{'type':'note_delta','rev':1})
+        received=self.pending(self.here,first)[0]
+        received['rev']=2
+        self.assertEqual(self.pending(self.here,second),[{'type':'note_delta','rev':1}])
+
+    async def test_messages_from_another_process_reach_local_members(self):
+        local=await self.join(self.here,'note_1')
+        await self.join(self.there,'note_1')
+        await self.there.group_send('note_1',{'type':'user_left','senderId':1})
+        self.assertEqual(await asyncio.wait_for(self.here.receive(local),2),{'type':'user_left','senderId':1})
+        channel=await self.here.new_channel()
+        await self.there.send(channel,{'type':'tunnel.event'})
+        self.assertEqual(await asyncio.wait_for(self.here.receive(channel),2),{'type':'tunnel.event'})
+
+
+class RedisPresenceTest(SimpleTestCase):
+    def setUp(self):
+        self.presence=RedisPresence(['redis://shard-a:6379/0'])
+        self.redis=self.presence.clients['redis://shard-a:6379/0']=fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(),decode_responses=True)
+
+    async def test_join_and_leave_fire_for_the_first_and_last_tab(self):
+        self.assertTrue(await self.presence.join('note_1','tab.a',1,'Ann'))
+        self.assertFalse(await self.presence.join('note_1','tab.b',1,'Ann'))
+        self.assertTrue(await self.presence.join('note_1','tab.c',2,'Bob'))
+        self.assertEqual(await self.presence.roster('note_1'),({'1':'Ann','2':'Bob'},[]))
+        self.assertFalse(await self.presence.leave('note_1','tab.a',1))
+        self.assertTrue(await self.presence.leave('note_1','tab.b',1))
+        #a second leave of the same connection changes nothing
+        self.assertFalse(await self.presence.leave('note_1','tab.b',1))
+        self.assertEqual(await self.presence.roster('note_1'),({'2':'Bob'},[]))
+        self.assertEqual(await self.redis.hgetall('presence:note_1:users'),{'2':'1'})
+
+    @override_settings(PRESENCE_TTL=30)
+    async def test_keys_expire_without_heartbeats(self):
+        await self.presence.join('note_1','tab.a',1,'Ann')
+        self.assertLessEqual(await self.redis.ttl('presence:note_1'),30)
+        self.assertLessEqual(await self.redis.ttl('presence:note_1:users'),30)
+
+    async def test_roster_drops_connections_of_dead_workers(self):
+        await self.presence.join('note_1','tab.a',1,'Ann')
+        await self.presence.join('note_1','tab.b',2,'Bob')
+        #the worker of tab.b stopped sending heartbeats
+        await self.redis.hset('presence:note_1','tab.b',json.dumps({'id':2,'name':'Bob','seen':time.time()-120}))
+        self.assertEqual(await self.presence.roster('note_1'),({'1':'Ann'},[(2,'Bob')]))
+        self.assertEqual(await self.redis.hkeys('presence:note_1'),['tab.a'])
+        self.assertFalse(await self.presence.leave('note_1','tab.b',2))
+
+    async def test_rooms_are_spread_over_the_shards(self):
+        presence=RedisPresence(['redis://shard-a:6379/0','redis://shard-b:6379/0'])
+        for url in presence.ring.shards:
+            presence.clients[url]=fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer(),decode_responses=True)
+        rooms=[f'note_{number}' for number in range(20)]
+        for room in rooms:
+            await presence.join(room,'tab.a',1,'Ann')
+        for url,client in presence.clients.items():
+            stored=await client.keys('presence:*:users')
+            self.assertEqual(sorted(stored),sorted(f'presence:{room}:users' for room in rooms if presence.ring.get(room)==url))
+            self.assertTrue(stored)
+
+
+class WriteBehindTest(TestCase):
+    def setUp(self):
+        user=User.objects.create(username='owner',email='owner@example.com')
+        self.first=Note.objects.create(owner=user,title='first',content='abc')
+        self.second=Note.objects.create(owner=user,title='second',content='abc')
+        self.write_behind=WriteBehind()
+
+    def test_write(self):
+        self.write_behind.append(self.first.id,1,[{'pos':3,'insert':'d'}])
+        self.write_behind.mark(self.first.id,title='renamed')
+        self.assertEqual(self.write_behind.write(self.write_behind.take()),1)
+        self.first.refresh_from_db()
+        self.assertEqual((self.first.title,self.first.rev),('renamed',1))
+        self.assertEqual(load_note(self.first.id),('abcd',1,0))
+
+    def test_conflict_only_drops_that_note(self):
+        NoteOperation.objects.create(note=self.first,rev=1,ops=[{'pos':0,'insert':'x'}])
+        self.write_behind.append(self.first.id,1,[{'pos':3,'insert':'d'}])
+        self.write_behind.append(self.second.id,1,[{'pos':3,'insert':'d'}])
+        self.write_behind.write(self.write_behind.take())
+        self.assertEqual(self.write_behind.conflicts,{self.first.id})
+        self.assertEqual(self.write_behind.take(),({},[]))
+        self.assertEqual(NoteOperation.objects.get(note=self.first,rev=1).ops,[{'pos':0,'insert':'x'}])
+        self.assertEqual(load_note(self.second.id),('abcd',1,0))
+
+
+class NoteTailTest(TestCase):
+    #content 'abc' is the snapshot at rev 0, 'd' and 'e' are the stored tail
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        self.note=Note.objects.create(owner=self.user,title='note',content='abc',rev=2,snapshot_rev=0)
+        NoteOperation.objects.bulk_create([
+            NoteOperation(note=self.note,rev=1,ops=[{'pos':3,'insert':'d'}]),
+            NoteOperation(note=self.note,rev=2,ops=[{'pos':4,'insert':'e'}]),
+        ])
+        login(self.client,self.user)
+
+    def put(self,content,etag):
+        return self.client.put(
+            f'/notes/{self.note.id}/',
+            {'title':'note','category':'','content':content},
+            content_type='application/json',
+            HTTP_IF_MATCH=etag,
+        )
+
+    def test_detail_replays_the_tail(self):
+        response=self.client.get(f'/notes/{self.note.id}/')
+        self.assertEqual(response.json()['content'],'abcde')
+        self.assertEqual(response['ETag'],f'"{self.note.id}.1.2"')
+
+    def test_put_diffs_against_the_replayed_text(self):
+        etag=self.client.get(f'/notes/{self.note.id}/')['ETag']
+        response=self.put('abcdeX',etag)
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json()['content'],'abcdeX')
+        self.assertEqual(load_note(self.note.id),('abcdeX',3,3))
+        self.assertEqual(NoteOperation.objects.get(note=self.note,rev=3).ops,[{'pos':5,'insert':'X'}])
+        self.assertEqual(self.client.get(f'/notes/{self.note.id}/').json()['content'],'abcdeX')
+
+    def test_put_against_the_snapshot_rev_is_refused(self):
+        response=self.put('abcX',f'"{self.note.id}.1.0"')
+        self.assertEqual(response.status_code,412)
+
+    def test_put_racing_on_the_same_etag_is_refused(self):
+        #both requests passed the If-Match check before either wrote
+        stale=Note.objects.get(id=self.note.id)
+        replay_notes([stale])
+        etag=self.client.get(f'/notes/{self.note.id}/')['ETag']
+        self.assertEqual(self.put('abcdeX',etag).status_code,200)
+        stale.title='other'
+        stale.version=2
+        self.assertFalse(save_note(stale,1,2,'abcdeY'))
+        self.assertEqual(load_note(self.note.id),('abcdeX',3,3))
+        self.assertEqual(NoteOperation.objects.filter(note=self.note).count(),3)
+
+    def test_put_writes_the_operation_and_the_note_together(self):
+        note=Note.objects.get(id=self.note.id)
+        replay_notes([note])
+        #an operation row at the next rev makes the insert fail after the note update
+        NoteOperation.objects.create(note=self.note,rev=3,ops=[{'pos':0,'insert':'x'}])
+        note.version=2
+        with self.assertRaises(IntegrityError):
+            save_note(note,1,2,'abcdeX')
+        self.note.refresh_from_db()
+        self.assertEqual((self.note.content,self.note.rev,self.note.version),('abc',2,1))
+
+    def test_put_without_precondition_writes_over_a_newer_state(self):
+        Note.objects.filter(id=self.note.id).update(version=5)
+        response=self.client.put(
+            f'/notes/{self.note.id}/',
+            {'title':'note','category':'','content':'abcdeX'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(response.json()['version'],6)
+
+    def test_bulk_update_keeps_the_tail(self):
+        response=self.client.post(
+            '/notes/bulk/',
+            {'operations':[{'op':'update','id':self.note.id,'content':'abcdeX'}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['results'][0]['status'],'updated')
+        self.assertEqual(load_note(self.note.id),('abcdeX',3,3))
+
+    def test_load_replays_the_tail(self):
+        self.assertEqual(load_note(self.note.id),('abcde',2,0))
+
+    def test_compaction_folds_the_tail(self):
+        call_command('compact_notes',stdout=io.StringIO())
+        self.note.refresh_from_db()
+        self.assertEqual((self.note.content,self.note.rev,self.note.snapshot_rev),('abcde',2,2))
+
+    async def test_export_replays_the_tail(self):
+        body=b''.join([chunk async for chunk in export_ndjson(self.user)])
+        lines=[json.loads(line) for line in body.splitlines()]
+        self.assertEqual([line['content'] for line in lines],['abcde'])
+
+
+class LiveNoteResponseTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        self.note=Note.objects.create(owner=self.user,title='note',content='abc')
+        login(self.client,self.user)
+        documents[self.note.id]=LiveDocument(self.note.id,'abc')
+
+    def tearDown(self):
+        documents.clear()
+        write_behind.take()
+
+    def test_put_on_a_live_note_serves_what_the_etag_names(self):
+        self.client.get(f'/notes/{self.note.id}/')
+        documents[self.note.id].apply(0,[{'pos':3,'insert':'d'}])
+        response=self.client.put(
+            f'/notes/{self.note.id}/',
+            {'title':'renamed','category':'work','content':'ignored'},
+            content_type='application/json',
+        )
+        etag=response['ETag']
+        response=self.client.get(f'/notes/{self.note.id}/')
+        self.assertEqual(response['ETag'],etag)
+        self.assertEqual(etag,f'"{self.note.id}.2.1"')
+        data=response.json()
+        self.assertEqual((data['title'],data['category'],data['version'],data['rev'],data['content']),('renamed','work',2,1,'abcd'))
+        self.assertEqual(self.client.get(f'/notes/{self.note.id}/',HTTP_IF_NONE_MATCH=etag).status_code,304)
+
+
+class RemoteRoomTest(TestCase):
+    #the room is open in another worker, nothing about it is in this process
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        self.note=Note.objects.create(owner=self.user,title='note',content='abc')
+        login(self.client,self.user)
+        async_to_sync(get_ownership().claim)(f'note_{self.note.id}','rooms.inmemory!other')
+
+    def tearDown(self):
+        get_ownership().owners.clear()
+
+    def test_put_writes_the_rest_right_away(self):
+        response=self.client.put(
+            f'/notes/{self.note.id}/',
+            {'title':'renamed','category':'home','content':'ignored'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(write_behind.pending(self.note.id),{})
+        self.note.refresh_from_db()
+        self.assertEqual((self.note.title,self.note.category,self.note.version,self.note.content),('renamed','home',2,'abc'))
+        data=self.client.get(f'/notes/{self.note.id}/').json()
+        self.assertEqual((data['title'],data['content']),('renamed','abc'))
+
+    def test_bulk_writes_the_rest_right_away(self):
+        response=self.client.post(
+            '/notes/bulk/',
+            {'operations':[{'op':'update','id':self.note.id,'title':'renamed','content':'ignored'}]},
+            content_type='application/json',
+        )
+        self.assertEqual(response.json()['results'][0]['status'],'updated')
+        self.assertEqual(write_behind.pending(self.note.id),{})
+        self.note.refresh_from_db()
+        self.assertEqual((self.note.title,self.note.version,self.note.content),('renamed',2,'abc'))
+
+
+class PaginationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        other=User.objects.create(username='other',email='other@example.com')
+        Note.objects.create(owner=other,title='foreign',content='abc')
+        login(self.client,self.user)
+        self.client.cookies['db_primary']='1'
+
+    def notes(self,*days):
+        notes=[Note.objects.create(owner=self.user,title=f'note {index}',content='abc') for index in range(len(days))]
+        for note,day in zip(notes,days):
+            Note.objects.filter(id=note.id).update(updated_at=date(2024,1,day))
+        return [note.id for note in notes]
+
+    def pages(self,limit):
+        pages=[]
+        cursor=None
+        while True:
+            params={'limit':limit}
+            if cursor:
+                params['cursor']=cursor
+            response=self.client.get('/notes/',params)
+            self.assertEqual(response.status_code,200)
+            data=response.json()
+            pages.append([note['id'] for note in data['results']])
+            cursor=data['next']
+            if cursor is None:
+                return pages
+
+    def test_pages_go_forward_newest_first(self):
+        ids=self.notes(3,1,5,2,4)
+        pages=self.pages(2)
+        self.assertEqual(pages,[[ids[2],ids[4]],[ids[0],ids[3]],[ids[1]]])
+
+    def test_tied_dates_are_ordered_by_id(self):
+        ids=self.notes(1,2,2,2,2,1)
+        pages=self.pages(2)
+        #no note repeated or skipped across a page boundary inside the tie
+        self.assertEqual(sum(pages,[]),[ids[4],ids[3],ids[2],ids[1],ids[5],ids[0]])
+        self.assertEqual(len(pages),3)
+
+    def test_last_full_page_has_no_next(self):
+        self.notes(1,2)
+        response=self.client.get('/notes/',{'limit':2})
+        self.assertIsNone(response.json()['next'])
+
+    def test_bad_cursor_or_limit_is_refused(self):
+        self.notes(1,2,3)
+        bad=[
+            {'cursor':'not base64!'},
+            {'cursor':base64.urlsafe_b64encode(b'2024-01-01').decode()},
+            {'cursor':base64.urlsafe_b64encode(b'yesterday,1').decode()},
+            {'cursor':base64.urlsafe_b64encode(b'2024-01-01,x').decode()},
+            {'cursor':base64.urlsafe_b64encode(b'\xff\xfe').decode()},
+            {'limit':'0'},
+            {'limit':'ten'},
+        ]
+        for params in bad:
+            response=self.client.get('/notes/',params)
+            self.assertEqual(response.status_code,400,params)
+            self.assertEqual(response.json(),{'message':'Invalid page'})
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        self.other=User.objects.create(username='other',email='other@example.com')
+        Note.objects.create(owner=self.user,title='groceries',content='<p>milk and bread</p>')
+        Note.objects.create(owner=self.user,title='work',category='groceries',content='<p>list</p>')
+        Note.objects.create(owner=self.user,title='plans',content='<p>buy groceries &amp; more</p>')
+        Note.objects.create(owner=self.other,title='groceries',content='<p>not mine</p>')
+        login(self.client,self.user)
+        #reads stay on the primary
+        self.client.cookies['db_primary']='1'
+
+    def search(self,**params):
+        return self.client.get('/notes/search/',params)
+
+    def test_results_are_ranked_and_limited_to_the_owner(self):
+        results=self.search(q='groceries').json()
+        self.assertEqual([hit['title'] for hit in results],['groceries','work','plans'])
+        self.assertEqual(len(self.search(q='groceries',limit=2).json()),2)
+
+    def test_snippet_is_escaped_except_the_marks(self):
+        Note.objects.create(
+            owner=self.user,title='x',
+            content='<img src=x onerror=alert(1)><p>a &lt;b&gt; needle</p>',
+        )
+        self.assertEqual(self.search(q='needle').json()[0]['snippet'],'a &lt;b&gt; <mark>needle</mark>')
+
+    def test_postgres_headline_is_escaped_except_the_marks(self):
+        self.assertEqual(
+            _marked('a &amp; &lt;script&gt; <mark>needle</mark>'),
+            'a &amp; &lt;script&gt; <mark>needle</mark>',
+        )
+
+    def test_bad_requests(self):
+        self.assertEqual(self.search(q='groceries',limit='ten').status_code,400)
+        self.assertEqual(self.search(q='  ').status_code,400)
+
+
+class BulkTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        self.other=User.objects.create(username='other',email='other@example.com')
+        self.first=Note.objects.create(owner=self.user,title='first',content='abc')
+        self.second=Note.objects.create(owner=self.user,title='second',content='abc')
+        self.foreign=Note.objects.create(owner=self.other,title='foreign',content='abc')
+        login(self.client,self.user)
+
+    def bulk(self,operations):
+        response=self.client.post('/notes/bulk/',{'operations':operations},content_type='application/json')
+        self.assertEqual(response.status_code,200)
+        return response.json()['results']
+
+    def test_create_move_and_delete(self):
+        results=self.bulk([
+            {'op':'create','title':'new','content':'x','category':'home'},
+            {'op':'move','id':self.first.id,'category':'archive'},
+            {'op':'delete','id':self.second.id},
+        ])
+        self.assertEqual([result['status'] for result in results],['created','updated','deleted'])
+        created=Note.objects.get(id=results[0]['id'])
+        self.assertEqual((created.owner_id,created.title,created.category),(self.user.id,'new','home'))
+        self.first.refresh_from_db()
+        self.assertEqual((self.first.category,self.first.version),('archive',2))
+        self.assertFalse(Note.objects.filter(id=self.second.id).exists())
+
+    def test_notes_of_other_users_are_not_found(self):
+        results=self.bulk([
+            {'op':'update','id':self.foreign.id,'title':'mine'},
+            {'op':'delete','id':self.foreign.id+1000},
+        ])
+        self.assertEqual([result['message'] for result in results],['Not found','Not found'])
+        self.foreign.refresh_from_db()
+        self.assertEqual(self.foreign.title,'foreign')
+
+    def test_invalid_items_are_reported_next_to_the_applied_ones(self):
+        third=Note.objects.create(owner=self.user,title='third',content='abc')
+        results=self.bulk([
+            {'op':'rename','id':self.first.id},
+            {'op':'update','id':self.first.id,'title':'x'*21},
+            {'op':'move','id':third.id},
+            {'op':'update','id':self.second.id,'title':'renamed'},
+            {'op':'delete','id':self.second.id},
+            {'op':'create','content':'no title'},
+            {'op':'delete','id':'1'},
+        ])
+        self.assertEqual(
+            [result['status'] for result in results],
+            ['error','error','error','updated','error','error','error'],
+        )
+        self.assertIn('title',results[1]['errors'])
+        self.assertEqual(results[2]['message'],"category required")
+        self.assertEqual(results[4]['message'],"Note already changed in this request")
+        self.assertIn('title',results[5]['errors'])
+        self.assertEqual(results[6]['message'],"id required")
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertEqual((self.first.title,self.second.title),('first','renamed'))
+
+    def test_writes_are_one_transaction(self):
+        with mock.patch.object(Note.objects,'bulk_update',side_effect=DatabaseError('down')):
+            with self.assertRaises(DatabaseError):
+                apply_operations(self.user,[
+                    {'op':'create','title':'new','content':'x'},
+                    {'op':'update','id':self.first.id,'content':'abcd'},
+                    {'op':'delete','id':self.second.id},
+                ])
+        self.assertFalse(Note.objects.filter(title='new').exists())
+        self.assertFalse(NoteOperation.objects.exists())
+        self.assertTrue(Note.objects.filter(id=self.second.id).exists())
+
+    def test_too_many_operations_are_refused(self):
+        with override_settings(NOTES_BULK_MAX=2):
+            response=self.client.post(
+                '/notes/bulk/',{'operations':[{'op':'delete','id':self.first.id}]*3},content_type='application/json',
+            )
+        self.assertEqual(response.status_code,400)
+
+
+class TransferTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        self.other=User.objects.create(username='other',email='other@example.com')
+        Note.objects.create(owner=self.other,title='foreign',content='abc')
+        login(self.client,self.user)
+        login(self.async_client,self.user)
+        self.client.cookies['db_primary']='1'
+        self.async_client.cookies['db_primary']='1'
+
+    def lines(self,*items):
+        return ''.join(item if isinstance(item,str) else json.dumps(item)+'\n' for item in items).encode()
+
+    @override_settings(NOTES_TRANSFER_BATCH=2)
+    def test_ndjson_import_inserts_in_batches(self):
+        body=self.lines(*({'title':f'note {number}','content':'<p>x</p>','category':'work'} for number in range(5)))
+        response=self.client.post('/notes/import/',body,content_type='application/x-ndjson')
+        self.assertEqual(response.json(),{'imported':5,'failed':0,'errors':[]})
+        notes=Note.objects.filter(owner=self.user).order_by('id')
+        self.assertEqual([note.title for note in notes],[f'note {number}' for number in range(5)])
+        self.assertEqual({note.category for note in notes},{'work'})
+
+    def test_multipart_import(self):
+        upload=SimpleUploadedFile('notes.ndjson',self.lines({'title':'uploaded','content':'abc'}))
+        response=self.client.post('/notes/import/',{'file':upload})
+        self.assertEqual(response.json()['imported'],1)
+        self.assertTrue(Note.objects.filter(owner=self.user,title='uploaded').exists())
+
+    def test_multipart_without_file_is_refused(self):
+        response=self.client.post('/notes/import/',{'other':'x'})
+        self.assertEqual(response.status_code,400)
+
+    def test_malformed_lines_are_reported_and_skipped(self):
+        body=self.lines(
+            {'title':'good','content':'abc'},
+            '{"title":\n',
+            '\n',
+            '[1,2]\n',
+            {'content':'no title'},
+            {'title':'x'*21,'content':'abc'},
+            {'title':'lone \ud800','content':'abc'},
+            {'title':'also good','content':'abc'},
+        )
+        result=self.client.post('/notes/import/',body,content_type='application/x-ndjson').json()
+        self.assertEqual((result['imported'],result['failed']),(2,5))
+        self.assertEqual([error['line'] for error in result['errors']],[2,4,5,6,7])
+        self.assertIn('title',result['errors'][2]['message'])
+        self.assertEqual(
+            sorted(Note.objects.filter(owner=self.user).values_list('title',flat=True)),['also good','good'],
+        )
+
+    @override_settings(NOTES_IMPORT_MAX=2)
+    def test_import_stops_at_the_limit(self):
+        body=self.lines(*({'title':f'note {number}','content':'abc'} for number in range(4)))
+        result=self.client.post('/notes/import/',body,content_type='application/x-ndjson').json()
+        self.assertEqual((result['imported'],result['failed']),(2,1))
+        self.assertEqual(result['errors'],[{'line':3,'message':"Import stopped after 2 notes"}])
+
+    async def export(self,kind):
+        response=await self.async_client.get('/notes/export/',{'format':kind})
+        self.assertEqual(response.status_code,200)
+        return response,b''.join([chunk async for chunk in response.streaming_content])
+
+    async def test_ndjson_export_is_only_the_users_notes(self):
+        first=await Note.objects.acreate(owner=self.user,title='first',content='abc',category='work')
+        second=await Note.objects.acreate(owner=self.user,title='second',content='def')
+        response,body=await self.export('ndjson')
+        self.assertEqual(response['Content-Type'],'application/x-ndjson')
+        lines=[json.loads(line) for line in body.splitlines()]
+        self.assertEqual([(line['id'],line['title'],line['content']) for line in lines],[
+            (first.id,'first','abc'),(second.id,'second','def'),
+        ])
+
+    async def test_markdown_export(self):
+        note=await Note.objects.acreate(
+            owner=self.user,title='Plan',category='Work Stuff',
+            content='<h2>Goals</h2><p><b>bold</b> and <a href="https://example.com">link</a></p><ol><li>one</li><li>two</li></ol>',
+        )
+        response,body=await self.export('markdown')
+        self.assertIn('notes-markdown.zip',response['Content-Disposition'])
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertEqual(archive.namelist(),[f'work-stuff/{note.id}-plan.md'])
+            self.assertEqual(archive.read(archive.namelist()[0]).decode(),(
+                '# Plan\n\n## Goals\n\n**bold** and [link](https://example.com)\n\n1. one\n2. two\n'
+            ))
+
+    @override_settings(NOTES_TRANSFER_BATCH=1)
+    async def test_html_export_spans_batches(self):
+        await Note.objects.acreate(owner=self.user,title='<b>',content='<p>one</p>')
+        await Note.objects.acreate(owner=self.user,title='two',content='<p>two</p>')
+        _,body=await self.export('html')
+        with zipfile.ZipFile(io.BytesIO(body)) as archive:
+            self.assertIsNone(archive.testzip())
+            names=archive.namelist()
+            self.assertEqual(len(names),2)
+            page=archive.read(names[0]).decode()
+        self.assertIn('<title>&lt;b&gt;</title>',page)
+        self.assertIn('<p>one</p>',page)
+
+    async def test_unknown_export_format_is_refused(self):
+        response=await self.async_client.get('/notes/export/',{'format':'pdf'})
+        self.assertEqual(response.status_code,400)
+
+
+class WireTest(TestCase):
+    def test_deflated_frames_round_trip(self):
+        frame={'type':'op','rev':0,'ops':[{'pos':0,'insert':'x'*5000}]}
+        data=encode_binary(frame)
+        self.assertEqual(data[:1],DEFLATE)
+        self.assertEqual(decode(bytes_data=data),frame)
+
+    def test_frames_inflating_past_the_bound_are_refused(self):
+        bomb=DEFLATE+zlib.compress(msgpack.packb({'content':'x'*(MAX_FRAME+1)}),9)
+        with self.assertRaises(FrameTooLarge):
+            decode(bytes_data=bomb)
+
+
+@override_settings(MIDDLEWARE=['backend.profiling.QueryProfilerMiddleware']+settings.MIDDLEWARE)
+class QueryProfilerTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        Note.objects.create(owner=self.user,title='first',content='abc')
+        login(self.client,self.user)
+        login(self.async_client,self.user)
+        self.client.cookies['db_primary']='1'
+        self.async_client.cookies['db_primary']='1'
+
+    async def test_async_view_is_counted_on_the_event_loop(self):
+        with self.assertLogs('backend.profiling','INFO') as logs:
+            response=await self.async_client.get('/notes/')
+        self.assertEqual(response.status_code,200)
+        self.assertGreater(int(response['X-Query-Count']),0)
+        self.assertIn('db;dur=',response['Server-Timing'])
+        line=json.loads(logs.records[0].getMessage())
+        self.assertEqual((line['view'],line['queries']),('all_new_note',int(response['X-Query-Count'])))
+
+    def test_middleware_stays_async(self):
+        middleware=QueryProfilerMiddleware(sync_to_async(lambda request:None))
+        self.assertTrue(iscoroutinefunction(middleware))
+        self.assertFalse(iscoroutinefunction(QueryProfilerMiddleware(lambda request:None)))
+
+    def test_sync_view_is_counted(self):
+        response=self.client.get('/notes/search/',{'q':'abc'})
+        self.assertEqual(response.status_code,200)
+        self.assertGreater(int(response['X-Query-Count']),0)
+
+
+class NoteQueryBudgetTest(TestCase):
+    #budgets hold for any number of notes, growth means an n+1 crept in
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='owner',email='owner@example.com')
+        self.notes=Note.objects.bulk_create([
+            Note(owner=self.user,title=f'note {i}',content='abc') for i in range(20)
+        ])
+        login(self.client,self.user)
+        #reads stay on the primary, a replica runs the same queries
+        self.client.cookies['db_primary']='1'
+
+    def test_list(self):
+        #the first request also checks that the user is active, later ones hit the cache
+        with query_budget(2):
+            self.assertEqual(len(self.client.get('/notes/').json()),20)
+        with query_budget(1):
+            self.assertEqual(len(self.client.get('/notes/?limit=10').json()['results']),10)
+
+    def test_detail(self):
+        with query_budget(2):
+            self.assertEqual(self.client.get(f'/notes/{self.notes[0].id}/').status_code,200)
+        with query_budget(0):
+            self.assertEqual(self.client.get(f'/notes/{self.notes[0].id}/').status_code,200)
+
+    def test_put(self):
+        #user check, note, then note update and operation insert in a transaction
+        #(the savepoint pair only shows up inside the test case transaction)
+        with query_budget(6):
+            response=self.client.put(
+                f'/notes/{self.notes[0].id}/',
+                {'title':'renamed','category':'','content':'abcd'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code,200)
+
+
+def random_ops(random,content,count):
+    #count ops applied one after the other, each valid against the text before it
+    ops=[]
+    for _ in range(count):
+        pos=random.randint(0,len(content))
+        if content and random.random()<0.4:
+            op={'pos':min(pos,len(content)-1),'delete':random.randint(1,3)}
+            op['delete']=min(op['delete'],len(content)-op['pos'])
+        else:
+            op={'pos':pos,'insert':random.choice(['x','yz','123'])}
+        ops.append(op)
+        content=apply_ops(content,[op])
+    return ops
+
+
+class TransformTest(SimpleTestCase):
+    def test_concurrent_edits_converge(self):
+        generator=random.Random(7)
+        for _ in range(2000):
+            base=''.join(generator.choice('abcdef') for _ in range(generator.randint(0,12)))
+            a=random_ops(generator,base,generator.randint(1,3))
+            b=random_ops(generator,base,generator.randint(1,3))
+            a_first=generator.random()<0.5
+            a2,b2=transform(a,b,a_first)
+            self.assertEqual(
+                apply_ops(apply_ops(base,a),b2),
+                apply_ops(apply_ops(base,b),a2),
+                (base,a,b,a_first),
+            )
+
+    def test_inserts_at_the_same_position(self):
+        self.assertEqual(transform([{'pos':1,'insert':'x'}],[{'pos':1,'insert':'y'}],True),(
+            [{'pos':1,'insert':'x'}],[{'pos':2,'insert':'y'}],
+        ))
+
+    def test_insert_inside_a_deleted_range_survives(self):
+        a2,b2=transform([{'pos':0,'delete':4}],[{'pos':2,'insert':'x'}],False)
+        self.assertEqual(apply_ops(apply_ops('abcd',[{'pos':2,'insert':'x'}]),a2),'x')
+        self.assertEqual(apply_ops(apply_ops('abcd',[{'pos':0,'delete':4}]),b2),'x')
+
+
+class LiveDocumentTest(SimpleTestCase):
+    def setUp(self):
+        self.document=LiveDocument(1,'abc')
+
+    def tearDown(self):
+        write_behind.take()
+
+    def test_apply_rebases_over_missed_revisions(self):
+        self.assertEqual(self.document.apply(0,[{'pos':0,'insert':'x'}]),(1,[{'pos':0,'insert':'x'}]))
+        self.assertEqual(self.document.apply(0,[{'pos':3,'insert':'y'}]),(2,[{'pos':4,'insert':'y'}]))
+        self.assertEqual(self.document.snapshot(),{'rev':2,'content':'xabcy'})
+        self.assertEqual([(op.rev,op.ops) for op in write_behind.take()[1]],[
+            (1,[{'pos':0,'insert':'x'}]),(2,[{'pos':4,'insert':'y'}]),
+        ])
+
+    def test_apply_refuses_unknown_revisions(self):
+        with self.assertRaises(StaleRevision):
+            self.document.apply(1,[{'pos':0,'insert':'x'}])
+        self.document.history.clear()
+        self.document.rev=5
+        with self.assertRaises(StaleRevision):
+            self.document.apply(4,[{'pos':0,'insert':'x'}])
+
+    def test_since(self):
+        self.document.apply(0,[{'pos':0,'insert':'x'}])
+        self.document.apply(1,[{'pos':0,'insert':'y'}])
+        self.assertEqual(self.document.since(0),[{'pos':0,'insert':'x'},{'pos':0,'insert':'y'}])
+        self.assertEqual(self.document.since(1),[{'pos':0,'insert':'y'}])
+        self.assertEqual(self.document.since(2),[])
+        self.assertIsNone(self.document.since(3))
+        self.document.history.popleft()
+        self.assertIsNone(self.document.since(0))
+
+    def test_replace_becomes_a_diff(self):
+        self.assertEqual(self.document.replace('aXc'),(1,[{'pos':1,'delete':1},{'pos':1,'insert':'X'}]))
+
+
+def op_frame(base_rev,rev,sender='a'):
+    return {'type':'op','rev':rev,'baseRev':base_rev,'ops':[{'pos':0,'insert':str(rev)}],'senderId':sender}
+
+
+class OutboxTest(SimpleTestCase):
+    def setUp(self):
+        self.sent=[]
+
+    async def send(self,text_data=None,bytes_data=None):
+        self.sent.append(json.loads(text_data))
+
+    async def drain(self,outbox):
+        while outbox.task is not None:
+            await outbox.task
+
+    async def test_queued_ops_are_merged(self):
+        outbox=Outbox(self.send,1000)
+        outbox.push(op_frame(0,1),'op')
+        outbox.push(op_frame(1,2),'op')
+        outbox.push(op_frame(2,3,'b'),'op')
+        await self.drain(outbox)
+        self.assertEqual(self.sent,[{
+            'type':'op','rev':3,'baseRev':0,'senderId':None,
+            'ops':[{'pos':0,'insert':'1'},{'pos':0,'insert':'2'},{'pos':0,'insert':'3'}],
+        }])
+
+    async def test_only_the_newest_content_is_sent(self):
+        outbox=Outbox(self.send,1000)
+        outbox.push({'content':'a'},'content')
+        outbox.push({'type':'ack','rev':1})
+        outbox.push({'content':'ab'},'content')
+        await self.drain(outbox)
+        self.assertEqual(self.sent,[{'type':'ack','rev':1},{'content':'ab'}])
+
+    async def test_snapshot_replaces_the_ops_it_covers(self):
+        outbox=Outbox(self.send,1000)
+        outbox.push(op_frame(0,1),'op')
+        outbox.push({'type':'snapshot','rev':1,'content':'1'},'snapshot')
+        outbox.push(op_frame(1,2),'op')
+        await self.drain(outbox)
+        self.assertEqual([frame['type'] for frame in self.sent],['snapshot','op'])
+
+    async def test_frames_wait_for_a_client_behind_its_window(self):
+        outbox=Outbox(self.send,0,window=2)
+        outbox.push({'type':'ack','rev':1})
+        await self.drain(outbox)
+        outbox.ack(1)
+        for rev in range(2,4):
+            outbox.push({'type':'ack','rev':rev})
+            await asyncio.sleep(0)
+        outbox.push(op_frame(3,4),'op')
+        outbox.push(op_frame(4,5),'op')
+        await asyncio.sleep(0.01)
+        #one frame seen, two ahead: the ops wait and get merged
+        self.assertEqual(len(self.sent),3)
+        self.assertEqual(len(outbox.frames),1)
+        outbox.ack(3)
+        await self.drain(outbox)
+        self.assertEqual(self.sent[-1]['baseRev'],3)
+        self.assertEqual(self.sent[-1]['rev'],5)
+
+    async def test_clients_that_never_report_are_not_held_back(self):
+        outbox=Outbox(self.send,0,window=2)
+        for rev in range(1,6):
+            outbox.push({'type':'ack','rev':rev})
+        await self.drain(outbox)
+        self.assertEqual(len(self.sent),5)
+
+    async def test_overflow_forces_a_resync_then_closes(self):
+        closed=[]
+
+        async def on_overflow():
+            closed.append(True)
+
+        outbox=Outbox(
+            self.send,1000,resync=lambda:{'type':'snapshot','rev':9,'content':''},
+            on_overflow=on_overflow,high_water=2,low_water=0,
+        )
+        for rev in range(1,4):
+            outbox.push({'type':'ack','rev':rev})
+        self.assertEqual(outbox.frames[-1][0],'snapshot')
+        outbox.push({'type':'ack','rev':4})
+        outbox.push({'type':'ack','rev':5})
+        await asyncio.sleep(0)
+        self.assertEqual((outbox.frames,closed),([],[True]))
@@ -0,0 +1,217 @@
+import html
+import json
+import re
+import zipfile
+from html.parser import HTMLParser
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.text import slugify
+from rest_framework.exceptions import ValidationError
+from rest_framework.validators import ProhibitSurrogateCharactersValidator
+from notes.models import Note
+from notes.serializers import NoteBulkSerializer
+from notes.documents import is_live,live_content
+from notes.oplog import replay_notes
+
+#export streams a user's notes as ndjson or a zip of html/markdown files, one query
+#per batch so memory does not grow with the account. import reads an ndjson upload
+#line by line and inserts a bulk_create per batch
+
+FIELDS=('id','title','category','content','created_at','updated_at','rev','snapshot_rev')
+MAX_ERRORS=100
+
+
+def batch_size():
+    return getattr(settings,'NOTES_TRANSFER_BATCH',1000)
+
+
+async def anote_batches(user):
+    #keyset batches in id order instead of a server side cursor, works behind
+    #pgbouncer and keeps no transaction open while the client downloads
+    last=0
+    while True:
+        batch=[
+            note async for note in
+            Note.objects.filter(owner=user,id__gt=last).order_by('id').only(*FIELDS)[:batch_size()]
+        ]
+        if not batch:
+            return
+        #ops after the snapshots are not folded into content yet
+        await sync_to_async(replay_notes)([note for note in batch if not is_live(note.id)])
+        for note in batch:
+            note.content=live_content(note.id,note.content)
+        yield batch
+        last=batch[-1].id
+
+
+def record(note):
+    return {
+        'id':note.id,
+        'title':note.title,
+        'category':note.category,
+        'content':note.content,
+        'created_at':note.created_at.isoformat(),
+        'updated_at':note.updated_at.isoformat(),
+    }
+
+
+async def export_ndjson(user):
+    async for batch in anote_batches(user):
+        yield ''.join(json.dumps(record(note))+'\n' for note in batch).encode()
+
+
+class _Markdown(HTMLParser):
+    #the editor stores contentEditable html, enough of it for readable markdown
+    blocks={'p','div','h1','h2','h3','h4','h5','h6','ul','ol','blockquote','pre'}
+    marks={'b':'**','strong':'**','i':'*','em':'*','s':'~~','strike':'~~','code':'`'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts=[]
+        self.lists=[]
+        self.links=[]
+
+    def handle_starttag(self,tag,attrs):
+        if tag in self.blocks:
+            self.parts.append('\n')
+        if tag in ('ul','ol'):
+            self.lists.append(0 if tag=='ol' else None)
+        elif tag=='li' and self.lists:
+            indent='\n'+'  '*(len(self.lists)-1)
+            if self.lists[-1] is None:
+                self.parts.append(indent+'- ')
+            else:
+                self.lists[-1]+=1
+                self.parts.append(f'{indent}{self.lists[-1]}. ')
+        elif tag[0]=='h' and tag[1:].isdigit():
+            self.parts.append('#'*int(tag[1:])+' ')
+        elif tag=='blockquote':
+            self.parts.append('> ')
+        elif tag=='br':
+            self.parts.append('\n')
+        elif tag=='a':
+            self.links.append(dict(attrs).get('href'))
+            self.parts.append('[')
+        elif tag in self.marks:
+            self.parts.append(self.marks[tag])
+
+    def handle_endtag(self,tag):
+        if tag in ('ul','ol') and self.lists:
+            self.lists.pop()
+        elif tag=='a' and self.links:
+            href=self.links.pop()
+            self.parts.append(f']({href})' if href else ']')
+        elif tag in self.marks:
+            self.parts.append(self.marks[tag])
+        if tag in self.blocks:
+            self.parts.append('\n')
+
+    def handle_data(self,data):
+        self.parts.append(data)
+
+    def text(self):
+        return re.sub(r'\n{3,}','\n\n',''.join(self.parts)).strip()
+
+
+def to_markdown(content):
+    parser=_Markdown()
+    parser.feed(content)
+    parser.close()
+    return parser.text()
+
+
+def render(note,kind):
+    name=f"{slugify(note.category) or 'notes'}/{note.id}-{slugify(note.title) or 'note'}"
+    if kind=='markdown':
+        return name+'.md',f"# {note.title}\n\n{to_markdown(note.content)}\n"
+    title=html.escape(note.title)
+    return name+'.html',(
+        f'<!doctype html>\n<html><head><meta charset="utf-8"><title>{title}</title></head>\n'
+        f'<body>\n<h1>{title}</h1>\n{note.content}\n</body></html>\n'
+    )
+
+
+class ZipStream:
+    #zipfile writes to an unseekable sink with data descriptors, so each batch
+    #comes out as soon as it is compressed
+    def __init__(self,kind):
+        self.kind=kind
+        self.chunks=[]
+        self.zip=zipfile.ZipFile(self,'w',zipfile.ZIP_DEFLATED)
+
+    def write(self,data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data=b''.join(self.chunks)
+        self.chunks=[]
+        return data
+
+    def add(self,notes):
+        for note in notes:
+            name,body=render(note,self.kind)
+            info=zipfile.ZipInfo(name,date_time=note.updated_at.timetuple()[:6])
+            info.compress_type=zipfile.ZIP_DEFLATED
+            self.zip.writestr(info,body)
+        return self.take()
+
+    def close(self):
+        self.zip.close()
+        return self.take()
+
+
+async def export_zip(user,kind):
+    stream=ZipStream(kind)
+    async for batch in anote_batches(user):
+        #compression is cpu work, keep it off the event loop
+        yield await sync_to_async(stream.add,thread_sensitive=False)(batch)
+    yield await sync_to_async(stream.close,thread_sensitive=False)()
+
+
+def import_lines(user,lines):
+    #lines is any iterable of ndjson lines, an upload is never read whole.
+    #each line is a note with title, content and optionally category
+    serializer=NoteBulkSerializer()
+    for field in serializer.fields.values():
+        #drf looks for lone surrogates one character at a time, most of the import
+        #time on long notes. encoding the values below finds them in C
+        field.validators=[v for v in field.validators if not isinstance(v,ProhibitSurrogateCharactersValidator)]
+    limit=getattr(settings,'NOTES_IMPORT_MAX',100000)
+    imported=0
+    failed=0
+    errors=[]
+    batch=[]
+    for number,line in enumerate(lines,1):
+        line=line.strip()
+        if not line:
+            continue
+        if imported+len(batch)>=limit:
+            errors.append({'line':number,'message':f"Import stopped after {limit} notes"})
+            failed+=1
+            break
+        try:
+            item=json.loads(line)
+            if not isinstance(item,dict):
+                raise ValueError("expected an object")
+            fields=serializer.run_validation(item)
+            for value in fields.values():
+                value.encode()
+        except (ValueError,ValidationError) as e:
+            failed+=1
+            if len(errors)<MAX_ERRORS:
+                detail=e.detail if isinstance(e,ValidationError) else str(e)
+                errors.append({'line':number,'message':detail})
+            continue
+        batch.append(Note(owner=user,**fields))
+        if len(batch)>=batch_size():
+            Note.objects.bulk_create(batch)
+            imported+=len(batch)
+            batch=[]
+    if batch:
+        Note.objects.bulk_create(batch)
+        imported+=len(batch)
+    return {'imported':imported,'failed':failed,'errors':errors}
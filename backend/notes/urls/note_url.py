@@ -3,6 +3,10 @@ from notes.views import note_view
 
 urlpatterns = [
     path('',note_view.All_New_Note,name="all_new_note"),
+    path('bulk/',note_view.bulk,name="bulk_notes"),
+    path('export/',note_view.export_notes,name="export_notes"),
+    path('import/',note_view.import_notes,name="import_notes"),
+    path('search/',note_view.search,name="search_notes"),
     path('share/<uuid:token>/',note_view.Shared_note,name="shared_token"),
     path('toggle_shared/<int:id>/',note_view.toggle_shared,name="toggle_shared"),
     path('<int:id>/',note_view.Individual_Note,name="individual_note"),
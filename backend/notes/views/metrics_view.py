@@ -0,0 +1,11 @@
+from django.conf import settings
+from django.http import HttpResponse
+from notes.metrics import render
+
+
+def metrics(request):
+    #scraped by prometheus, guarded by a bearer token when METRICS_TOKEN is set
+    token=getattr(settings,'METRICS_TOKEN',None)
+    if token and request.headers.get('Authorization')!=f'Bearer {token}':
+        return HttpResponse(status=403)
+    return HttpResponse(render(),content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -6,113 +6,234 @@ from rest_framework.permissions import IsAuthenticated,IsAdminUser
 from notes.models import Note
 from notes.serializers import NoteSerializer,NoteDetailSerializer,NoteShareSerializer
 from rest_framework.status import *
+from notes.documents import alive_notes,is_live,live_content,live_rev
+from notes.conditional import current_version,not_modified,note_etag,precondition_failed
+from notes.oplog import areplay_note,asave_note
+from notes.pagination import paginate
+from notes.search import DEFAULT_LIMIT,search_notes
+from notes.persistence import write_behind
+from notes.cache import aget_note_detail,aget_shared_note_id,ainvalidate_note
+from notes.bulk import apply_operations,max_operations
+from notes.transfer import export_ndjson,export_zip,import_lines
+from django.http import StreamingHttpResponse
+from notes import asyncapi
+from asgiref.sync import sync_to_async
 
-@api_view(['POST','GET'])
-@permission_classes([IsAuthenticated])
-def All_New_Note(request):
+#the note views are async django views (see notes.asyncapi) so daphne runs them on
+#its event loop next to the websocket consumers, only queries leave the loop
+
+@asyncapi.async_api_view(['POST','GET'])
+async def All_New_Note(request):
     if request.method=='GET':
-        notes=Note.objects.filter(owner=request.user).order_by('-updated_at')
-        serializer=NoteSerializer(notes,many=True)
-        return Response(serializer.data)
+        #only load the columns the list shows, never content
+        notes=Note.objects.filter(owner=request.user).only(*NoteSerializer.Meta.fields)
+        if 'limit' not in request.query_params and 'cursor' not in request.query_params:
+            notes=[note async for note in notes.order_by('-updated_at','-id')]
+            serializer=NoteSerializer(notes,many=True)
+            return asyncapi.Response(serializer.data)
+        try:
+            page,next_cursor=await paginate(notes,request.query_params)
+        except (ValueError,UnicodeDecodeError):
+            return asyncapi.Response({"message":"Invalid page"},status=HTTP_400_BAD_REQUEST)
+        serializer=NoteSerializer(page,many=True)
+        return asyncapi.Response({"results":serializer.data,"next":next_cursor})
 
     elif request.method=='POST':
-        note=Note.objects.create(
+        note=await Note.objects.acreate(
             owner=request.user,
             title=request.data['title'],
             content=request.data['content']
         )
         serializer=NoteDetailSerializer(note,many=False)
-        return Response(serializer.data)
+        return asyncapi.Response(serializer.data)
     
 
-@api_view(['GET','PUT','DELETE'])
-@permission_classes([IsAuthenticated])
-def Individual_Note(request,id):
+@asyncapi.async_api_view(['POST'])
+async def bulk(request):
+    operations=request.data.get('operations') if isinstance(request.data,dict) else None
+    if not isinstance(operations,list) or not operations:
+        return asyncapi.Response({"message":"operations list required"},status=HTTP_400_BAD_REQUEST)
+    if len(operations)>max_operations():
+        return asyncapi.Response({"message":f"At most {max_operations()} operations per request"},status=HTTP_400_BAD_REQUEST)
+    #the transaction needs one thread, the whole batch runs off the loop
+    ids=[item.get('id') for item in operations if isinstance(item,dict) and isinstance(item.get('id'),int)]
+    results=await sync_to_async(apply_operations)(request.user,operations,await alive_notes(ids))
+    return asyncapi.Response({"results":results})
+
+
+EXPORTS={
+    'ndjson':('application/x-ndjson','notes.ndjson'),
+    'html':('application/zip','notes-html.zip'),
+    'markdown':('application/zip','notes-markdown.zip'),
+}
+
+
+@asyncapi.async_api_view(['GET'])
+async def export_notes(request):
+    kind=request.query_params.get('format','ndjson')
+    if kind not in EXPORTS:
+        return asyncapi.Response({"message":"format must be ndjson, html or markdown"},status=HTTP_400_BAD_REQUEST)
+    content_type,filename=EXPORTS[kind]
+    stream=export_ndjson(request.user) if kind=='ndjson' else export_zip(request.user,kind)
+    response=StreamingHttpResponse(stream,content_type=content_type)
+    response['Content-Disposition']=f'attachment; filename="{filename}"'
+    return response
+
+
+@asyncapi.async_api_view(['POST'],parse_body=False)
+async def import_notes(request):
+    def run():
+        #a multipart upload is spooled to disk by django, a raw ndjson body by the
+        #asgi server, both are read here line by line
+        if request.content_type=='multipart/form-data':
+            upload=request.FILES.get('file')
+            if upload is None:
+                return None
+            return import_lines(request.user,upload)
+        return import_lines(request.user,request)
+    result=await sync_to_async(run)()
+    if result is None:
+        return asyncapi.Response({"message":"file required"},status=HTTP_400_BAD_REQUEST)
+    return asyncapi.Response(result)
+
+
+def note_response(request,data):
+    #the cached payload can be older than an open room and its queued writes,
+    #the etag is built from the same overlaid fields that are served
+    data.update({name:value for name,value in write_behind.pending(data['id']).items() if name in data})
+    data['content']=live_content(data['id'],data['content'])
+    data['rev']=live_rev(data['id'],data['rev'])
+    etag=note_etag(data['id'],data['version'],data['rev'])
+    if not_modified(request,etag):
+        return asyncapi.Response(status=HTTP_304_NOT_MODIFIED,headers={'ETag':etag})
+    return asyncapi.Response(data,headers={'ETag':etag})
+
+
+async def update_note(request,note):
+    while True:
+        if not is_live(note.id):
+            #content and rev as of the newest stored operation, not the last snapshot
+            await areplay_note(note)
+        if precondition_failed(request,note_etag(note.id,note.version,note.rev)):
+            return asyncapi.Response({"message":"Note was changed by someone else"},status=HTTP_412_PRECONDITION_FAILED)
+        version=current_version(note.id,note.version)
+        rev=note.rev
+        note.title=request.data['title']
+        note.category=request.data['category']
+        note.version=version+1
+        #an open room owns the content and writes behind, autosaves only queue the rest
+        if is_live(note.id):
+            write_behind.mark(note.id,title=note.title,category=note.category,version=note.version)
+            note.content=live_content(note.id,note.content)
+            break
+        #the room can be open in another worker, its write-behind never sees this
+        #process's queue. the rest is written now, the content is as of its last flush
+        content=None if await alive_notes([note.id]) else request.data['content']
+        #conditional on what the etag was checked against, two requests with the same
+        #If-Match cannot both get through
+        if await asave_note(note,version,rev,content):
+            await ainvalidate_note(note.id)
+            break
+        if 'If-Match' in request.headers:
+            return asyncapi.Response({"message":"Note was changed by someone else"},status=HTTP_412_PRECONDITION_FAILED)
+        #without a precondition the last write wins, again on top of the new state
+        note=await Note.objects.select_related('owner').aget(id=note.id)
+    serializer=NoteDetailSerializer(note,many=False)
+    return asyncapi.Response(serializer.data,headers={'ETag':note_etag(note.id,note.version,note.rev)})
+
+
+@asyncapi.async_api_view(['GET','PUT','DELETE'])
+async def Individual_Note(request,id):
     if request.method=="GET":
         try:
-            note=Note.objects.get(   
-                owner=request.user,             
-                id=id)
-            serializer=NoteDetailSerializer(note,many=False)
-            return Response(serializer.data)
+            data=await aget_note_detail(id)
+            if data is None or data['owner']!=request.user.id:
+                raise Note.DoesNotExist()
+            return note_response(request,data)
         except:
             
-            return Response({"message":"Not found"},status=HTTP_400_BAD_REQUEST)
+            return asyncapi.Response({"message":"Not found"},status=HTTP_400_BAD_REQUEST)
     elif request.method=='PUT':
         try:
-            note=Note.objects.get(
+            note=await Note.objects.select_related('owner').aget(
                owner=request.user,
                id=id)  
-            note.title=request.data['title']
-            note.content=request.data['content']
-            note.category=request.data['category']
-            serializer=NoteDetailSerializer(note,many=False)
-            note.save()
-            return Response(serializer.data)
+            return await update_note(request,note)
         except:
-            return Response({"message":"cannot be edited"},status=HTTP_400_BAD_REQUEST)
+            return asyncapi.Response({"message":"cannot be edited"},status=HTTP_400_BAD_REQUEST)
         
     elif request.method=="DELETE":
         try:
-            note=Note.objects.get(
+            note=await Note.objects.aget(
                owner=request.user,
                id=id) 
-            Note.delete(note)
-            return Response({"message":"deleted successfully"})
+            await note.adelete()
+            await ainvalidate_note(id,note.share_token)
+            return asyncapi.Response({"message":"deleted successfully"})
         except:
-            return Response({"message":"cannot be deleted"},status=HTTP_400_BAD_REQUEST)
+            return asyncapi.Response({"message":"cannot be deleted"},status=HTTP_400_BAD_REQUEST)
         
 
 
-@api_view(['GET','PUT'])
-@permission_classes([IsAuthenticated])
-def Shared_note(request,token):
+@asyncapi.async_api_view(['GET','PUT'])
+async def Shared_note(request,token):
     if request.method=="GET":
         # print("run")
         try:
-            note=Note.objects.get(              
-                share_token=token,
-                is_shared=True)
-            
-            serializer=NoteDetailSerializer(note,many=False)
-            return Response(serializer.data)
+            note_id=await aget_shared_note_id(token)
+            data=await aget_note_detail(note_id) if note_id is not None else None
+            if data is None:
+                raise Note.DoesNotExist()
+            return note_response(request,data)
         except:
             
-            return Response({"message":"Not found"},status=HTTP_400_BAD_REQUEST)
+            return asyncapi.Response({"message":"Not found"},status=HTTP_400_BAD_REQUEST)
     elif request.method=='PUT':
         try:
-            note=Note.objects.get(              
+            note=await Note.objects.select_related('owner').aget(              
                 share_token=token,
                 is_shared=True) 
-            note.title=request.data['title']
-            note.content=request.data['content']
-            note.category=request.data['category']
-            serializer=NoteDetailSerializer(note,many=False)
-            note.save()
-            return Response(serializer.data)
+            return await update_note(request,note)
         except:
-            return Response({"message":"cannot be edited"},status=HTTP_400_BAD_REQUEST)
+            return asyncapi.Response({"message":"cannot be edited"},status=HTTP_400_BAD_REQUEST)
         
 
-@api_view(['GET','PUT'])
-@permission_classes([IsAuthenticated])
-def toggle_shared(request,id):
+@asyncapi.async_api_view(['GET','PUT'])
+async def toggle_shared(request,id):
     if request.method=='GET':
         try:
-            note=Note.objects.get(   
+            note=await Note.objects.aget(   
                 owner=request.user,             
                 id=id)
             serializer=NoteShareSerializer(note,many=False)
-            return Response(serializer.data)
+            return asyncapi.Response(serializer.data)
         except:
-            return Response({"message":"Sharing detail not found"},status=HTTP_400_BAD_REQUEST)
+            return asyncapi.Response({"message":"Sharing detail not found"},status=HTTP_400_BAD_REQUEST)
     elif request.method=='PUT':
         try:
-            note=Note.objects.get(
+            note=await Note.objects.aget(
                owner=request.user,
                id=id)  
             note.is_shared= not note.is_shared
-            note.save()
-            return Response({"message":"shared button toggled"})
+            note.version=current_version(note.id,note.version)+1
+            await note.asave(update_fields=['is_shared','version','updated_at'])
+            if is_live(note.id):
+                #keep a queued flush from writing an older version back
+                write_behind.mark(note.id,version=note.version)
+            await ainvalidate_note(note.id,note.share_token)
+            return asyncapi.Response({"message":"shared button toggled"})
         except:
-            return Response({"message":"cannot be toggled"},status=HTTP_400_BAD_REQUEST)
\ No newline at end of file
+            return asyncapi.Response({"message":"cannot be toggled"},status=HTTP_400_BAD_REQUEST)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def search(request):
+    text=request.query_params.get('q','').strip()
+    if not text:
+        return Response({"message":"Search text required"},status=HTTP_400_BAD_REQUEST)
+    try:
+        limit=int(request.query_params.get('limit',DEFAULT_LIMIT))
+    except ValueError:
+        return Response({"message":"Invalid limit"},status=HTTP_400_BAD_REQUEST)
+    return Response(search_notes(request.user,text,limit))
@@ -0,0 +1,96 @@
+import json
+import zlib
+from collections import OrderedDict
+import msgpack
+from notes.delta import MAX_INSERT_LENGTH,MAX_OPS_PER_MESSAGE
+
+#websocket wire formats. clients that ask for the notes.msgpack subprotocol get
+#binary frames: one header byte (0 plain, 1 zlib) followed by the msgpack body.
+#everyone else keeps json text frames.
+#frames every member of a room gets the same way (ops, snapshots, full content)
+#are encoded once per room and format and reused for every recipient
+
+BINARY_PROTOCOL='notes.msgpack'
+COMPRESS_MIN=1024
+CACHE_SIZE=64
+
+PLAIN=b'\x00'
+DEFLATE=b'\x01'
+#largest inflated client frame: a full op message of 4 byte characters plus room
+#for the keys. a deflated frame that inflates past it is refused
+MAX_FRAME=MAX_OPS_PER_MESSAGE*(4*MAX_INSERT_LENGTH+64)+4096
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class FrameCache:
+    def __init__(self,size=CACHE_SIZE):
+        self.size=size
+        self.entries=OrderedDict()
+
+    def get(self,key,render):
+        data=self.entries.get(key)
+        if data is None:
+            data=self.entries[key]=render()
+            if len(self.entries)>self.size:
+                self.entries.popitem(last=False)
+        return data
+
+    def clear(self):
+        self.entries.clear()
+
+
+def _cache_key(frame):
+    kind=frame.get('type')
+    if kind=='op':
+        return ('op',frame['baseRev'],frame['rev'],frame['senderId'])
+    if kind=='snapshot':
+        return ('snapshot',frame['rev'])
+    if kind is None and 'content' in frame and 'rev' in frame:
+        return ('content',frame['rev'],frame['senderId'])
+    return None
+
+
+def encode_binary(frame):
+    body=msgpack.packb(frame,use_bin_type=True)
+    if len(body)>=COMPRESS_MIN:
+        packed=zlib.compress(body,6)
+        if len(packed)<len(body):
+            return DEFLATE+packed
+    return PLAIN+body
+
+
+def decode(text_data=None,bytes_data=None):
+    if text_data is not None:
+        return json.loads(text_data)
+    if bytes_data[:1]==DEFLATE:
+        inflater=zlib.decompressobj()
+        body=inflater.decompress(bytes_data[1:],MAX_FRAME)
+        if inflater.unconsumed_tail:
+            raise FrameTooLarge()
+        return msgpack.unpackb(body,raw=False)
+    return msgpack.unpackb(bytes_data[1:],raw=False)
+
+
+class FrameEncoder:
+    #one per connection, returns the keyword arguments for consumer.send
+    def __init__(self,binary=False,cache=None):
+        self.binary=binary
+        self.cache=cache
+
+    def encode(self,frame):
+        if self.binary:
+            return encode_binary(frame)
+        return json.dumps(frame)
+
+    def __call__(self,frame):
+        key=_cache_key(frame) if self.cache is not None else None
+        if key is None:
+            data=self.encode(frame)
+        else:
+            data=self.cache.get(key+(self.binary,),lambda:self.encode(frame))
+        if self.binary:
+            return {'bytes_data':data}
+        return {'text_data':data}
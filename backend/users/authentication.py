@@ -1,10 +1,84 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework_simplejwt.authentication import JWTAuthentication
 
+#what the fast path knows about a user besides the id in the token. kept in a
+#short lived cache instead of the token, token claims would stay as they were at
+#login for the whole 30 day access token lifetime
+USER_FIELDS=('is_active','username','email','first_name')
+
+
+def user_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def forget_user(user_id):
+    #call when a user changes so the fast path sees it right away, otherwise it
+    #does after JWT_ACTIVE_CACHE_TIMEOUT seconds
+    cache.delete(user_cache_key(user_id))
+
+
+def _timeout():
+    return getattr(settings,'JWT_ACTIVE_CACHE_TIMEOUT',60)
+
+
+def cached_user(user_id):
+    #read from the primary, a lagging replica would cache a just verified user as inactive.
+    #a deleted user is cached as inactive
+    fields=cache.get(user_cache_key(user_id))
+    if fields is None:
+        fields=User.objects.using('default').filter(id=user_id).values(*USER_FIELDS).first() or {'is_active':False}
+        cache.set(user_cache_key(user_id),fields,_timeout())
+    return fields
+
+
+async def acached_user(user_id):
+    fields=await cache.aget(user_cache_key(user_id))
+    if fields is None:
+        fields=await User.objects.using('default').filter(id=user_id).values(*USER_FIELDS).afirst() or {'is_active':False}
+        await cache.aset(user_cache_key(user_id),fields,_timeout())
+    return fields
+
+
 class CookieJWTAuthentication(JWTAuthentication):
     def authenticate(self, request):
         raw_token=request.COOKIES.get("access_token")
         if raw_token is None:
             return None
         validated_token=self.get_validated_token(raw_token)
-        user=self.get_user(validated_token)
-        return user,validated_token
\ No newline at end of file
+        if getattr(settings,'JWT_AUTH_FAST_PATH',False):
+            user=self.build_token_user(validated_token,cached_user(self.token_user_id(validated_token)))
+        else:
+            user=self.get_user(validated_token)
+        return user,validated_token
+
+    async def aauthenticate(self, request):
+        #same as authenticate for the async views
+        return await self.aauthenticate_token(request.COOKIES.get("access_token"))
+
+    async def aauthenticate_token(self,raw_token):
+        #the cookie value alone, also used by the note websocket
+        if raw_token is None:
+            return None
+        validated_token=self.get_validated_token(raw_token)
+        if getattr(settings,'JWT_AUTH_FAST_PATH',False):
+            user=self.build_token_user(validated_token,await acached_user(self.token_user_id(validated_token)))
+        else:
+            user=await sync_to_async(self.get_user)(validated_token)
+        return user,validated_token
+
+    def token_user_id(self,validated_token):
+        #simplejwt stores the id claim as a string
+        return User._meta.pk.to_python(validated_token['user_id'])
+
+    def build_token_user(self,validated_token,fields):
+        #unsaved User from the cached fields, the request makes no query for it
+        if not fields['is_active']:
+            raise AuthenticationFailed("User is inactive or deleted",code="user_inactive")
+        user=User(id=self.token_user_id(validated_token),**fields)
+        user._state.adding=False
+        user._state.db='default'
+        return user
@@ -0,0 +1,91 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.html import strip_tags
+from django.utils.module_loading import import_string
+from users.models import OutgoingEmail
+
+#email outbox. views only insert a row, the send_emails worker claims due rows
+#in batches, renders them and hands them to the configured transport.
+#failures are retried with exponential backoff until EMAIL_OUTBOX_MAX_ATTEMPTS
+
+
+def enqueue_email(to,subject,template,context):
+    return OutgoingEmail.objects.create(to=to,subject=subject,template=template,context=context)
+
+
+class SendGridTransport:
+    def __init__(self):
+        from sendgrid import SendGridAPIClient
+        self.client=SendGridAPIClient(settings.SENDGRID_API_KEY)
+
+    def send(self,to,subject,html):
+        from sendgrid.helpers.mail import Mail
+        self.client.send(Mail(
+            from_email=settings.DEFAULT_FROM_EMAIL,
+            to_emails=to,
+            subject=subject,
+            html_content=html
+        ))
+
+
+class DjangoMailTransport:
+    #goes through EMAIL_BACKEND, smtp to a local server or the file backend in development
+    def send(self,to,subject,html):
+        message=EmailMultiAlternatives(subject,strip_tags(html),settings.DEFAULT_FROM_EMAIL,[to])
+        message.attach_alternative(html,"text/html")
+        message.send()
+
+
+_transport=None
+
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        _transport=import_string(settings.EMAIL_OUTBOX_TRANSPORT)()
+    return _transport
+
+
+def backoff(attempts):
+    base=getattr(settings,'EMAIL_OUTBOX_RETRY_BASE',30)
+    return timedelta(seconds=min(base*2**(attempts-1),6*60*60))
+
+
+def claim_batch(limit):
+    #due rows are leased by moving next_attempt_at forward so a second worker skips them
+    now=timezone.now()
+    with transaction.atomic():
+        emails=list(
+            OutgoingEmail.objects.select_for_update(skip_locked=True)
+            .filter(status=OutgoingEmail.PENDING,next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:limit]
+        )
+        OutgoingEmail.objects.filter(id__in=[email.id for email in emails]).update(
+            next_attempt_at=now+timedelta(seconds=getattr(settings,'EMAIL_OUTBOX_LEASE',300))
+        )
+    return emails
+
+
+def deliver(email):
+    email.attempts+=1
+    try:
+        #a template that fails to render is retried and failed like a send error
+        html=render_to_string(email.template,email.context)
+        get_transport().send(email.to,email.subject,html)
+    except Exception as e:
+        print("email delivery error:",e)
+        email.last_error=str(e)
+        if email.attempts>=getattr(settings,'EMAIL_OUTBOX_MAX_ATTEMPTS',8):
+            email.status=OutgoingEmail.FAILED
+        else:
+            email.next_attempt_at=timezone.now()+backoff(email.attempts)
+    else:
+        email.status=OutgoingEmail.SENT
+        email.sent_at=timezone.now()
+        email.last_error=''
+    email.save(update_fields=['status','attempts','next_attempt_at','last_error','sent_at'])
+    return email.status==OutgoingEmail.SENT
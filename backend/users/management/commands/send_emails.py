@@ -0,0 +1,38 @@
+import asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from users.mail import claim_batch,deliver
+
+
+class Command(BaseCommand):
+    help="Deliver queued emails from the outbox, retrying failures with backoff"
+
+    def add_arguments(self,parser):
+        parser.add_argument('--once',action='store_true',help="Deliver what is due and exit")
+
+    def handle(self,*args,**options):
+        asyncio.run(self.work(options['once']))
+
+    async def work(self,once):
+        batch=getattr(settings,'EMAIL_OUTBOX_BATCH',20)
+        poll=getattr(settings,'EMAIL_OUTBOX_POLL',2)
+        while True:
+            emails=await sync_to_async(claim_batch)(batch)
+            if emails:
+                #each delivery waits on the provider in its own thread
+                results=await asyncio.gather(*(
+                    sync_to_async(self.deliver,thread_sensitive=False)(email) for email in emails
+                ))
+                self.stdout.write(f"sent {sum(results)} of {len(emails)} emails")
+            if once:
+                return
+            if len(emails)<batch:
+                await asyncio.sleep(poll)
+
+    def deliver(self,email):
+        try:
+            return deliver(email)
+        finally:
+            close_old_connections()
@@ -1,3 +1,31 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
+
+
+class OutgoingEmail(models.Model):
+    #emails are queued here by the views and delivered by the send_emails worker
+    PENDING='pending'
+    SENT='sent'
+    FAILED='failed'
+    STATUS_CHOICES=[(PENDING,'Pending'),(SENT,'Sent'),(FAILED,'Failed')]
+
+    to=models.EmailField()
+    subject=models.CharField(max_length=200)
+    template=models.CharField(max_length=200)
+    context=models.JSONField(default=dict)
+    status=models.CharField(max_length=10,choices=STATUS_CHOICES,default=PENDING)
+    attempts=models.PositiveIntegerField(default=0)
+    next_attempt_at=models.DateTimeField(default=timezone.now)
+    last_error=models.TextField(blank=True,default='')
+    created_at=models.DateTimeField(auto_now_add=True)
+    sent_at=models.DateTimeField(null=True,blank=True)
+
+    class Meta:
+        indexes=[
+            models.Index(fields=['status','next_attempt_at'],name='email_due_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} -> {self.to}'
@@ -1,3 +1,116 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import RequestFactory,TestCase,override_settings
+from rest_framework.exceptions import AuthenticationFailed
+from backend.profiling import query_budget
+from django.utils import timezone
+from users.authentication import CookieJWTAuthentication,forget_user
+from users.mail import deliver,enqueue_email
+from users.models import OutgoingEmail
+from users.views import MyTokenObtainPairSerializer
 
-# Create your tests here.
+
+def login(client,user):
+    #what the login view leaves in the browser
+    client.cookies['access_token']=str(MyTokenObtainPairSerializer.get_token(user).access_token)
+
+
+class AuthenticationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user=User.objects.create(username='ann@example.com',email='ann@example.com',first_name='Ann')
+        self.authentication=CookieJWTAuthentication()
+
+    def request(self,user):
+        request=RequestFactory().get('/')
+        request.COOKIES['access_token']=str(MyTokenObtainPairSerializer.get_token(user).access_token)
+        return request
+
+    def authenticate(self):
+        return self.authentication.authenticate(self.request(self.user))
+
+    def test_fast_path_builds_the_user_without_a_query(self):
+        self.authenticate()
+        with query_budget(0):
+            user,_=self.authenticate()
+        self.assertEqual(
+            (user.pk,user.username,user.email,user.first_name,user.is_active),
+            (self.user.id,'ann@example.com','ann@example.com','Ann',True),
+        )
+        #usable like a loaded user, never written
+        self.assertFalse(user._state.adding)
+        self.assertEqual(user,self.user)
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual(User.objects.filter(id=user.pk).count(),1)
+
+    def test_changes_show_once_the_cache_entry_is_gone(self):
+        self.authenticate()
+        User.objects.filter(id=self.user.id).update(first_name='Anne')
+        #the token still carries nothing but the id
+        self.assertEqual(self.authenticate()[0].first_name,'Ann')
+        forget_user(self.user.id)
+        self.assertEqual(self.authenticate()[0].first_name,'Anne')
+
+    def test_inactive_user_is_refused(self):
+        self.user.is_active=False
+        self.user.save()
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_deactivation_is_seen_after_forget_user(self):
+        self.authenticate()
+        User.objects.filter(id=self.user.id).update(is_active=False)
+        forget_user(self.user.id)
+        with self.assertRaises(AuthenticationFailed):
+            self.authenticate()
+
+    def test_deleted_user_is_refused(self):
+        user=User.objects.create(username='gone@example.com',email='gone@example.com')
+        request=self.request(user)
+        user.delete()
+        with self.assertRaises(AuthenticationFailed):
+            self.authentication.authenticate(request)
+        with self.assertRaises(AuthenticationFailed):
+            async_to_sync(self.authentication.aauthenticate)(request)
+
+    def test_async_path_builds_the_same_user(self):
+        user,_=async_to_sync(self.authentication.aauthenticate)(self.request(self.user))
+        self.assertEqual((user.pk,user.first_name,user.is_active),(self.user.id,'Ann',True))
+
+    @override_settings(JWT_AUTH_FAST_PATH=False)
+    def test_slow_path_loads_the_user(self):
+        user,_=self.authenticate()
+        self.assertEqual(user.pk,self.user.id)
+        self.assertIsNone(cache.get(f'auth:user:{self.user.id}'))
+
+
+class DeliverTest(TestCase):
+    def test_template_errors_count_as_failed_attempts(self):
+        email=enqueue_email('someone@example.com','Hello','missing.html',{})
+        self.assertFalse(deliver(email))
+        email.refresh_from_db()
+        self.assertEqual((email.status,email.attempts),(OutgoingEmail.PENDING,1))
+        self.assertIn('missing.html',email.last_error)
+        self.assertGreater(email.next_attempt_at,timezone.now())
+
+
+class UserQueryBudgetTest(TestCase):
+    def test_register(self):
+        #user insert and queued email
+        with query_budget(2):
+            response=self.client.post(
+                '/users/register/',
+                {'name':'Someone','email':'someone@example.com','password':'a long enough password 1'},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(OutgoingEmail.objects.count(),1)
+
+    def test_forgot_password(self):
+        User.objects.create(username='someone@example.com',email='someone@example.com')
+        #user lookup and queued email
+        with query_budget(2):
+            response=self.client.post('/users/forgot-password/',{'email':'someone@example.com'},content_type='application/json')
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(OutgoingEmail.objects.count(),1)
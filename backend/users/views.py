@@ -22,8 +22,8 @@ from django.contrib.auth.tokens import PasswordResetTokenGenerator
 from django.conf import settings
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
 from django.utils.encoding import force_bytes, force_str
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from users.authentication import forget_user
+from users.mail import enqueue_email
 
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     def validate(self, attrs):
@@ -77,18 +77,13 @@ def registerUser(request):
             first_name=data["name"],
             username=data["email"],
             email=data["email"],
-            password=data["password"]
+            password=data["password"],
+            is_active=False
         )   
-        user.is_active=False
-        user.save()
         # print("flag2")
         
         # serializer=UserSerializer(user,many=False)
         # return Response({"message":"ok"})
-        email=data.get("email")
-
-        user=User.objects.filter(email=email).first()
-
         if user:
             uid=urlsafe_base64_encode(force_bytes(user.pk))
             token=token_generator.make_token(user)
@@ -97,22 +92,12 @@ def registerUser(request):
                 f"{settings.FRONTEND_URL}/verify-email?uid={uid}&token={token}"
             )
             # print("flag 3")
-            html_content=render_to_string(
+            enqueue_email(
+                user.email,
+                "Collab Notes verify email request",
                 "users/verify_email.html",
                 {"email_url":email_url}
             )
-            
-            try:
-                message=Mail(
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    to_emails=user.email,
-                    subject="Collab Notes verify email request",
-                    html_content=html_content
-                )
-                sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-                sg.send(message)
-            except Exception as e:
-                print("sendgrid error:",e)
         return Response({"message":"Verify email sent"},status=HTTP_200_OK)       
     except ValidationError as e:
         message={"message":e.messages}
@@ -176,22 +161,12 @@ def forgot_password(request):
         reset_link=(
             f"{settings.FRONTEND_URL}/reset-password?uid={uid}&token={token}"
         )
-        html_content=render_to_string(
+        enqueue_email(
+            user.email,
+            "Collab Notes password reset request",
             "users/reset_password_email.html",
             {"reset_link":reset_link}
         )
-        
-        try:
-            message=Mail(
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                to_emails=user.email,
-                subject="Collab Notes password reset request",
-                html_content=html_content
-            )
-            sg = SendGridAPIClient(settings.SENDGRID_API_KEY)
-            sg.send(message)
-        except Exception as e:
-            print("sendgrid error:",e)
     return Response({"message":"If user exit, email sent"},status=HTTP_200_OK)
 
 #verify email for register  
@@ -218,6 +193,7 @@ def verify_email(request):
     
     user.is_active=True
     user.save()
+    forget_user(user.id)
 
     return Response({"message":"Email verified Successfully"},
                     status=HTTP_200_OK)
@@ -10,6 +10,7 @@ import ThemeToggle from '../components/ThemeToggle';
 import Loader from '../components/Loader';
 import { updateNote } from '../store/slices/notesSlice';
 import {  fetchIndividualNote } from '../store/slices/individualNoteSlice';
+import { NoteSync, renderHtml } from '../utils/noteSync';
 
 function EditorPage() {
   const WS_BASE_URL = import.meta.env.VITE_WS_URL;
@@ -18,88 +19,128 @@ function EditorPage() {
   const { id } = useParams<{ id: string }>();
   const timer=useRef<number|null>(null);
   const socketRef=useRef<WebSocket|null>(null);
+  const syncRef=useRef<NoteSync|null>(null);
   const userId=useSelector((state:RootState)=>state.auth.user?.id)
   const username=useSelector((state:RootState)=>state.auth.user?.name)
   useEffect(()=>{
-    const socket= new WebSocket(`${WS_BASE_URL}/ws/notes/${id}/`);
-    socketRef.current=socket;
+    let closed=false;
+    let retry=0;
+    let reconnectTimer:number|null=null;
+    // edits go out as ops against the server revision, see utils/noteSync
+    const sync=new NoteSync(
+      (message)=>{
+        if(socketRef.current?.readyState===WebSocket.OPEN){
+          socketRef.current.send(JSON.stringify(message));
+        }
+      },
+      ()=>bodyRef.current ? bodyRef.current.innerHTML : null,
+      (content)=>{
+        if(bodyRef.current){
+          renderHtml(bodyRef.current,content);
+        }
+      },
+      ()=>userId,
+    );
+    syncRef.current=sync;
+
+    const connect=()=>{
+      const socket= new WebSocket(`${WS_BASE_URL}/ws/notes/${id}/`);
+      socketRef.current=socket;
     
-    socket.onopen=()=>{
-      console.log(" WebSocket connected for note:", id);
-      setIsWsConnected(true);
-      // Don't add current user here - wait for the join message from backend
-      // This ensures all users are added through the same mechanism
-      socket.send(
-          JSON.stringify({
-            type:"join",
-            username:username,
-            senderId:userId,
-          })
-        )
-    }
+      socket.onopen=()=>{
+        console.log(" WebSocket connected for note:", id);
+        retry=0;
+        setIsWsConnected(true);
+        // Don't add current user here - wait for the join message from backend
+        // This ensures all users are added through the same mechanism
+        socket.send(
+            JSON.stringify({
+              type:"join",
+              username:username,
+              senderId:userId,
+            })
+          )
+        // a reconnect only asks for the revisions it missed
+        sync.resume();
+      }
       
-    socket.onmessage=(event:MessageEvent)=>{
-      const data=JSON.parse(event.data)
-      console.log("WebSocket message received:", data);
+      socket.onmessage=(event:MessageEvent)=>{
+        const data=JSON.parse(event.data)
+        console.log("WebSocket message received:", data);
+        sync.received();
 
       
       
 
-      if(data.type==="join"){
-        console.log("joined "+data.username+" "+data.senderId+" "+data.current_user);
+        if(data.type==="presence"){
+          // Full roster, sent once to us when we join
+          setConnectedUsers(data.users);
+          return;
+        }
+
+        if(data.type==="join"){
+          console.log("joined "+data.username+" "+data.senderId);
         
-        // Update the connected users list
-        // Strategy: Keep track of users we know about (with IDs), and add the new user
-        console.log(data.current_user);
-        setConnectedUsers(data.current_user);
+          // Join events only carry the user that joined
+          setConnectedUsers((users)=>({...users,[data.senderId]:data.username}));
         
-        // Don't show toast for your own join
-        if(data.senderId===userId){
+          // Don't show toast for your own join
+          if(data.senderId===userId){
+            return;
+          }
+          toast.success(`${data.username} joined`, {
+            autoClose: 3000,
+            pauseOnHover: false,
+            pauseOnFocusLoss: false,
+          });
           return;
         }
-        toast.success(`${data.username} joined`, {
-          autoClose: 3000,
-          pauseOnHover: false,
-          pauseOnFocusLoss: false,
-        });
-        return;
-      }
-      if(data.type==="left"){
-        console.log("left "+data.username+" "+data.senderId+" "+data.current_user);
-        // Remove user from connected users list
-        setConnectedUsers(data.current_user);
-        if(data.senderId===userId){
-        return;
-      }
-        toast.error(`${data.username} left`, {
-          autoClose: 3000,
-          pauseOnHover: false,
-          pauseOnFocusLoss: false,
-        });
-        return;
-      }
-      if(data.senderId===userId){
-        return;
-      }
-      if(bodyRef.current){
-        bodyRef.current.innerHTML=data.content;
+        if(data.type==="left"){
+          console.log("left "+data.username+" "+data.senderId);
+          // Remove user from connected users list
+          setConnectedUsers((users)=>{
+            const next={...users};
+            delete next[data.senderId];
+            return next;
+          });
+          if(data.senderId===userId){
+          return;
+        }
+          toast.error(`${data.username} left`, {
+            autoClose: 3000,
+            pauseOnHover: false,
+            pauseOnFocusLoss: false,
+          });
+          return;
+        }
+        sync.receive(data);
       }
-      console.log("Message received:", data.content);
-
-    }
 
 
-    socket.onerror=(error:Event)=>{
-      console.log("WebSocket error:", error);
-      setIsWsConnected(false);
-    }
-    socket.onclose=()=>{
-      console.log("WebSocket disconnected for note:", id);
-      setIsWsConnected(false);
+      socket.onerror=(error:Event)=>{
+        console.log("WebSocket error:", error);
+        setIsWsConnected(false);
+      }
+      socket.onclose=(event:CloseEvent)=>{
+        console.log("WebSocket disconnected for note:", id);
+        setIsWsConnected(false);
+        // 4403: no access to the note, retrying will not help
+        if(closed || event.code===4403){
+          return;
+        }
+        reconnectTimer=window.setTimeout(connect,Math.min(30000,1000*2**retry));
+        retry+=1;
+      }
     }
+    connect();
 
     return ()=>{
-       if (socket.readyState === WebSocket.OPEN){
+      closed=true;
+      if(reconnectTimer){
+        clearTimeout(reconnectTimer);
+      }
+      const socket=socketRef.current;
+       if (socket?.readyState === WebSocket.OPEN){
         socket.send(
           JSON.stringify({
             type:"left",
@@ -109,7 +150,7 @@ function EditorPage() {
         )
        }
       
-      socket.close();
+      socket?.close();
     }
   },[id])
 
@@ -182,7 +223,9 @@ function EditorPage() {
   // Set body content after component renders and fetchedNote is available
   useEffect(() => {
     if (fetchedNote && bodyRef.current && !isLoadingNote) {
-      bodyRef.current.innerHTML = fetchedNote.content;
+      // the socket snapshot is newer than the fetched note when it came first
+      const sync = syncRef.current;
+      bodyRef.current.innerHTML = sync?.ready ? sync.content : fetchedNote.content;
     }
   }, [fetchedNote, isLoadingNote]);
 
@@ -231,20 +274,14 @@ function EditorPage() {
     // console.log(userId)
     if(!userId || !bodyRef.current) return;
     const newBody = bodyRef.current.innerHTML;
-    if (bodyRef.current) {
-      
-      
-      if(socketRef.current?.readyState===WebSocket.OPEN){
-        // console.log("send")
-        // console.log("WS readyState:", socketRef.current?.readyState);
-
-        socketRef.current.send(
-          JSON.stringify({
-            content:newBody,
-            senderId:userId,
-          })
-        )
-      }
+    if(socketRef.current?.readyState===WebSocket.OPEN){
+      // the open room saves the content itself
+      syncRef.current?.edit();
+      return;
+    }
+    if(syncRef.current?.ready){
+      // reconnecting, the edits go out as ops once the socket is back
+      return;
     }
     if(timer.current){
       clearTimeout(timer.current)
@@ -6,6 +6,7 @@ import type { RootState } from '../types';
 import ThemeToggle from '../components/ThemeToggle';
 import Loader from '../components/Loader';
 import axios from 'axios';
+import { NoteSync, renderHtml } from '../utils/noteSync';
 
 function SharedEditorPage() {
   const WS_BASE_URL = import.meta.env.VITE_WS_URL;
@@ -14,6 +15,7 @@ function SharedEditorPage() {
   const { token } = useParams<{ token: string }>();
   const timer = useRef<number | null>(null);
   const socketRef = useRef<WebSocket | null>(null);
+  const syncRef = useRef<NoteSync | null>(null);
   const userId = useSelector((state: RootState) => state.auth.user?.id);
   const username = useSelector((state: RootState) => state.auth.user?.name);
   const navigate = useNavigate();
@@ -72,72 +74,113 @@ function SharedEditorPage() {
   useEffect(() => {
     if (!fetchedNote?.id) return;
 
-    const socket = new WebSocket(`${WS_BASE_URL}/ws/notes/${fetchedNote.id}/`);
-    socketRef.current = socket;
-
-    socket.onopen = () => {
-      console.log('WebSocket connected for shared note:', fetchedNote.id);
-      setIsWsConnected(true);
-      socket.send(
-        JSON.stringify({
-          type: 'join',
-          username: username,
-          senderId: userId,
-        })
-      );
-    };
+    let closed = false;
+    let retry = 0;
+    let reconnectTimer: number | null = null;
+    // edits go out as ops against the server revision, see utils/noteSync
+    const sync = new NoteSync(
+      (message) => {
+        if (socketRef.current?.readyState === WebSocket.OPEN) {
+          socketRef.current.send(JSON.stringify(message));
+        }
+      },
+      () => (bodyRef.current ? bodyRef.current.innerHTML : null),
+      (content) => {
+        if (bodyRef.current) {
+          renderHtml(bodyRef.current, content);
+        }
+      },
+      () => userId
+    );
+    syncRef.current = sync;
+
+    const connect = () => {
+      const socket = new WebSocket(`${WS_BASE_URL}/ws/notes/${fetchedNote.id}/`);
+      socketRef.current = socket;
+
+      socket.onopen = () => {
+        console.log('WebSocket connected for shared note:', fetchedNote.id);
+        retry = 0;
+        setIsWsConnected(true);
+        socket.send(
+          JSON.stringify({
+            type: 'join',
+            username: username,
+            senderId: userId,
+          })
+        );
+        // a reconnect only asks for the revisions it missed
+        sync.resume();
+      };
 
-    socket.onmessage = (event: MessageEvent) => {
-      const data = JSON.parse(event.data);
-      console.log('WebSocket message received:', data);
+      socket.onmessage = (event: MessageEvent) => {
+        const data = JSON.parse(event.data);
+        console.log('WebSocket message received:', data);
+        sync.received();
 
-      if (data.type === 'join') {
-        setConnectedUsers(data.current_user);
-        if (data.senderId === userId) {
+        if (data.type === 'presence') {
+          setConnectedUsers(data.users);
           return;
         }
-        toast.success(`${data.username} joined`, {
-          autoClose: 3000,
-          pauseOnHover: false,
-          pauseOnFocusLoss: false,
-        });
-        return;
-      }
 
-      if (data.type === 'left') {
-        setConnectedUsers(data.current_user);
-        if (data.senderId === userId) {
+        if (data.type === 'join') {
+          setConnectedUsers((users) => ({ ...users, [data.senderId]: data.username }));
+          if (data.senderId === userId) {
+            return;
+          }
+          toast.success(`${data.username} joined`, {
+            autoClose: 3000,
+            pauseOnHover: false,
+            pauseOnFocusLoss: false,
+          });
           return;
         }
-        toast.error(`${data.username} left`, {
-          autoClose: 3000,
-          pauseOnHover: false,
-          pauseOnFocusLoss: false,
-        });
-        return;
-      }
 
-      if (data.senderId === userId) {
-        return;
-      }
+        if (data.type === 'left') {
+          setConnectedUsers((users) => {
+            const next = { ...users };
+            delete next[data.senderId];
+            return next;
+          });
+          if (data.senderId === userId) {
+            return;
+          }
+          toast.error(`${data.username} left`, {
+            autoClose: 3000,
+            pauseOnHover: false,
+            pauseOnFocusLoss: false,
+          });
+          return;
+        }
 
-      if (bodyRef.current) {
-        bodyRef.current.innerHTML = data.content;
-      }
-    };
+        sync.receive(data);
+      };
 
-    socket.onerror = (error: Event) => {
-      console.log('WebSocket error:', error);
-      setIsWsConnected(false);
-    };
+      socket.onerror = (error: Event) => {
+        console.log('WebSocket error:', error);
+        setIsWsConnected(false);
+      };
 
-    socket.onclose = () => {
-      console.log('WebSocket disconnected for shared note:', fetchedNote.id);
-      setIsWsConnected(false);
+      socket.onclose = (event: CloseEvent) => {
+        console.log('WebSocket disconnected for shared note:', fetchedNote.id);
+        setIsWsConnected(false);
+        // 4403: no access to the note, retrying will not help
+        if (closed || event.code === 4403) {
+          return;
+        }
+        reconnectTimer = window.setTimeout(connect, Math.min(30000, 1000 * 2 ** retry));
+        retry += 1;
+      };
     };
+    connect();
 
     return () => {
-      if (socket.readyState === WebSocket.OPEN) {
+      closed = true;
+      if (reconnectTimer) {
+        clearTimeout(reconnectTimer);
+      }
+      const socket = socketRef.current;
+      if (socket?.readyState === WebSocket.OPEN) {
         socket.send(
           JSON.stringify({
             type: 'left',
@@ -146,14 +189,16 @@ function SharedEditorPage() {
           })
         );
       }
-      socket.close();
+      socket?.close();
     };
   }, [fetchedNote?.id, WS_BASE_URL, userId, username]);
 
   // Set body content after component renders
   useEffect(() => {
     if (fetchedNote && bodyRef.current && !isLoadingNote) {
-      bodyRef.current.innerHTML = fetchedNote.content;
+      // the socket snapshot is newer than the fetched note when it came first
+      const sync = syncRef.current;
+      bodyRef.current.innerHTML = sync?.ready ? sync.content : fetchedNote.content;
     }
   }, [fetchedNote, isLoadingNote]);
 
@@ -208,12 +253,13 @@ function SharedEditorPage() {
     const newBody = bodyRef.current.innerHTML;
 
     if (socketRef.current?.readyState === WebSocket.OPEN) {
-      socketRef.current.send(
-        JSON.stringify({
-          content: newBody,
-          senderId: userId,
-        })
-      );
+      // the open room saves the content itself
+      syncRef.current?.edit();
+      return;
+    }
+    if (syncRef.current?.ready) {
+      // reconnecting, the edits go out as ops once the socket is back
+      return;
     }
 
     if (timer.current) {
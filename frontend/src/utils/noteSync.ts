@@ -0,0 +1,278 @@
+/**
+ * Note Sync
+ * Client side of the note websocket delta protocol (backend notes/delta.py).
+ * Local edits are sent as ops against the last revision the server confirmed,
+ * one message in flight at a time, and remote ops are transformed over them.
+ * Positions count code points like the server, not UTF-16 units.
+ */
+
+export type Op = { pos: number; insert: string } | { pos: number; delete: number };
+
+const chars = (text: string): string[] => Array.from(text);
+
+/**
+ * Apply ops one after the other, throws when one is out of range
+ */
+export const applyOps = (content: string, ops: Op[]): string => {
+  const text = chars(content);
+  for (const op of ops) {
+    if ('insert' in op) {
+      if (op.pos > text.length) throw new RangeError('insert out of range');
+      text.splice(op.pos, 0, ...chars(op.insert));
+    } else {
+      if (op.pos + op.delete > text.length) throw new RangeError('delete out of range');
+      text.splice(op.pos, op.delete);
+    }
+  }
+  return text.join('');
+};
+
+/**
+ * Single delete+insert covering the changed middle part, like the server's diff_ops
+ */
+export const diffOps = (before: string, after: string): Op[] => {
+  const a = chars(before);
+  const b = chars(after);
+  const limit = Math.min(a.length, b.length);
+  let start = 0;
+  while (start < limit && a[start] === b[start]) start++;
+  let end = 0;
+  while (end < limit - start && a[a.length - 1 - end] === b[b.length - 1 - end]) end++;
+  const ops: Op[] = [];
+  if (a.length - end > start) ops.push({ pos: start, delete: a.length - end - start });
+  if (b.length - end > start) ops.push({ pos: start, insert: b.slice(start, b.length - end).join('') });
+  return ops;
+};
+
+const transformOp = (a: Op, b: Op, aFirst: boolean): Op[] => {
+  const pos = a.pos;
+  if ('insert' in a) {
+    if ('insert' in b) {
+      if (pos < b.pos || (pos === b.pos && aFirst)) return [a];
+      return [{ pos: pos + chars(b.insert).length, insert: a.insert }];
+    }
+    if (pos <= b.pos) return [a];
+    if (pos >= b.pos + b.delete) return [{ pos: pos - b.delete, insert: a.insert }];
+    return [{ pos: b.pos, insert: a.insert }];
+  }
+  const end = pos + a.delete;
+  if ('insert' in b) {
+    if (b.pos >= end) return [a];
+    const length = chars(b.insert).length;
+    if (b.pos <= pos) return [{ pos: pos + length, delete: a.delete }];
+    // text inserted inside the deleted range survives, delete around it
+    const before = b.pos - pos;
+    return [
+      { pos, delete: before },
+      { pos: pos + length, delete: a.delete - before },
+    ];
+  }
+  const bEnd = b.pos + b.delete;
+  const shift = Math.max(0, Math.min(pos, bEnd) - b.pos);
+  const overlap = Math.max(0, Math.min(end, bEnd) - Math.max(pos, b.pos));
+  const length = a.delete - overlap;
+  if (!length) return [];
+  return [{ pos: pos - shift, delete: length }];
+};
+
+/**
+ * Returns [a', b'] so that applying b then a' gives the same text as a then b'.
+ * aFirst breaks ties between two inserts at the same position
+ */
+export const transform = (opsA: Op[], opsB: Op[], aFirst: boolean): [Op[], Op[]] => {
+  if (!opsA.length || !opsB.length) return [opsA, opsB];
+  if (opsA.length === 1 && opsB.length === 1) {
+    return [transformOp(opsA[0], opsB[0], aFirst), transformOp(opsB[0], opsA[0], !aFirst)];
+  }
+  if (opsA.length > 1) {
+    const [head, restB] = transform(opsA.slice(0, 1), opsB, aFirst);
+    const [tail, lastB] = transform(opsA.slice(1), restB, aFirst);
+    return [[...head, ...tail], lastB];
+  }
+  const [restA, head] = transform(opsA, opsB.slice(0, 1), aFirst);
+  const [lastA, tail] = transform(restA, opsB.slice(1), aFirst);
+  return [lastA, [...head, ...tail]];
+};
+
+const textOffset = (root: HTMLElement): number | null => {
+  const selection = window.getSelection();
+  if (!selection || !selection.rangeCount) return null;
+  const range = selection.getRangeAt(0);
+  if (!root.contains(range.endContainer)) return null;
+  const before = document.createRange();
+  before.selectNodeContents(root);
+  before.setEnd(range.endContainer, range.endOffset);
+  return before.toString().length;
+};
+
+const placeCaret = (root: HTMLElement, offset: number) => {
+  const walker = document.createTreeWalker(root, NodeFilter.SHOW_TEXT);
+  let node = walker.nextNode();
+  while (node) {
+    const length = node.textContent?.length ?? 0;
+    if (offset <= length) {
+      const selection = window.getSelection();
+      const range = document.createRange();
+      range.setStart(node, offset);
+      range.collapse(true);
+      selection?.removeAllRanges();
+      selection?.addRange(range);
+      return;
+    }
+    offset -= length;
+    node = walker.nextNode();
+  }
+};
+
+/**
+ * Replace the editor html, keeping the caret at the same text offset
+ */
+export const renderHtml = (root: HTMLElement, html: string) => {
+  if (root.innerHTML === html) return;
+  const offset = textOffset(root);
+  root.innerHTML = html;
+  if (offset !== null) placeCaret(root, offset);
+};
+
+type Send = (message: object) => void;
+
+// frames between two "seen" reports, the server sends at most NOTES_WS_WINDOW
+// frames ahead of the last report so this has to stay well below it
+const SEEN_EVERY = 16;
+
+/**
+ * Revision bookkeeping for one note. read returns the editor html (null while
+ * the editor is not mounted), render shows the document after remote changes
+ */
+export class NoteSync {
+  rev = 0;
+  content = '';
+  ready = false;
+  private frames = 0;
+  private inflight: Op[] | null = null;
+  private buffer: Op[] | null = null;
+  private send: Send;
+  private read: () => string | null;
+  private render: (content: string) => void;
+  private senderId: () => number | undefined;
+
+  constructor(send: Send, read: () => string | null, render: (content: string) => void, senderId: () => number | undefined) {
+    this.send = send;
+    this.read = read;
+    this.render = render;
+    this.senderId = senderId;
+  }
+
+  /**
+   * Ask for the document, the server answers with a snapshot
+   */
+  start() {
+    this.ready = false;
+    this.send({ type: 'sync' });
+  }
+
+  /**
+   * Count a frame the page processed, the server holds back frames for a client
+   * that falls behind
+   */
+  received() {
+    this.frames++;
+    if (this.frames % SEEN_EVERY === 0) this.send({ type: 'seen', frames: this.frames });
+  }
+
+  /**
+   * Call when a socket opens. After a reconnect ask only for the revisions
+   * missed and send the edits made meanwhile, the server rebases them like any
+   * other op. An op without an ack may or may not have been applied, that
+   * case starts over from a snapshot
+   */
+  resume() {
+    this.frames = 0;
+    if (!this.ready || this.inflight) {
+      this.start();
+      return;
+    }
+    this.send({ type: 'sync', rev: this.rev });
+    this.edit();
+  }
+
+  /**
+   * Pick up whatever changed in the editor since the last call
+   */
+  edit() {
+    if (!this.ready) return;
+    const content = this.read();
+    if (content === null) return;
+    const ops = diffOps(this.content, content);
+    if (!ops.length) return;
+    this.content = content;
+    if (this.inflight) {
+      this.buffer = [...(this.buffer ?? []), ...ops];
+    } else {
+      this.submit(ops);
+    }
+  }
+
+  /**
+   * Handle a delta protocol frame, false for frames meant for the page
+   */
+  receive(data: any): boolean {
+    if (data.type === 'snapshot') {
+      // local edits the server has not confirmed are dropped with the old state
+      this.rev = data.rev;
+      this.content = data.content;
+      this.inflight = null;
+      this.buffer = null;
+      this.ready = true;
+      this.render(this.content);
+      return true;
+    }
+    if (data.type === 'ack') {
+      if (!this.inflight) {
+        // an op sent before a snapshot landed after it, the snapshot lacks it
+        if (data.rev > this.rev) this.start();
+        return true;
+      }
+      this.rev = data.rev;
+      this.inflight = null;
+      if (this.buffer) {
+        const ops = this.buffer;
+        this.buffer = null;
+        this.submit(ops);
+      }
+      return true;
+    }
+    if (data.type === 'op') {
+      if (!this.ready || data.rev <= this.rev) return true;
+      if (data.baseRev !== this.rev) {
+        // frames were skipped, start over from a snapshot
+        this.start();
+        return true;
+      }
+      this.edit();
+      // the server sequenced these before our pending ops, they win ties
+      let remote: Op[] = data.ops;
+      if (this.inflight) [this.inflight, remote] = transform(this.inflight, remote, false);
+      if (this.buffer) [this.buffer, remote] = transform(this.buffer, remote, false);
+      try {
+        this.content = applyOps(this.content, remote);
+      } catch {
+        this.start();
+        return true;
+      }
+      this.rev = data.rev;
+      this.render(this.content);
+      return true;
+    }
+    if (data.type === 'error') {
+      console.error('Note sync error:', data.message);
+      return true;
+    }
+    return false;
+  }
+
+  private submit(ops: Op[]) {
+    this.inflight = ops;
+    this.send({ type: 'op', rev: this.rev, ops, senderId: this.senderId() });
+  }
+}